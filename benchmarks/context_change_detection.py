@@ -0,0 +1,83 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compare the cost of detecting changed output contexts via MessageToJson strings and via binary fingerprints
+
+    PYTHONPATH=. python benchmarks/context_change_detection.py --contexts 25 --parameters 10
+"""
+import argparse
+import timeit
+from typing import (
+    Callable,
+    Dict,
+    Tuple,
+)
+
+from google.protobuf.json_format import MessageToJson
+from ondewo.nlu import (
+    context_pb2,
+    session_pb2,
+)
+
+from ondewo_bpi.bpi_services import BpiSessionsServices
+
+
+def build_response(num_contexts: int, num_parameters: int) -> session_pb2.DetectIntentResponse:
+    response: session_pb2.DetectIntentResponse = session_pb2.DetectIntentResponse()
+    for context_index in range(num_contexts):
+        context: context_pb2.Context = response.query_result.output_contexts.add(
+            name=f"projects/p/agent/sessions/s/contexts/context_{context_index}",
+            lifespan_count=5,
+        )
+        for parameter_index in range(num_parameters):
+            parameter: context_pb2.Context.Parameter = context.parameters[f"parameter_{parameter_index}"]
+            parameter.display_name = f"parameter_{parameter_index}"
+            parameter.value = f"value {parameter_index} of context {context_index} " * 4
+            parameter.value_original = parameter.value
+    return response
+
+
+def json_snapshot(response: session_pb2.DetectIntentResponse) -> Dict[str, Tuple[str, context_pb2.Context]]:
+    return {
+        context.name: (MessageToJson(message=context, sort_keys=True, indent=True), context)
+        for context in response.query_result.output_contexts
+    }
+
+
+def run(name: str, snapshot: Callable, response: session_pb2.DetectIntentResponse, repetitions: int) -> float:
+    # before and after processing, as in DetectIntent
+    seconds: float = timeit.timeit(lambda: (snapshot(response), snapshot(response)), number=repetitions)
+    per_request_ms: float = seconds / repetitions * 1000
+    print(f"{name:>20}: {per_request_ms:8.3f} ms per request")
+    return per_request_ms
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--contexts", type=int, default=25)
+    parser.add_argument("--parameters", type=int, default=10)
+    parser.add_argument("--repetitions", type=int, default=200)
+    args = parser.parse_args()
+
+    response: session_pb2.DetectIntentResponse = build_response(args.contexts, args.parameters)
+    print(f"{args.contexts} contexts with {args.parameters} parameters each")
+    json_ms: float = run("MessageToJson", json_snapshot, response, args.repetitions)
+    fingerprint_ms: float = run(
+        "fingerprint", BpiSessionsServices._get_output_contexts_dict, response, args.repetitions
+    )
+    print(f"{'speedup':>20}: {json_ms / fingerprint_ms:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
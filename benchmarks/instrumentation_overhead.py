@@ -0,0 +1,111 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compare the per-call overhead of the instrumentation modes with a plain call and with ondewo.logging's Timer
+
+    PYTHONPATH=. python benchmarks/instrumentation_overhead.py --repetitions 100000
+"""
+import argparse
+import logging
+import timeit
+from typing import (
+    Callable,
+    Optional,
+)
+
+from ondewo.logging.decorators import Timer
+from ondewo.nlu import (
+    intent_pb2,
+    session_pb2,
+)
+
+from ondewo_bpi.instrumentation import (
+    INSTRUMENTATION_FULL,
+    INSTRUMENTATION_OFF,
+    INSTRUMENTATION_SAMPLED,
+    configure_instrumentation,
+    instrumented,
+    instrumented_request,
+)
+
+# records are formatted but not written, so the numbers show the CPU cost and not the I/O of the log handlers
+benchmark_logger: logging.Logger = logging.getLogger("bpi_instrumentation_benchmark")
+benchmark_logger.addHandler(logging.NullHandler())
+benchmark_logger.propagate = False
+
+
+def build_response() -> session_pb2.DetectIntentResponse:
+    response: session_pb2.DetectIntentResponse = session_pb2.DetectIntentResponse(response_id="r")
+    for index in range(5):
+        response.query_result.fulfillment_messages.append(
+            intent_pb2.Intent.Message(text=intent_pb2.Intent.Message.Text(text=[f"message {index} " * 10]))
+        )
+    response.query_result.diagnostic_info["sessionId"] = "projects/p/agent/sessions/s"
+    return response
+
+
+def get_session(response: session_pb2.DetectIntentResponse) -> str:
+    return response.query_result.diagnostic_info["sessionId"]
+
+
+def run(name: str, call: Callable[[], object], repetitions: int, plain_ns: Optional[float] = None) -> float:
+    # the best of several runs is the least disturbed by other processes
+    per_call_ns: float = min(timeit.repeat(call, number=repetitions, repeat=5)) / repetitions * 1e9
+    overhead: str = "" if plain_ns is None else f", {per_call_ns - plain_ns:+10.0f} ns overhead"
+    print(f"{name:>36}: {per_call_ns:10.0f} ns per call{overhead}")
+    return per_call_ns
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repetitions", type=int, default=100000)
+    parser.add_argument("--sample-every", type=int, default=100)
+    args = parser.parse_args()
+    repetitions: int = args.repetitions
+
+    response: session_pb2.DetectIntentResponse = build_response()
+    message: str = "get_session: Elapsed time: {:0.4f}"
+    timer_function: Callable = Timer(logger=benchmark_logger.debug, log_arguments=True, message=message)(get_session)
+    instrumented_function: Callable = instrumented(
+        logger=benchmark_logger.debug, log_arguments=True, message=message,
+    )(get_session)
+
+    plain_ns: float = run("plain call", lambda: get_session(response), repetitions)
+    benchmark_logger.setLevel(logging.DEBUG)
+    run("Timer, debug enabled", lambda: timer_function(response), repetitions // 10, plain_ns)
+    benchmark_logger.setLevel(logging.INFO)
+    run("Timer, debug disabled", lambda: timer_function(response), repetitions // 10, plain_ns)
+
+    configure_instrumentation(INSTRUMENTATION_OFF)
+    run("off", lambda: instrumented_function(response), repetitions, plain_ns)
+
+    benchmark_logger.setLevel(logging.DEBUG)
+    configure_instrumentation(INSTRUMENTATION_SAMPLED, sample_every=args.sample_every)
+    # the first request of the counter is sampled, the next one is not (unless every request is sampled)
+    with instrumented_request():
+        pass
+    with instrumented_request():
+        run("sampled, in an unsampled request", lambda: instrumented_function(response), repetitions, plain_ns)
+    run(
+        f"sampled 1/{args.sample_every} calls", lambda: instrumented_function(response), repetitions, plain_ns,
+    )
+
+    configure_instrumentation(INSTRUMENTATION_FULL)
+    run("full, debug enabled", lambda: instrumented_function(response), repetitions // 10, plain_ns)
+    benchmark_logger.setLevel(logging.INFO)
+    run("full, debug disabled", lambda: instrumented_function(response), repetitions, plain_ns)
+
+
+if __name__ == "__main__":
+    main()
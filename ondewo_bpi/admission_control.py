@@ -0,0 +1,209 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+from threading import Lock
+from typing import (
+    Any,
+    Callable,
+    Iterator,
+    Optional,
+    Set,
+)
+
+import grpc
+from ondewo.logging.logger import logger_console as log
+
+from ondewo_bpi.interceptor_helpers import (  # noqa: F401
+    RETRY_AFTER_METADATA_KEY,
+    Behavior,
+    abort_handler,
+    abort_resource_exhausted,
+    replace_behavior,
+)
+
+DETECT_INTENT_METHOD: str = "/ondewo.nlu.Sessions/DetectIntent"
+
+
+class AimdConcurrencyLimiter:
+    """
+    Adaptive concurrency limit following additive-increase / multiplicative-decrease (AIMD)
+
+    Completed calls whose latency stays below `latency_threshold_seconds` while the limit is saturated increase the
+    limit by about `increase_step` per limit-many calls. A slower call (or a call that failed because of overload)
+    decreases the limit by `backoff_ratio`, at most once per `decrease_cooldown_seconds`, so that one slow burst does
+    not collapse the limit to its minimum. Under overload the BPI therefore rejects early instead of queueing until everything
+    times out.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int,
+        min_limit: int,
+        max_limit: int,
+        latency_threshold_seconds: float,
+        backoff_ratio: float = 0.9,
+        increase_step: float = 1.0,
+        decrease_cooldown_seconds: float = 1.0,
+    ) -> None:
+        assert 0 < min_limit <= initial_limit <= max_limit, "limits must satisfy 0 < min <= initial <= max"
+        assert 0.0 < backoff_ratio < 1.0, "backoff_ratio must be in (0, 1)"
+        self.min_limit: int = min_limit
+        self.max_limit: int = max_limit
+        self.latency_threshold_seconds: float = latency_threshold_seconds
+        self.backoff_ratio: float = backoff_ratio
+        self.increase_step: float = increase_step
+        self.decrease_cooldown_seconds: float = decrease_cooldown_seconds
+        self._limit: float = float(initial_limit)
+        self._inflight: int = 0
+        self._last_decrease: float = 0.0
+        self._lock: Lock = Lock()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def inflight(self) -> int:
+        return self._inflight
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self._inflight >= int(self._limit):
+                return False
+            self._inflight += 1
+            return True
+
+    def release(self, latency_seconds: Optional[float] = None, overloaded: bool = False) -> None:
+        """
+        Args:
+            latency_seconds: latency of the call, None if the call must not be used as a latency sample
+            overloaded: the call failed because a downstream service is overloaded
+        """
+        with self._lock:
+            was_saturated: bool = self._inflight >= int(self._limit) - 1
+            self._inflight -= 1
+            if overloaded or (latency_seconds is not None and latency_seconds > self.latency_threshold_seconds):
+                now: float = time.monotonic()
+                if now - self._last_decrease >= self.decrease_cooldown_seconds:
+                    self._limit = max(float(self.min_limit), self._limit * self.backoff_ratio)
+                    self._last_decrease = now
+            elif latency_seconds is not None and was_saturated:
+                # only grow when the limit is actually the bottleneck; step / limit per call adds ~step per "round"
+                self._limit = min(float(self.max_limit), self._limit + self.increase_step / self._limit)
+
+
+class AdmissionControlInterceptor(grpc.ServerInterceptor):
+    """
+    Server interceptor which fast-fails calls with RESOURCE_EXHAUSTED once the adaptive concurrency limit is reached
+
+    The rejected call carries a `retry-after-ms` trailing metadata entry as a hint for the client when to retry.
+    Latency samples for the limiter are only taken from `latency_methods` (by default DetectIntent), since the latency
+    of admin endpoints like ExportAgent says nothing about the health of the conversational path.
+    """
+
+    def __init__(
+        self,
+        limiter: AimdConcurrencyLimiter,
+        retry_after_ms: int = 1000,
+        latency_methods: Optional[Set[str]] = None,
+    ) -> None:
+        self.limiter: AimdConcurrencyLimiter = limiter
+        self.retry_after_ms: int = retry_after_ms
+        self.latency_methods: Set[str] = latency_methods if latency_methods is not None else {DETECT_INTENT_METHOD}
+        self.rejected_calls: int = 0
+
+    def _reject(self, request: Any, context: grpc.ServicerContext) -> None:
+        abort_resource_exhausted(
+            context=context,
+            details=f"BPI is overloaded (concurrency limit {self.limiter.limit}), retry after {self.retry_after_ms} ms",
+            retry_after_ms=self.retry_after_ms,
+        )
+
+    def _release(self, start: float, sample_latency: bool, error: Optional[BaseException]) -> None:
+        overloaded: bool = isinstance(error, grpc.RpcError) and error.code() in {  # type: ignore
+            grpc.StatusCode.RESOURCE_EXHAUSTED,
+            grpc.StatusCode.DEADLINE_EXCEEDED,
+            grpc.StatusCode.UNAVAILABLE,
+        }
+        latency: Optional[float] = time.monotonic() - start if sample_latency else None
+        self.limiter.release(latency_seconds=latency, overloaded=overloaded)
+
+    def _wrap_unary_response(self, behavior: Behavior, sample_latency: bool) -> Behavior:
+        def wrapper(request_or_iterator: Any, context: grpc.ServicerContext) -> Any:
+            start: float = time.monotonic()
+            error: Optional[BaseException] = None
+            try:
+                return behavior(request_or_iterator, context)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                self._release(start, sample_latency, error)
+
+        return wrapper
+
+    def _wrap_stream_response(self, behavior: Behavior, sample_latency: bool) -> Behavior:
+        def wrapper(request_or_iterator: Any, context: grpc.ServicerContext) -> Iterator[Any]:
+            start: float = time.monotonic()
+            release_lock: Lock = Lock()
+            released: bool = False
+
+            def release_once(error: Optional[BaseException], with_latency: bool) -> None:
+                nonlocal released
+                with release_lock:
+                    if released:
+                        return
+                    released = True
+                self._release(start, sample_latency and with_latency, error)
+
+            def stream() -> Iterator[Any]:
+                error: Optional[BaseException] = None
+                try:
+                    yield from behavior(request_or_iterator, context)
+                except BaseException as e:
+                    error = e
+                    raise
+                finally:
+                    release_once(error, with_latency=True)
+
+            # a response stream which is never read (the client cancelled before) does not run its finally
+            if not context.add_callback(lambda: release_once(None, with_latency=False)):
+                release_once(None, with_latency=False)  # the call has already terminated
+            return stream()
+
+        return wrapper
+
+    def intercept_service(
+        self,
+        continuation: Callable[[grpc.HandlerCallDetails], Optional[grpc.RpcMethodHandler]],
+        handler_call_details: grpc.HandlerCallDetails,
+    ) -> Optional[grpc.RpcMethodHandler]:
+        handler: Optional[grpc.RpcMethodHandler] = continuation(handler_call_details)
+        if handler is None:
+            return None
+
+        if not self.limiter.try_acquire():
+            self.rejected_calls += 1
+            log.debug(
+                f"AdmissionControlInterceptor: rejected {handler_call_details.method}, "
+                f"inflight={self.limiter.inflight}, limit={self.limiter.limit}"
+            )
+            return abort_handler(handler=handler, behavior=self._reject)
+
+        sample_latency: bool = handler_call_details.method in self.latency_methods
+        return replace_behavior(
+            handler=handler,
+            wrap_unary_response=lambda behavior: self._wrap_unary_response(behavior, sample_latency),
+            wrap_stream_response=lambda behavior: self._wrap_stream_response(behavior, sample_latency),
+        )
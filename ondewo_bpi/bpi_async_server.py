@@ -0,0 +1,129 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+from concurrent import futures
+from typing import Optional
+
+import grpc
+from ondewo.logging.decorators import Timer
+from ondewo.logging.logger import (
+    logger,
+    logger_console as log,
+)
+from ondewo.nlu.session_pb2_grpc import SessionsStub
+
+from ondewo_bpi.bpi_async_services import AsyncBpiSessionsServices
+from ondewo_bpi.bpi_server import BpiServer
+from ondewo_bpi.config import (
+    CentralClientProvider,
+    ONDEWO_BPI_ASYNC_RELAY_MAX_WORKERS,
+    ONDEWO_BPI_HOST,
+    ONDEWO_BPI_PORT,
+)
+
+
+class AsyncBpiServer(AsyncBpiSessionsServices, BpiServer):
+    """
+    BPI server based on grpc.aio
+
+    DetectIntent is served natively on the event loop and calls CAI through a grpc.aio channel, so an in-flight
+    conversation does not hold an OS thread while it waits for CAI. All other (relayed) endpoints are synchronous
+    and are served by the migration thread pool of the grpc.aio server.
+    """
+
+    @Timer(
+        logger=log.debug, log_arguments=False,
+        message='AsyncBpiServer: __init__: Elapsed time: {:0.4f}'
+    )
+    def __init__(self, client_provider: Optional[CentralClientProvider] = None) -> None:
+        if not client_provider:
+            client_provider = CentralClientProvider()
+        super().__init__(client_provider=client_provider)
+        self.client_provider: CentralClientProvider = client_provider
+        self.async_cai_channel: Optional[grpc.aio.Channel] = None
+
+    async def _setup_server_async(self) -> None:
+        logger.info("attempting to setup asyncio server...")
+        for interceptor in self.interceptors:
+            if not isinstance(interceptor, grpc.aio.ServerInterceptor):
+                log.warning(f"{type(interceptor).__name__} is only supported by the threaded BpiServer, skipped")
+        server: grpc.aio.Server = grpc.aio.server(
+            migration_thread_pool=futures.ThreadPoolExecutor(max_workers=ONDEWO_BPI_ASYNC_RELAY_MAX_WORKERS),
+            options=self.server_options,
+            interceptors=[i for i in self.interceptors if isinstance(i, grpc.aio.ServerInterceptor)],
+            maximum_concurrent_rpcs=self.maximum_concurrent_rpcs,
+        )
+        self.server = server
+        self._add_services()
+        self._setup_reflection()
+        if ONDEWO_BPI_HOST:
+            server.add_insecure_port(f"{ONDEWO_BPI_HOST}:{ONDEWO_BPI_PORT}")
+        else:
+            server.add_insecure_port(f"[::]:{ONDEWO_BPI_PORT}")
+
+        self.async_cai_channel = self.client_provider.get_async_channel()
+        self.async_sessions_stub = SessionsStub(channel=self.async_cai_channel)
+        if self.detect_intent_hedger is not None:
+            log.info("hedging is enabled: DetectIntent calls CAI through the hedger in the sync handler pool")
+
+        logger.info(f"SERVING ASYNCIO SERVER AT SERVING PORT {ONDEWO_BPI_PORT}")
+        await self.server.start()  # type: ignore
+
+    async def _serve_async(self) -> None:
+        await self._setup_server_async()
+        log.info({"message": f"Asyncio server started on port {ONDEWO_BPI_PORT}", "content": ONDEWO_BPI_PORT})
+        self.freeze_intent_handlers()
+        log.info(
+            {
+                "message": f"using intent handlers list: {self.intent_handlers}",
+                "content": self.intent_handlers,
+            }
+        )
+        try:
+            self.server_is_running = True
+            while self.server_should_run:
+                await asyncio.sleep(3)
+        finally:
+            self.server_is_running = False
+            await self.server.stop(grace=None)  # type: ignore
+            if self.async_cai_channel:
+                await self.async_cai_channel.close()
+            self.async_sessions_stub = None
+            self.sync_handler_executor.shutdown(wait=False)
+            self.context_sync.stop()
+            if self.quicksend_dispatcher:
+                # coroutine quicksends still need the event loop while the queue drains
+                await asyncio.get_running_loop().run_in_executor(None, self.quicksend_dispatcher.stop)
+
+    @Timer(
+        logger=log.debug, log_arguments=False,
+        message='AsyncBpiServer: serve: Elapsed time: {:0.4f}'
+    )
+    def serve(self) -> None:
+        self._start_log_queue()
+        try:
+            log.info(f"attempting to start asyncio server on port {ONDEWO_BPI_PORT}")
+            try:
+                asyncio.run(self._serve_async())
+            except KeyboardInterrupt:
+                log.info("Keyboard interrupt, shutting down")
+            log.info({"message": "server shut down", "tags": ["timing"]})
+        finally:
+            # also if the server failed: give the loggers their handlers back and write the queued records
+            self._stop_log_queue()
+
+
+if __name__ == "__main__":
+    server = AsyncBpiServer()
+    server.serve()
@@ -0,0 +1,327 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import contextvars
+import inspect
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+import grpc
+from ondewo.logging.logger import logger_console as log
+from ondewo.nlu import (
+    context_pb2,
+    intent_pb2,
+    session_pb2,
+)
+from ondewo.nlu.session_pb2_grpc import SessionsStub
+
+from ondewo_bpi.bpi_services import (
+    BpiSessionsServices,
+    merge_handler_responses,
+)
+from ondewo_bpi.config import ONDEWO_BPI_ASYNC_SYNC_HANDLER_MAX_WORKERS
+from ondewo_bpi.deadline import (
+    get_context_time_remaining,
+    is_abandoned,
+    request_budget,
+    time_remaining,
+)
+from ondewo_bpi.helpers import get_session_from_response
+from ondewo_bpi.instrumentation import instrumented_request
+from ondewo_bpi.lazy_logging import (
+    PAYLOAD_LOG,
+    lazy_log,
+)
+from ondewo_bpi.message_handler import MessageHandler
+from ondewo_bpi.response_cache import ResponseCacheKey
+from ondewo_bpi.single_flight import (
+    Flight,
+    get_request_fingerprint,
+)
+from ondewo_bpi.stage_timing import (
+    observe_intent_handler,
+    observe_stage,
+)
+
+
+class AsyncBpiSessionsServices(BpiSessionsServices):
+    """
+    asyncio version of the DetectIntent pipeline of BpiSessionsServices, served by grpc.aio
+
+    Intent and trigger handlers can be registered as coroutine functions and are awaited directly on the event loop.
+    Synchronous handlers are still supported and run in `sync_handler_executor`, so that they never block the loop.
+    So do the calls of the pipeline itself which may block: the single flight, the response cache (both may call the
+    state store), the context sync queue and, with hedging enabled, the whole CAI call (the hedger is synchronous).
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.sync_handler_executor: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=ONDEWO_BPI_ASYNC_SYNC_HANDLER_MAX_WORKERS,
+            thread_name_prefix="bpi_sync_handler",
+        )
+        # set by the AsyncBpiServer once the event loop is running, otherwise the nlu-client is used in the executor
+        self.async_sessions_stub: Optional[SessionsStub] = None
+
+    async def _call_handler(self, handler: Callable, *args: Any) -> Any:
+        """Await a coroutine handler or run a synchronous handler in the executor"""
+        if inspect.iscoroutinefunction(handler):
+            return await handler(*args)
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        # the copied context lets synchronous handlers see the deadline of the call, see ondewo_bpi.deadline
+        result: Any = await loop.run_in_executor(
+            self.sync_handler_executor, contextvars.copy_context().run, handler, *args,
+        )
+        if inspect.isawaitable(result):
+            # e.g. coroutine functions wrapped by decorators which hide the coroutine flag
+            result = await result
+        return result
+
+    async def _run_blocking(self, function: Callable, *args: Any, **kwargs: Any) -> Any:
+        """run a synchronous call which may block (state store, full queues) in the executor, not on the loop"""
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.sync_handler_executor, partial(contextvars.copy_context().run, function, *args, **kwargs),
+        )
+
+    async def _call_intent_handler(
+        self,
+        handler: Callable,
+        intent_name: str,
+        response: session_pb2.DetectIntentResponse,
+    ) -> session_pb2.DetectIntentResponse:
+        """call the intent handler like `_call_handler` and record its duration, also if it raises"""
+        started_at: float = time.perf_counter()
+        try:
+            handled_response: session_pb2.DetectIntentResponse = await self._call_handler(handler, response, self.client)
+            return handled_response
+        finally:
+            observe_intent_handler(handler=handler, intent_name=intent_name, started_at=started_at)
+
+    async def DetectIntent(  # type: ignore[override]
+        self,
+        request: session_pb2.DetectIntentRequest,
+        context: grpc.aio.ServicerContext,
+    ) -> session_pb2.DetectIntentResponse:
+        if self.single_flight is None:
+            return await self._detect_intent_async(request=request, context=context)
+
+        key: bytes = get_request_fingerprint(request)
+        flight, is_leader = await self._run_blocking(self.single_flight.join, key=key, context=context)
+        if not is_leader:
+            return await self._wait_for_flight_async(flight=flight, context=context)
+        try:
+            response: session_pb2.DetectIntentResponse = await self._detect_intent_async(
+                request=request,
+                context=context,
+                flight=flight,
+            )
+        except BaseException as e:
+            self.single_flight.fail(key=key, flight=flight, error=e)
+            raise
+        await self._run_blocking(self.single_flight.succeed, key=key, flight=flight, response=response)
+        return response
+
+    @staticmethod
+    async def _wait_for_flight_async(
+        flight: Flight,
+        context: grpc.aio.ServicerContext,
+    ) -> session_pb2.DetectIntentResponse:
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(flight.future)),
+                timeout=get_context_time_remaining(context),
+            )
+        except asyncio.TimeoutError:
+            await context.abort(grpc.StatusCode.DEADLINE_EXCEEDED, "the identical request did not finish in time")
+        except grpc.RpcError as e:
+            await context.abort(e.code(), e.details())  # type: ignore[attr-defined]
+        return flight.get_response()
+
+    async def _detect_intent_async(
+        self,
+        request: session_pb2.DetectIntentRequest,
+        context: grpc.aio.ServicerContext,
+        flight: Optional[Flight] = None,
+    ) -> session_pb2.DetectIntentResponse:
+        with request_budget(flight or context), instrumented_request():
+            started_at: float = time.perf_counter()
+            self._truncate_request_text(request)
+            observe_stage(stage="truncate_request", started_at=started_at)
+            cai_response: session_pb2.DetectIntentResponse = await self.perform_detect_intent_async(request)
+            intent_name: str = cai_response.query_result.intent.display_name
+            self.context_mirror.update_from_response(session_name=request.session, response=cai_response)
+            output_contexts_cai_response_dict: Dict[str, Tuple[bytes, context_pb2.Context]] = \
+                self._get_output_contexts_dict(cai_response)
+            self._log_cai_response(cai_response)
+            PAYLOAD_LOG.log(session_name=request.session, stage="cai_response", payload=cai_response)
+            abandoned_status: Optional[grpc.StatusCode] = self._get_abandoned_status(stage="process_messages")
+            if abandoned_status is not None:
+                await context.abort(abandoned_status, "the caller has abandoned the call")
+            with self._session_state_turn(
+                session_name=request.session, cai_response=cai_response, flush=False,
+            ) as session_state:
+                try:
+                    started_at = time.perf_counter()
+                    cai_response = await self.process_messages_async(cai_response)
+                    observe_stage(stage="process_messages", started_at=started_at, intent_name=intent_name)
+                    started_at = time.perf_counter()
+                    processed_cai_response: session_pb2.DetectIntentResponse = \
+                        await self.process_intent_handler_async(cai_response)
+                    observe_stage(stage="intent_handlers", started_at=started_at, intent_name=intent_name)
+                finally:
+                    if session_state is not None:
+                        await asyncio.get_running_loop().run_in_executor(
+                            self.sync_handler_executor, session_state.flush,
+                        )
+            started_at = time.perf_counter()
+            await self._run_blocking(
+                self._start_context_update,
+                output_contexts_cai_response_dict=output_contexts_cai_response_dict,
+                processed_cai_response=processed_cai_response,
+                session_name=request.session,
+            )
+            abandoned_status = self._get_abandoned_status(stage="returning the response")
+            if abandoned_status is not None:
+                await context.abort(abandoned_status, "the caller has abandoned the call")
+            observe_stage(stage="return_response", started_at=started_at, intent_name=intent_name)
+        PAYLOAD_LOG.log(session_name=request.session, stage="response", payload=processed_cai_response)
+        return processed_cai_response
+
+    async def perform_detect_intent_async(
+        self,
+        request: session_pb2.DetectIntentRequest,
+    ) -> session_pb2.DetectIntentResponse:
+        lazy_log.debug(lambda: f'START: AsyncBpiSessionsServices: perform_detect_intent_async: request: \n{request}')
+        for hook in self.pre_detect_intent_hooks:
+            local_response: Optional[session_pb2.DetectIntentResponse] = await self._call_handler(hook, request)
+            if local_response is not None:
+                return self._answer_locally(request=request, response=local_response)
+        response: session_pb2.DetectIntentResponse
+        if self.async_sessions_stub is not None and self.detect_intent_hedger is None:
+            cached: Tuple[Optional[ResponseCacheKey], Optional[session_pb2.DetectIntentResponse]] = \
+                await self._run_blocking(self._get_cached_response, request)
+            cache_key, cached_response = cached
+            if cached_response is not None:
+                return cached_response
+            started_at: float = time.perf_counter()
+            response = await self.async_sessions_stub.DetectIntent(
+                request,
+                metadata=self.client.services.sessions.metadata,
+                timeout=time_remaining(),
+            )
+            observe_stage(
+                stage="cai_detect_intent", started_at=started_at, intent_name=response.query_result.intent.display_name,
+            )
+            await self._run_blocking(self._cache_response, cache_key=cache_key, response=response)
+        else:
+            # the copied context carries the deadline of the call into the executor thread
+            response = await self._run_blocking(self._detect_intent_with_cai, request)
+        lazy_log.debug(
+            lambda: f'DONE: AsyncBpiSessionsServices: perform_detect_intent_async: response: \n{response}'
+        )
+        return response
+
+    async def process_messages_async(
+        self,
+        response: session_pb2.DetectIntentResponse,
+    ) -> session_pb2.DetectIntentResponse:
+        for j, message in enumerate(response.query_result.fulfillment_messages):
+            if is_abandoned():
+                return response
+            found_triggers: Dict[str, List[str]] = MessageHandler.get_triggers(
+                message, get_session_from_response(response), trigger_scanner=self.trigger_scanner,
+            )
+
+            for found_trigger in found_triggers:
+                new_response: Optional[session_pb2.DetectIntentResponse] = await self._call_handler(
+                    self.trigger_handlers[found_trigger], response, message, found_trigger, found_triggers,
+                )
+
+                if new_response:
+                    if not new_response.response_id == response.response_id:
+                        return new_response
+
+            await self.quicksend_async(response, message, j)
+        if not len(response.query_result.fulfillment_messages):
+            await self.quicksend_async(response, None, 0)
+
+        return response
+
+    async def quicksend_async(
+        self,
+        response: session_pb2.DetectIntentResponse,
+        message: Optional[intent_pb2.Intent.Message],
+        count: int,
+    ) -> None:
+        if self.quicksend_dispatcher is None:
+            await self._call_handler(self.quicksend_to_api, response, message, count)
+            return
+        if inspect.iscoroutinefunction(self.quicksend_to_api) and not isinstance(self.quicksend_dispatcher.send, partial):
+            # the dispatcher threads hand the coroutines back to the event loop of the server
+            self.quicksend_dispatcher.send = partial(self._send_on_loop, asyncio.get_running_loop())
+        # never wait for space in the queue on the event loop
+        self.quicksend_dispatcher.submit(
+            session_name=get_session_from_response(response), response=response, message=message, count=count,
+            timeout=0,
+        )
+
+    def _send_on_loop(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        response: session_pb2.DetectIntentResponse,
+        message: Optional[intent_pb2.Intent.Message],
+        count: int,
+    ) -> None:
+        asyncio.run_coroutine_threadsafe(self.quicksend_to_api(response, message, count), loop).result()
+
+    async def process_intent_handler_async(
+        self,
+        cai_response: session_pb2.DetectIntentResponse,
+    ) -> session_pb2.DetectIntentResponse:
+        intent_name: str = cai_response.query_result.intent.display_name
+        for stage in self._get_handler_stages_for_intent(intent_name=intent_name):
+            if is_abandoned():
+                break
+            if len(stage) == 1:
+                cai_response = await self._call_intent_handler(stage[0], intent_name, cai_response)
+            else:
+                response_copies: List[session_pb2.DetectIntentResponse] = []
+                for _ in stage:
+                    response_copies.append(session_pb2.DetectIntentResponse())
+                    response_copies[-1].CopyFrom(cai_response)
+                handler_responses: List[session_pb2.DetectIntentResponse] = await asyncio.gather(*[
+                    self._call_intent_handler(handler, intent_name, response_copy)
+                    for handler, response_copy in zip(stage, response_copies)
+                ])
+                cai_response = merge_handler_responses(cai_response, handler_responses)
+            text: List[Any] = [i.text.text for i in cai_response.query_result.fulfillment_messages]
+            log.info(
+                {
+                    "message": f"BPI-DetectIntentResponse from BPI with text: {text}",
+                    "content": text,
+                    "text": text,
+                    "tags": ["text", "clean"],
+                }
+            )
+        return cai_response
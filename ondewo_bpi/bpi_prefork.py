@@ -0,0 +1,192 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import multiprocessing
+import os
+import signal
+import time
+from multiprocessing.process import BaseProcess
+from types import FrameType
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Optional,
+)
+
+from ondewo.logging.decorators import Timer
+from ondewo.logging.logger import logger_console as log
+
+from ondewo_bpi.bpi_server import BpiServer
+from ondewo_bpi.config import (
+    ONDEWO_BPI_PORT,
+    ONDEWO_BPI_PREFORK_MAX_RAPID_FAILURES,
+    ONDEWO_BPI_PREFORK_RAPID_FAILURE_SECONDS,
+    ONDEWO_BPI_PREFORK_RESTART_BACKOFF_MAX_SECONDS,
+    ONDEWO_BPI_PREFORK_RESTART_BACKOFF_SECONDS,
+    ONDEWO_BPI_PREFORK_WORKERS,
+)
+
+
+def _run_worker(server_factory: Callable[[], BpiServer], worker_index: int) -> None:
+    """
+    entrypoint of a forked worker process
+
+    The server, and with it the CentralClientProvider and its grpc channels, is only built here, i.e. after the fork.
+    gRPC does not survive a fork, hence nothing grpc related may be created in the parent process.
+    """
+    os.environ["ONDEWO_BPI_PREFORK_WORKER_INDEX"] = str(worker_index)
+    server: BpiServer = server_factory()  # handler registration happens in the constructor of the server
+    server.server_options.append(("grpc.so_reuseport", 1))
+
+    def _stop(signum: int, frame: Optional[FrameType]) -> None:
+        log.info(f"BPI worker {worker_index} (pid {os.getpid()}) received signal {signum}, shutting down")
+        server.stop()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    log.info(f"BPI worker {worker_index} (pid {os.getpid()}) serving on port {ONDEWO_BPI_PORT}")
+    server.serve()
+
+
+class PreforkLauncher:
+    """
+    Serve a BPI server from several processes which all bind ONDEWO_BPI_PORT with SO_REUSEPORT
+
+    The kernel load balances the incoming connections between the workers, hence the GIL bound parts of the BPI
+    (trigger scanning, protobuf (de)serialization, handlers) scale with the number of cores.
+
+    Usage:
+        PreforkLauncher(server_factory=MyServer, num_workers=4).serve()
+
+    The server_factory is called once in every worker process after the fork. Everything that should exist per
+    worker (handler registration, nlu-client, caches) has to be set up by the factory, e.g. in the constructor of
+    the server class.
+
+    A worker which exits within rapid_failure_seconds of its start is restarted after an exponential backoff. After
+    max_rapid_failures such failures in a row (e.g. a bad config lets every worker fail on startup) the launcher stops
+    all workers and `serve` raises a RuntimeError instead of fork-looping forever.
+    """
+
+    def __init__(
+        self,
+        server_factory: Callable[[], BpiServer],
+        num_workers: int = ONDEWO_BPI_PREFORK_WORKERS,
+        restart_workers: bool = True,
+        restart_backoff_seconds: float = ONDEWO_BPI_PREFORK_RESTART_BACKOFF_SECONDS,
+        restart_backoff_max_seconds: float = ONDEWO_BPI_PREFORK_RESTART_BACKOFF_MAX_SECONDS,
+        rapid_failure_seconds: float = ONDEWO_BPI_PREFORK_RAPID_FAILURE_SECONDS,
+        max_rapid_failures: int = ONDEWO_BPI_PREFORK_MAX_RAPID_FAILURES,
+        poll_interval_seconds: float = 1.0,
+    ) -> None:
+        self.server_factory: Callable[[], BpiServer] = server_factory
+        self.num_workers: int = num_workers if num_workers > 0 else (os.cpu_count() or 1)
+        self.restart_workers: bool = restart_workers
+        self.restart_backoff_seconds: float = restart_backoff_seconds
+        self.restart_backoff_max_seconds: float = restart_backoff_max_seconds
+        self.rapid_failure_seconds: float = rapid_failure_seconds
+        self.max_rapid_failures: int = max_rapid_failures
+        self.poll_interval_seconds: float = poll_interval_seconds
+        self.workers: Dict[int, BaseProcess] = {}
+        self.should_run: bool = True
+        # worker index -> monotonic time of its start, of its restart if it is waiting for one
+        self._started_at: Dict[int, float] = {}
+        self._restart_at: Dict[int, float] = {}
+        # worker index -> number of rapid failures in a row
+        self._rapid_failures: Dict[int, int] = {}
+        self.crash_looping_worker: Optional[int] = None
+        self._context = multiprocessing.get_context("fork")
+
+    def _start_worker(self, worker_index: int) -> None:
+        process: BaseProcess = self._context.Process(  # type: ignore
+            target=_run_worker,
+            args=(self.server_factory, worker_index),
+            name=f"bpi_worker_{worker_index}",
+            daemon=False,
+        )
+        process.start()
+        self.workers[worker_index] = process
+        self._started_at[worker_index] = time.monotonic()
+        log.info(f"started BPI worker {worker_index} with pid {process.pid}")
+
+    def _on_worker_exit(self, worker_index: int, process: BaseProcess) -> None:
+        log.warning(f"BPI worker {worker_index} (pid {process.pid}) exited with code {process.exitcode}")
+        self.workers.pop(worker_index)
+        if not self.restart_workers:
+            return
+        now: float = time.monotonic()
+        if now - self._started_at[worker_index] >= self.rapid_failure_seconds:
+            self._rapid_failures[worker_index] = 0
+        failures: int = self._rapid_failures.get(worker_index, 0) + 1
+        self._rapid_failures[worker_index] = failures
+        if failures > self.max_rapid_failures:
+            log.error(
+                f"BPI worker {worker_index} failed {failures} times in a row within {self.rapid_failure_seconds}s "
+                f"of its start, giving up and stopping all workers"
+            )
+            self.crash_looping_worker = worker_index
+            self.stop()
+            return
+        backoff: float = min(self.restart_backoff_max_seconds, self.restart_backoff_seconds * 2 ** (failures - 1))
+        log.info(f"restarting BPI worker {worker_index} in {backoff:.1f}s")
+        self._restart_at[worker_index] = now + backoff
+
+    def _handle_signal(self, signum: int, frame: Optional[FrameType]) -> None:
+        log.info(f"BPI prefork launcher received signal {signum}, stopping {len(self.workers)} workers")
+        self.stop()
+
+    @Timer(
+        logger=log.debug, log_arguments=False,
+        message='PreforkLauncher: serve: Elapsed time: {:0.4f}'
+    )
+    def serve(self) -> None:
+        log.info(f"starting {self.num_workers} BPI worker processes on port {ONDEWO_BPI_PORT}")
+        previous_sigterm_handler: Any = signal.signal(signal.SIGTERM, self._handle_signal)
+        previous_sigint_handler: Any = signal.signal(signal.SIGINT, self._handle_signal)
+        for worker_index in range(self.num_workers):
+            self._start_worker(worker_index)
+
+        while self.should_run:
+            time.sleep(self.poll_interval_seconds)
+            for worker_index, process in list(self.workers.items()):
+                if process.is_alive() or not self.should_run:
+                    continue
+                self._on_worker_exit(worker_index=worker_index, process=process)
+            now: float = time.monotonic()
+            for worker_index, restart_at in list(self._restart_at.items()):
+                if restart_at <= now and self.should_run:
+                    del self._restart_at[worker_index]
+                    self._start_worker(worker_index)
+            if not self.workers and not self._restart_at:
+                self.should_run = False
+
+        for process in self.workers.values():
+            process.join(timeout=10)
+            if process.is_alive():
+                process.kill()
+        signal.signal(signal.SIGTERM, previous_sigterm_handler)
+        signal.signal(signal.SIGINT, previous_sigint_handler)
+        log.info("all BPI workers shut down")
+        if self.crash_looping_worker is not None:
+            raise RuntimeError(f"BPI worker {self.crash_looping_worker} keeps failing on startup")
+
+    def stop(self) -> None:
+        self.should_run = False
+        for process in self.workers.values():
+            if process.is_alive():
+                process.terminate()
+
+
+if __name__ == "__main__":
+    launcher = PreforkLauncher(server_factory=BpiServer)
+    launcher.serve()
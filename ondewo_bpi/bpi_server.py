@@ -15,8 +15,10 @@
 import time
 from concurrent import futures
 from typing import (
+    Any,
     List,
     Optional,
+    Tuple,
 )
 
 import grpc
@@ -55,7 +57,12 @@ from ondewo.nlu import (
     utility_pb2_grpc,
 )
 from ondewo.nlu.client import Client as NluClient
+from ondewo.nlu.session_pb2_grpc import SessionsStub
 
+from ondewo_bpi.admission_control import (
+    AdmissionControlInterceptor,
+    AimdConcurrencyLimiter,
+)
 from ondewo_bpi.bpi_services import (
     BpiAgentsServices,
     BpiAiServicesServices,
@@ -73,8 +80,35 @@ from ondewo_bpi.bpi_services import (
 )
 from ondewo_bpi.config import (
     CentralClientProvider,
+    ONDEWO_BPI_ADAPTIVE_CONCURRENCY,
+    ONDEWO_BPI_ADAPTIVE_CONCURRENCY_LATENCY_SECONDS,
+    ONDEWO_BPI_ADAPTIVE_CONCURRENCY_MIN_LIMIT,
+    ONDEWO_BPI_CAI_HOST,
+    ONDEWO_BPI_CAI_PORT,
+    ONDEWO_BPI_EXECUTION_LANES,
+    ONDEWO_BPI_HEDGING_CAI_HOST,
+    ONDEWO_BPI_HEDGING_CAI_PORT,
+    ONDEWO_BPI_HEDGING_ENABLED,
     ONDEWO_BPI_HOST,
+    ONDEWO_BPI_LOG_QUEUE_ENABLED,
+    ONDEWO_BPI_MAX_QUEUE_DEPTH,
+    ONDEWO_BPI_MAX_WORKERS,
+    ONDEWO_BPI_MAXIMUM_CONCURRENT_RPCS,
     ONDEWO_BPI_PORT,
+    ONDEWO_BPI_RETRY_AFTER_MS,
+)
+from ondewo_bpi.deadline import (
+    install_deadline_propagation,
+    with_deadline_propagation,
+)
+from ondewo_bpi.execution_lanes import (
+    ExecutionLanesInterceptor,
+    parse_execution_lanes,
+)
+from ondewo_bpi.hedging import HedgedDetectIntent
+from ondewo_bpi.log_queue import (
+    install_log_queue,
+    uninstall_log_queue,
 )
 
 
@@ -108,9 +142,9 @@ class BpiServer(
     def __init__(self, client_provider: Optional[CentralClientProvider] = None) -> None:
         super().__init__()
         if not client_provider:
-            self.client = CentralClientProvider().get_client()
-        else:
-            self.client = client_provider.get_client()
+            client_provider = CentralClientProvider()
+        # CAI calls get the remaining time of the incoming call as timeout, see ondewo_bpi.deadline
+        self.client = install_deadline_propagation(client_provider.get_client())
         self.server = None
         self.services_descriptors: List[str] = [
             agent_pb2.DESCRIPTOR.services_by_name['Agents'].full_name,
@@ -127,9 +161,94 @@ class BpiServer(
             user_pb2.DESCRIPTOR.services_by_name['Users'].full_name,
             utility_pb2.DESCRIPTOR.services_by_name['Utilities'].full_name,
         ]
+        # additional grpc server options (channel arguments), e.g. ("grpc.so_reuseport", 1)
+        self.server_options: List[Tuple[str, Any]] = []
+        self.max_workers: int = ONDEWO_BPI_MAX_WORKERS
+        self.maximum_concurrent_rpcs: Optional[int] = self._get_maximum_concurrent_rpcs()
+        self.interceptors: List[grpc.ServerInterceptor] = []
+        self.admission_control: Optional[AdmissionControlInterceptor] = self._create_admission_control()
+        if self.admission_control is not None:
+            self.interceptors.append(self.admission_control)
+        self.execution_lanes: ExecutionLanesInterceptor = ExecutionLanesInterceptor(
+            lanes=parse_execution_lanes(ONDEWO_BPI_EXECUTION_LANES),
+            retry_after_ms=ONDEWO_BPI_RETRY_AFTER_MS,
+        )
+        if self.execution_lanes.lanes:
+            self.execution_lanes.check_capacity(max_workers=self.max_workers)
+            self.interceptors.append(self.execution_lanes)
+        if ONDEWO_BPI_HEDGING_ENABLED:
+            self.detect_intent_hedger = self._create_detect_intent_hedger(client_provider)
+        # write the logs of the serving process from a background thread, see ondewo_bpi.log_queue
+        self.log_queue_enabled: bool = ONDEWO_BPI_LOG_QUEUE_ENABLED
         self.server_is_running: bool = False
         self.server_should_run: bool = True
 
+    def _create_detect_intent_hedger(self, client_provider: CentralClientProvider) -> HedgedDetectIntent:
+        hedge_target: Optional[str] = None
+        if ONDEWO_BPI_HEDGING_CAI_HOST or ONDEWO_BPI_HEDGING_CAI_PORT:
+            hedge_target = f"{ONDEWO_BPI_HEDGING_CAI_HOST or ONDEWO_BPI_CAI_HOST}:" \
+                           f"{ONDEWO_BPI_HEDGING_CAI_PORT or ONDEWO_BPI_CAI_PORT}"
+        log.info(f"hedging DetectIntent requests to {hedge_target or 'a second connection to CAI'}")
+        return HedgedDetectIntent(
+            primary_stub=self.client.services.sessions.stub,
+            hedge_stub=SessionsStub(
+                channel=with_deadline_propagation(client_provider.get_separate_channel(target=hedge_target)),
+            ),
+            metadata=self.client.services.sessions.metadata,
+        )
+
+    @staticmethod
+    def _get_maximum_concurrent_rpcs() -> Optional[int]:
+        """
+        calls beyond this limit are rejected by grpc with RESOURCE_EXHAUSTED before they reach the worker queue
+
+        Returns:
+            ONDEWO_BPI_MAXIMUM_CONCURRENT_RPCS if set, else max workers + max queue depth if a queue depth is set,
+            else None (unbounded)
+        """
+        if ONDEWO_BPI_MAXIMUM_CONCURRENT_RPCS > 0:
+            return ONDEWO_BPI_MAXIMUM_CONCURRENT_RPCS
+        if ONDEWO_BPI_MAX_QUEUE_DEPTH > 0:
+            return ONDEWO_BPI_MAX_WORKERS + ONDEWO_BPI_MAX_QUEUE_DEPTH
+        return None
+
+    def _create_admission_control(self) -> Optional[AdmissionControlInterceptor]:
+        """
+        the interceptor which sheds load with RESOURCE_EXHAUSTED and a retry-after-ms hint
+
+        With ONDEWO_BPI_ADAPTIVE_CONCURRENCY the limit adapts to the DetectIntent latency (AIMD), otherwise the bound
+        of `_get_maximum_concurrent_rpcs` is a fixed limit. None if neither is configured, i.e. nothing is shed.
+        """
+        if ONDEWO_BPI_ADAPTIVE_CONCURRENCY:
+            max_limit: int = self.maximum_concurrent_rpcs or self.max_workers
+            limiter: AimdConcurrencyLimiter = AimdConcurrencyLimiter(
+                initial_limit=min(self.max_workers, max_limit),
+                min_limit=min(ONDEWO_BPI_ADAPTIVE_CONCURRENCY_MIN_LIMIT, max_limit),
+                max_limit=max_limit,
+                latency_threshold_seconds=ONDEWO_BPI_ADAPTIVE_CONCURRENCY_LATENCY_SECONDS,
+            )
+        elif self.maximum_concurrent_rpcs is not None:
+            limiter = AimdConcurrencyLimiter(  # min == max, the limit never changes
+                initial_limit=self.maximum_concurrent_rpcs,
+                min_limit=self.maximum_concurrent_rpcs,
+                max_limit=self.maximum_concurrent_rpcs,
+                latency_threshold_seconds=ONDEWO_BPI_ADAPTIVE_CONCURRENCY_LATENCY_SECONDS,
+            )
+        else:
+            return None
+        return AdmissionControlInterceptor(limiter=limiter, retry_after_ms=ONDEWO_BPI_RETRY_AFTER_MS)
+
+    def _get_grpc_maximum_concurrent_rpcs(self) -> Optional[int]:
+        """
+        the hard limit of grpc itself, whose rejections carry no retry-after hint
+
+        Calls rejected by the admission control still run (the abort) on a server worker, hence grpc only rejects beyond
+        the limit of the admission control plus one rejection per worker.
+        """
+        if self.maximum_concurrent_rpcs is None or self.admission_control is None:
+            return self.maximum_concurrent_rpcs
+        return self.maximum_concurrent_rpcs + self.max_workers
+
     @Timer(
         logger=log.debug, log_arguments=False,
         message='BpiServer: _setup_reflection: Elapsed time: {:0.4f}'
@@ -137,6 +256,14 @@ class BpiServer(
     def _setup_reflection(self) -> None:
         reflection.enable_server_reflection(service_names=self.services_descriptors, server=self.server)
 
+    def _start_log_queue(self) -> None:
+        if self.log_queue_enabled:
+            install_log_queue()
+
+    def _stop_log_queue(self) -> None:
+        if self.log_queue_enabled:
+            uninstall_log_queue()
+
     @Timer(
         logger=log.debug, log_arguments=False,
         message='BpiServer: _add_services: Elapsed time: {:0.4f}'
@@ -162,7 +289,12 @@ class BpiServer(
     )
     def _setup_server(self) -> None:
         logger.info("attempting to setup server...")
-        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=100))
+        self.server = grpc.server(
+            futures.ThreadPoolExecutor(max_workers=self.max_workers),
+            options=self.server_options,
+            interceptors=self.interceptors,
+            maximum_concurrent_rpcs=self._get_grpc_maximum_concurrent_rpcs(),
+        )
         self._add_services()
         self._setup_reflection()
         if ONDEWO_BPI_HOST:
@@ -179,23 +311,32 @@ class BpiServer(
         message='BpiServer: serve: Elapsed time: {:0.4f}'
     )
     def serve(self) -> None:
-        log.info(f"attempting to start server on port {ONDEWO_BPI_PORT}")
-        self._setup_server()
-        log.info({"message": f"Server started on port {ONDEWO_BPI_PORT}", "content": ONDEWO_BPI_PORT})
-        log.info(
-            {
-                "message": f"using intent handlers list: {self.intent_handlers}",
-                "content": self.intent_handlers,
-            }
-        )
+        self._start_log_queue()
         try:
-            self.server_is_running = True
-            while self.server_should_run:
-                time.sleep(3)
-        except KeyboardInterrupt:
-            self.server_is_running = False
-            log.info("Keyboard interrupt, shutting down")
-        log.info({"message": "server shut down", "tags": ["timing"]})
+            log.info(f"attempting to start server on port {ONDEWO_BPI_PORT}")
+            self._setup_server()
+            log.info({"message": f"Server started on port {ONDEWO_BPI_PORT}", "content": ONDEWO_BPI_PORT})
+            self.freeze_intent_handlers()
+            log.info(
+                {
+                    "message": f"using intent handlers list: {self.intent_handlers}",
+                    "content": self.intent_handlers,
+                }
+            )
+            try:
+                self.server_is_running = True
+                while self.server_should_run:
+                    time.sleep(3)
+            except KeyboardInterrupt:
+                self.server_is_running = False
+                log.info("Keyboard interrupt, shutting down")
+            self.context_sync.stop()
+            if self.quicksend_dispatcher:
+                self.quicksend_dispatcher.stop()
+            log.info({"message": "server shut down", "tags": ["timing"]})
+        finally:
+            # also if the server failed: give the loggers their handlers back and write the queued records
+            self._stop_log_queue()
 
     @Timer(
         logger=log.debug, log_arguments=False,
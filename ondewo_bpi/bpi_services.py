@@ -15,26 +15,29 @@ from abc import (
     ABCMeta,
     abstractmethod,
 )
-from concurrent.futures import ThreadPoolExecutor
-from dataclasses import (
-    dataclass,
-    field,
+from contextlib import nullcontext
+import contextvars
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
 )
-from datetime import datetime
-from threading import Thread
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from hashlib import blake2b
+import time
 from typing import (
     Callable,
+    ContextManager,
     Dict,
+    Iterator,
     List,
     Optional,
-    Set,
+    Sequence,
     Tuple,
 )
 
 import grpc
 import regex as re
-from google.protobuf.json_format import MessageToJson
-from ondewo.logging.decorators import Timer
+from google.protobuf.empty_pb2 import Empty
 from ondewo.logging.logger import logger_console as log
 from ondewo.nlu import (
     context_pb2,
@@ -43,10 +46,6 @@ from ondewo.nlu import (
     user_pb2,
 )
 from ondewo.nlu.client import Client as NluClient
-from ondewo.nlu.context_pb2 import (
-    ListContextsRequest,
-    ListContextsResponse,
-)
 from ondewo.nlu.session_pb2 import TextInput
 
 from ondewo_bpi.autocoded.agent_grpc_autocode import AutoAgentsServicer
@@ -62,35 +61,95 @@ from ondewo_bpi.autocoded.server_statistics_grpc_autocode import AutoServerStati
 from ondewo_bpi.autocoded.session_grpc_autocode import AutoSessionsServicer
 from ondewo_bpi.autocoded.user_grpc_autocode import AutoUsersServicer
 from ondewo_bpi.autocoded.utility_grpc_autocode import AutoUtilitiesServicer
-from ondewo_bpi.config import ONDEWO_BPI_SENTENCE_TRUNCATION
+from ondewo_bpi.config import (
+    ONDEWO_BPI_INTENT_HANDLER_MAX_WORKERS,
+    ONDEWO_BPI_QUICKSEND_ASYNC,
+    ONDEWO_BPI_RESPONSE_CACHE_ENABLED,
+    ONDEWO_BPI_SENTENCE_TRUNCATION,
+    ONDEWO_BPI_SESSION_STATE_CACHE_ENABLED,
+    ONDEWO_BPI_SINGLE_FLIGHT_ENABLED,
+)
 from ondewo_bpi.constants import (
     QueryTriggers,
     SipTriggers,
 )
-from ondewo_bpi.helpers import (
-    clear_created_modified,
-    get_session_from_response,
+from ondewo_bpi.context_mirror import (
+    SESSION_CONTEXT_MIRROR,
+    SessionContextMirror,
+)
+from ondewo_bpi.context_sync import ContextSyncWorker
+from ondewo_bpi.deadline import (
+    get_context_time_remaining,
+    is_abandoned,
+    request_budget,
+    time_remaining,
+)
+from ondewo_bpi.handler_resilience import (
+    HandlerPolicy,
+    with_policy,
+)
+from ondewo_bpi.hedging import HedgedDetectIntent
+from ondewo_bpi.helpers import get_session_from_response
+from ondewo_bpi.instrumentation import (
+    instrumented,
+    instrumented_request,
+)
+from ondewo_bpi.intent_dispatch import (  # noqa: F401, IntentCallbackAssignor is imported from here by users
+    IntentCallbackAssignor,
+    IntentDispatchIndex,
+)
+from ondewo_bpi.lazy_logging import (
+    PAYLOAD_LOG,
+    lazy_log,
 )
 from ondewo_bpi.message_handler import (
     MessageHandler,
 )
+from ondewo_bpi.metrics import BPI_METRICS
+from ondewo_bpi.pre_detect_intent import PreDetectIntentHook
+from ondewo_bpi.quicksend_dispatcher import QuicksendDispatcher
+from ondewo_bpi.response_cache import (
+    ResponseCache,
+    ResponseCacheKey,
+    is_context_preserving,
+)
+from ondewo_bpi.response_merge import merge_changes
+from ondewo_bpi.session_state_cache import (
+    SESSION_STATE_CACHE,
+    SessionStateCache,
+    SessionStateTurn,
+    session_state_turn,
+)
+from ondewo_bpi.session_steps import (
+    SessionStepTracker,
+    adapt_local_response,
+)
+from ondewo_bpi.single_flight import (
+    Flight,
+    SingleFlight,
+    get_request_fingerprint,
+)
+from ondewo_bpi.stage_timing import (
+    call_intent_handler,
+    observe_stage,
+)
+from ondewo_bpi.state_store import (
+    StateStore,
+    create_state_store,
+)
+from ondewo_bpi.trigger_scanner import TriggerScanner
 
 
-@dataclass()
-class IntentCallbackAssignor:
-    """Class for keeping track of the intents and their handlers"""
-    sort_index: int = field(init=False, repr=False)
-    intent_pattern: str
-    handlers: List[Callable]
-
-    def __gt__(self, other: 'IntentCallbackAssignor') -> bool:
-        return self.sort_index > other.sort_index
-
-    def __lt__(self, other: 'IntentCallbackAssignor') -> bool:
-        return self.sort_index < other.sort_index
-
-    def __post_init__(self):
-        object.__setattr__(self, 'sort_index', len(self.intent_pattern))
+def merge_handler_responses(
+    base: session_pb2.DetectIntentResponse,
+    handler_responses: List[session_pb2.DetectIntentResponse],
+) -> session_pb2.DetectIntentResponse:
+    """merge the changes which concurrent handlers made to their copies of `base`, later handlers win conflicts"""
+    merged: session_pb2.DetectIntentResponse = session_pb2.DetectIntentResponse()
+    merged.CopyFrom(base)
+    for handler_response in handler_responses:
+        merge_changes(target=merged, base=base, changed=handler_response)
+    return merged
 
 
 class BpiSessionsServices(AutoSessionsServicer):
@@ -101,36 +160,128 @@ class BpiSessionsServices(AutoSessionsServicer):
     def client(self) -> NluClient:
         pass
 
-    @Timer(
+    @instrumented(
         logger=log.debug, log_arguments=False,
         message='BpiSessionsServices: __init__: Elapsed time: {:0.4f}'
     )
     def __init__(self) -> None:
         self.intent_handlers: List[IntentCallbackAssignor] = list()
+        # built from intent_handlers on the first dispatch or by freeze_intent_handlers
+        self.intent_dispatch_index: Optional[IntentDispatchIndex] = None
+        # runs the independent intent handlers of a stage concurrently, see IntentCallbackAssignor
+        self.intent_handler_executor: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=ONDEWO_BPI_INTENT_HANDLER_MAX_WORKERS,
+            thread_name_prefix="bpi_intent_handler",
+        )
         self.trigger_handlers: Dict[str, Callable] = {
             i.value: self.trigger_function_not_implemented for i in [*SipTriggers, *QueryTriggers]
         }
+        # finds the triggers of trigger_handlers in the fulfillment messages, see register_trigger_handler
+        self.trigger_scanner: TriggerScanner = TriggerScanner(patterns=list(self.trigger_handlers))
+        self.context_mirror: SessionContextMirror = SESSION_CONTEXT_MIRROR
+        self.context_sync: ContextSyncWorker = ContextSyncWorker(
+            client_provider=lambda: self.client,
+            context_mirror=self.context_mirror,
+        )
+        # set by the server if ONDEWO_BPI_HEDGING_ENABLED
+        self.detect_intent_hedger: Optional[HedgedDetectIntent] = None
+        # shared by the replicas if ONDEWO_BPI_STATE_STORE_URL is set
+        self.state_store: Optional[StateStore] = create_state_store()
+        self.response_cache: Optional[ResponseCache] = ResponseCache(
+            state_store=self.state_store,
+        ) if ONDEWO_BPI_RESPONSE_CACHE_ENABLED else None
+        self.single_flight: Optional[SingleFlight] = SingleFlight(
+            state_store=self.state_store,
+        ) if ONDEWO_BPI_SINGLE_FLIGHT_ENABLED else None
+        self.session_state_cache: Optional[SessionStateCache] = \
+            SESSION_STATE_CACHE if ONDEWO_BPI_SESSION_STATE_CACHE_ENABLED else None
+        # called with the request before CAI, the first one returning a response answers the turn
+        self.pre_detect_intent_hooks: List[PreDetectIntentHook] = []
+        self.session_step_tracker: SessionStepTracker = SessionStepTracker(
+            errors_metric="pre_detect_intent_track_session_step_errors_total",
+            dropped_metric="pre_detect_intent_track_session_step_dropped_total",
+        )
+        self.quicksend_dispatcher: Optional[QuicksendDispatcher] = QuicksendDispatcher(
+            send=self.quicksend_to_api,
+        ) if ONDEWO_BPI_QUICKSEND_ASYNC else None
 
-    @Timer(
+    @instrumented(
         logger=log.debug, log_arguments=True,
         message='BpiSessionsServices: register_intent_handler: Elapsed time: {:0.4f}'
     )
-    def register_intent_handler(self, intent_pattern: str, handlers: List[Callable]) -> None:
+    def register_intent_handler(
+        self,
+        intent_pattern: str,
+        handlers: List[Callable],
+        independent: bool = False,
+        dependencies: Optional[Dict[Callable, Sequence[Callable]]] = None,
+        policy: Optional[HandlerPolicy] = None,
+    ) -> None:
+        """
+        Args:
+            intent_pattern: regex matched against the intent display name
+            handlers: called with (response, client), each returns the (changed) response
+            independent: the handlers do not need the results of each other and may run concurrently
+            dependencies: handler -> handlers whose results it needs; all other handlers may run concurrently
+            policy: timeout, bulkhead and circuit breaker applied to each of the handlers, see with_policy
+        """
+        if policy is not None:
+            guarded_handlers: Dict[Callable, Callable] = {
+                handler: with_policy(handler=handler, policy=policy) for handler in handlers
+            }
+            handlers = [guarded_handlers[handler] for handler in handlers]
+            if dependencies is not None:
+                dependencies = {
+                    guarded_handlers.get(handler, handler): [
+                        guarded_handlers.get(prerequisite, prerequisite) for prerequisite in prerequisites
+                    ]
+                    for handler, prerequisites in dependencies.items()
+                }
         intent_handler: IntentCallbackAssignor = IntentCallbackAssignor(
             intent_pattern=intent_pattern,
             handlers=handlers,
+            independent=independent,
+            dependencies=dependencies,
         )
-        self.intent_handlers.append(intent_handler)
-        self.intent_handlers = sorted(self.intent_handlers, reverse=True)
-
-    @Timer(
+        # keep the list ordered by descending pattern length, equal lengths in the order of registration
+        position: int = len(self.intent_handlers)
+        while position > 0 and self.intent_handlers[position - 1] < intent_handler:
+            position -= 1
+        self.intent_handlers.insert(position, intent_handler)
+        if self.intent_dispatch_index is not None:
+            log.warning(f"intent handler for {intent_pattern} registered after the dispatch index was frozen")
+            self.intent_dispatch_index = None
+
+    def register_pre_detect_intent_hook(self, hook: PreDetectIntentHook) -> None:
+        """
+        Register a hook which may answer a DetectIntent request without calling CAI, e.g. for keep-alive events
+
+        The hook is called with the request and returns None to let CAI answer it, or the response of the turn. The
+        response is processed by the trigger and intent handlers like a response of CAI and the turn is recorded in
+        the session of CAI in the background. Hooks are called in the order of registration.
+        """
+        self.pre_detect_intent_hooks.append(hook)
+
+    def freeze_intent_handlers(self) -> IntentDispatchIndex:
+        """build the dispatch index of the registered intent handlers, called by the server before serving"""
+        self.intent_dispatch_index = IntentDispatchIndex(assignors=self.intent_handlers)
+        return self.intent_dispatch_index
+
+    @instrumented(
         logger=log.debug, log_arguments=False,
         message='BpiSessionsServices: register_trigger_handler: Elapsed time: {:0.4f}'
     )
-    def register_trigger_handler(self, trigger: str, handler: Callable) -> None:
-        self.trigger_handlers[trigger] = handler
-
-    @Timer(
+    def register_trigger_handler(self, trigger: str, handler: Callable, policy: Optional[HandlerPolicy] = None) -> None:
+        """
+        Args:
+            trigger: the trigger pattern, e.g. a SipTriggers value or an own pattern like "<MY:TRIGGER=(.*?)>" whose
+                first group is the argument of the trigger
+            policy: timeout, bulkhead and circuit breaker of the handler, see with_policy
+        """
+        self.trigger_scanner.register(trigger)
+        self.trigger_handlers[trigger] = handler if policy is None else with_policy(handler=handler, policy=policy)
+
+    @instrumented(
         logger=log.debug, log_arguments=True,
         message='BpiSessionsServices: trigger_function_not_implemented: Elapsed time: {:0.4f}'
     )
@@ -149,7 +300,7 @@ class BpiSessionsServices(AutoSessionsServicer):
             }
         )
 
-    @Timer(
+    @instrumented(
         logger=log.debug, log_arguments=True,
         message='BpiSessionsServices: DetectIntent: Elapsed time: {:0.4f}'
     )
@@ -158,17 +309,186 @@ class BpiSessionsServices(AutoSessionsServicer):
         request: session_pb2.DetectIntentRequest,
         context: grpc.ServicerContext,
     ) -> session_pb2.DetectIntentResponse:
+        if self.single_flight is None:
+            return self._detect_intent(request=request, context=context)
+
+        key: bytes = get_request_fingerprint(request)
+        flight, is_leader = self.single_flight.join(key=key, context=context)
+        if not is_leader:
+            return self._wait_for_flight(flight=flight, context=context)
+        try:
+            response: session_pb2.DetectIntentResponse = self._detect_intent(
+                request=request,
+                context=context,
+                flight=flight,
+            )
+        except BaseException as e:
+            self.single_flight.fail(key=key, flight=flight, error=e)
+            raise
+        self.single_flight.succeed(key=key, flight=flight, response=response)
+        return response
+
+    def _process_cai_response(
+        self,
+        session_name: str,
+        cai_response: session_pb2.DetectIntentResponse,
+        context: grpc.ServicerContext,
+    ) -> session_pb2.DetectIntentResponse:
+        """run the triggers and intent handlers on the response of CAI and queue the changed contexts"""
+        self.context_mirror.update_from_response(session_name=session_name, response=cai_response)
+        output_contexts_cai_response_dict: Dict[str, Tuple[bytes, context_pb2.Context]] = \
+            self._get_output_contexts_dict(cai_response)
+        self._log_cai_response(cai_response)
+        PAYLOAD_LOG.log(session_name=session_name, stage="cai_response", payload=cai_response)
+        abandoned_status: Optional[grpc.StatusCode] = self._get_abandoned_status(stage="process_messages")
+        if abandoned_status is not None:
+            context.abort(abandoned_status, "the caller has abandoned the call")
+        intent_name: str = cai_response.query_result.intent.display_name
+        with self._session_state_turn(session_name=session_name, cai_response=cai_response):
+            started_at: float = time.perf_counter()
+            cai_response = self.process_messages(cai_response)
+            observe_stage(stage="process_messages", started_at=started_at, intent_name=intent_name)
+            started_at = time.perf_counter()
+            processed_cai_response: session_pb2.DetectIntentResponse = self.process_intent_handler(cai_response)
+            observe_stage(stage="intent_handlers", started_at=started_at, intent_name=intent_name)
+        started_at = time.perf_counter()
+        # the contexts changed by the handlers which did run are written back even for an abandoned call
+        self._start_context_update(
+            output_contexts_cai_response_dict=output_contexts_cai_response_dict,
+            processed_cai_response=processed_cai_response,
+            session_name=session_name,
+        )
+        abandoned_status = self._get_abandoned_status(stage="returning the response")
+        if abandoned_status is not None:
+            context.abort(abandoned_status, "the caller has abandoned the call")
+        observe_stage(stage="return_response", started_at=started_at, intent_name=intent_name)
+        PAYLOAD_LOG.log(session_name=session_name, stage="response", payload=processed_cai_response)
+        return processed_cai_response
+
+    def _session_state_turn(
+        self,
+        session_name: str,
+        cai_response: session_pb2.DetectIntentResponse,
+        flush: bool = True,
+    ) -> ContextManager[Optional[SessionStateTurn]]:
+        """
+        Returns:
+            with ONDEWO_BPI_SESSION_STATE_CACHE_ENABLED the turn collecting the context writes of the helpers, which
+            are flushed at its end (if `flush`), else a context manager doing nothing
+        """
+        if self.session_state_cache is None:
+            return nullcontext()
+        self.session_state_cache.update_from_response(session_name=session_name, response=cai_response)
+        return session_state_turn(client=self.client, cache=self.session_state_cache, flush=flush)
+
+    def StreamingDetectIntent(
+        self,
+        request_iterator: Iterator[session_pb2.StreamingDetectIntentRequest],
+        context: grpc.ServicerContext,
+    ) -> Iterator[session_pb2.StreamingDetectIntentResponse]:
+        """
+        Streams the requests to CAI and the responses back; interim recognition results are relayed unchanged, a
+        response with the final query result is run through the same processing as the response of DetectIntent.
+        """
+        session_names: List[str] = []
+
+        def forward_requests() -> Iterator[session_pb2.StreamingDetectIntentRequest]:
+            # every chunk is passed on as soon as it arrives, only the session name is kept
+            for streaming_request in request_iterator:
+                if not session_names and streaming_request.session:
+                    session_names.append(streaming_request.session)
+                yield streaming_request
+
+        # the budget is only entered around synchronous work, a generator may be closed in another thread
+        with request_budget(context):
+            streaming_responses: Iterator[session_pb2.StreamingDetectIntentResponse] = \
+                self.client.services.sessions.streaming_detect_intent(request_iterator=forward_requests())
+        for streaming_response in streaming_responses:
+            if not streaming_response.HasField("query_result"):
+                yield streaming_response
+                continue
+            cai_response: session_pb2.DetectIntentResponse = session_pb2.DetectIntentResponse(
+                response_id=streaming_response.response_id,
+                query_result=streaming_response.query_result,
+                webhook_status=streaming_response.webhook_status,
+            )
+            with request_budget(context):
+                processed_cai_response: session_pb2.DetectIntentResponse = self._process_cai_response(
+                    session_name=session_names[0] if session_names else get_session_from_response(cai_response),
+                    cai_response=cai_response,
+                    context=context,
+                )
+            yield session_pb2.StreamingDetectIntentResponse(
+                response_id=processed_cai_response.response_id,
+                recognition_result=streaming_response.recognition_result,
+                query_result=processed_cai_response.query_result,
+                webhook_status=processed_cai_response.webhook_status,
+            )
+
+    @staticmethod
+    def _wait_for_flight(flight: Flight, context: grpc.ServicerContext) -> session_pb2.DetectIntentResponse:
+        """answer a duplicate request with the response of the identical request which is (or was) served"""
+        try:
+            return flight.get_response(timeout=get_context_time_remaining(context))
+        except FutureTimeoutError:
+            context.abort(grpc.StatusCode.DEADLINE_EXCEEDED, "the identical request did not finish in time")
+            raise
+        except grpc.RpcError as e:
+            context.abort(e.code(), e.details())  # type: ignore[attr-defined]
+            raise
+
+    def _detect_intent(
+        self,
+        request: session_pb2.DetectIntentRequest,
+        context: grpc.ServicerContext,
+        flight: Optional[Flight] = None,
+    ) -> session_pb2.DetectIntentResponse:
+        # the deadline of the caller is the timeout of every CAI call and the budget seen by the handlers; a flight
+        # stays active while any of the callers of identical requests waits
+        with request_budget(flight or context), instrumented_request():
+            started_at: float = time.perf_counter()
+            self._truncate_request_text(request)
+            observe_stage(stage="truncate_request", started_at=started_at)
+            cai_response: session_pb2.DetectIntentResponse = self.perform_detect_intent(request)
+            processed_cai_response: session_pb2.DetectIntentResponse = self._process_cai_response(
+                session_name=request.session,
+                cai_response=cai_response,
+                context=context,
+            )
+
+        # TODO(arath): add here to update the modified response in ondewo-cai session step once API is ready
+        return processed_cai_response
+
+    @staticmethod
+    def _get_abandoned_status(stage: str) -> Optional[grpc.StatusCode]:
+        """
+        Returns:
+            the status to abort the call with if its caller has cancelled it or its deadline has passed, else None
+        """
+        if not is_abandoned():
+            return None
+        BPI_METRICS.increment("detect_intent_abandoned_total")
+        log.info(f"BpiSessionsServices: DetectIntent: the caller has abandoned the call, skipping {stage}")
+        return grpc.StatusCode.DEADLINE_EXCEEDED if time_remaining() == 0.0 else grpc.StatusCode.CANCELLED
+
+    @instrumented(
+        logger=log.debug, log_arguments=False,
+        message='BpiSessionsServices: _truncate_request_text: Elapsed time: {:0.4f}'
+    )
+    def _truncate_request_text(self, request: session_pb2.DetectIntentRequest) -> str:
+        """Truncate the text of the request in place and return the text sent to CAI"""
         try:
             if len(request.query_input.text.text) > ONDEWO_BPI_SENTENCE_TRUNCATION:
                 log.warning(
                     f'The received text is too long, it will be truncated '
                     f'to {ONDEWO_BPI_SENTENCE_TRUNCATION} characters!'
                 )
-            log.debug(f'BpiSessionsServices: DetectIntent: request: \n{request}')
+            lazy_log.debug(lambda: f'BpiSessionsServices: DetectIntent: request: \n{request}')
             truncated_text: TextInput = TextInput(text=request.query_input.text.text[:ONDEWO_BPI_SENTENCE_TRUNCATION])
             truncated_text.language_code = request.query_input.text.language_code
-            log.debug(f'BpiSessionsServices: DetectIntent: truncated_text: \n{truncated_text}')
-            request.query_input.text.CopyFrom(truncated_text)
+            lazy_log.debug(lambda: f'BpiSessionsServices: DetectIntent: truncated_text: \n{truncated_text}')
+            if request.query_input.WhichOneof("input") == "text":  # an event or audio input must stay as it is
+                request.query_input.text.CopyFrom(truncated_text)
             text = request.query_input.text.text
         except Exception as e:
             log.exception(
@@ -177,22 +497,45 @@ class BpiSessionsServices(AutoSessionsServicer):
                 f"\tDetails: {e}"
             )
             text = "error"
-        log.debug(
-            {
+        lazy_log.debug(
+            lambda: {
                 "message": f"CAI-DetectIntentRequest to CAI, text input: {text}",
                 "content": text,
                 "text": text,
                 "tags": ["text"],
             }
         )
-        cai_response: session_pb2.DetectIntentResponse = self.perform_detect_intent(request)
-        output_contexts_cai_response_dict: Dict[str, Tuple[str, context_pb2.Context]] = {
-            output_context.name: (MessageToJson(message=output_context, sort_keys=True, indent=True), output_context)
-            for output_context in cai_response.query_result.output_contexts
+        PAYLOAD_LOG.log(session_name=request.session, stage="request", payload=request)
+        return text
+
+    @staticmethod
+    def _get_context_fingerprint(context: context_pb2.Context) -> bytes:
+        """
+        hash of the deterministic binary serialization of the context, i.e. equal for equal contexts
+
+        Much cheaper than comparing MessageToJson strings; deterministic serialization sorts map entries, so the
+        parameters map does not cause false positives.
+        """
+        return blake2b(context.SerializeToString(deterministic=True), digest_size=16).digest()
+
+    @staticmethod
+    def _get_output_contexts_dict(
+        response: session_pb2.DetectIntentResponse,
+    ) -> Dict[str, Tuple[bytes, context_pb2.Context]]:
+        """
+        Returns:
+            context name -> (fingerprint of the context as it is now, context)
+        """
+        return {
+            output_context.name: (BpiSessionsServices._get_context_fingerprint(output_context), output_context)
+            for output_context in response.query_result.output_contexts
         }
+
+    @staticmethod
+    def _log_cai_response(cai_response: session_pb2.DetectIntentResponse) -> None:
         intent_name: str = cai_response.query_result.intent.display_name
-        log.debug(
-            {
+        lazy_log.debug(
+            lambda: {
                 "message": f"CAI-DetectIntentResponse from CAI, intent_name: {intent_name}",
                 "content": intent_name,
                 "intent_name": intent_name,
@@ -200,111 +543,120 @@ class BpiSessionsServices(AutoSessionsServicer):
                 "tags": ["text"],
             }
         )
-        cai_response = self.process_messages(cai_response)
-        processed_cai_response: session_pb2.DetectIntentResponse = self.process_intent_handler(cai_response)
-
-        output_contexts_cai_response_processed_dict: Dict[str, Tuple[str, context_pb2.Context]] = {
-            output_context.name: (MessageToJson(message=output_context, sort_keys=True, indent=True), output_context)
-            for output_context in cai_response.query_result.output_contexts
-        }
-        # region multi thread context update in a thread
-        bpi_services_process_threadpool_for_context_update_thread: Thread = Thread(
-            target=lambda: BpiSessionsServices.update_contexts_in_threadpool(
-                output_contexts_cai_response_dict=output_contexts_cai_response_dict,
-                output_contexts_cai_response_processed_dict=output_contexts_cai_response_processed_dict,
-                session_name=request.session,
-                client=self.client,
-            ), name=f"bpi_services_process_threadpool_for_context_update_thread {datetime.now()}"
-        )
-        bpi_services_process_threadpool_for_context_update_thread.start()
-        # endregion multi thread context update in a thread
 
-        # TODO(arath): add here to update the modified response in ondewo-cai session step once API is ready
-        return processed_cai_response
-
-    @staticmethod
-    @Timer(
-        logger=log.debug, log_arguments=False, recursive=False,
-        message='BpiSessionsServices: process_context: Elapsed time: {:0.4f}'
-    )
-    def process_context(
-        context_name: str,
-        output_contexts_cai_response_dict: Dict[str, Tuple[str, context_pb2.Context]],
-        client: NluClient,
-    ) -> None:
-        # Update the modified context from bpi in cai
-        context_to_update: context_pb2.Context = output_contexts_cai_response_dict[context_name][1]
-        if context_to_update.lifespan_count > 0:
-            clear_created_modified(context_to_update)
-            update_context_request: context_pb2.UpdateContextRequest = context_pb2.UpdateContextRequest(
-                context=context_to_update,
-            )
-            log.debug(f"START: Send process_context for context {context_name} ...")
-            try:
-                client.services.contexts.update_context(update_context_request)
-            except Exception as e:
-                if "StatusCode.NOT_FOUND" not in str(e):  # if context does not exist anymore then ignore the update
-                    log.warning(f"Context update failed for {context_name}, hence retry: {e}")
-                    client.services.contexts.update_context(update_context_request)
-
-            log.debug(f"DONE: Send process_context for context {context_name}.")
-
-    @staticmethod
-    @Timer(
-        logger=log.debug, log_arguments=False, recursive=False,
-        message='BpiSessionsServices: update_contexts_in_threadpool: Elapsed time: {:0.4f}'
-    )
-    def update_contexts_in_threadpool(
-        output_contexts_cai_response_dict: Dict[str, Tuple[str, context_pb2.Context]],
-        output_contexts_cai_response_processed_dict: Dict[str, Tuple[str, context_pb2.Context]],
+    def _start_context_update(
+        self,
+        output_contexts_cai_response_dict: Dict[str, Tuple[bytes, context_pb2.Context]],
+        processed_cai_response: session_pb2.DetectIntentResponse,
         session_name: str,
-        client: NluClient,
     ) -> None:
-        # Get the currently active contexts from NLU to prevent updating a decayed or non-existing context
-        list_context_response: ListContextsResponse = client.services.contexts.list_contexts(
-            request=ListContextsRequest(session_id=session_name),
-        )
-        nlu_context_names: Set[str] = {
-            c.name for c in list_context_response.contexts if c.lifespan_count > 0
-        }
-        if len(nlu_context_names) == 0:
-            return None
-
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            # Submit tasks to the thread pool
-            for context_name in output_contexts_cai_response_dict.keys():
-                if (
-                    context_name in output_contexts_cai_response_processed_dict
-                    and context_name in nlu_context_names  # no need to update a context not existing in NLU
-                ):
-                    context_str: str = output_contexts_cai_response_dict[context_name][0]
-                    context_processed_str: str = output_contexts_cai_response_processed_dict[context_name][0]
-                    if context_str == context_processed_str:
-                        # do not update context if context has not changed through ondewo-bpi processing
-                        continue
-
-                executor.submit(
-                    BpiSessionsServices.process_context,
-                    context_name=context_name,
-                    output_contexts_cai_response_dict=output_contexts_cai_response_dict,
-                    client=client,
-                )
-
-    @Timer(
-        logger=log.debug, log_arguments=True, recursive=True,
+        """queue the contexts which were changed by the BPI processing to be written back to CAI"""
+        output_contexts_cai_response_processed_dict: Dict[str, Tuple[bytes, context_pb2.Context]] = \
+            self._get_output_contexts_dict(processed_cai_response)
+        changed_contexts: List[context_pb2.Context] = [
+            output_contexts_cai_response_processed_dict[context_name][1]
+            for context_name, (fingerprint, _) in output_contexts_cai_response_dict.items()
+            if context_name in output_contexts_cai_response_processed_dict
+            # do not update context if context has not changed through ondewo-bpi processing
+            and fingerprint != output_contexts_cai_response_processed_dict[context_name][0]
+        ]
+        self.context_sync.submit(session_name=session_name, contexts=changed_contexts)
+
+    @instrumented(
+        logger=log.debug, log_arguments=True,
         message='BpiSessionsServices: perform_detect_intent: Elapsed time: {:0.4f}'
     )
     def perform_detect_intent(
         self,
         request: session_pb2.DetectIntentRequest,
     ) -> session_pb2.DetectIntentResponse:
-        log.debug(f'START: BpiSessionsServices: perform_detect_intent: request: \n{request}')
-        response: session_pb2.DetectIntentResponse = self.client.services.sessions.detect_intent(request)
-        log.debug(f'DONE: BpiSessionsServices: perform_detect_intent: response: \n{response}')
+        lazy_log.debug(lambda: f'START: BpiSessionsServices: perform_detect_intent: request: \n{request}')
+        for hook in self.pre_detect_intent_hooks:
+            local_response: Optional[session_pb2.DetectIntentResponse] = hook(request)
+            if local_response is not None:
+                return self._answer_locally(request=request, response=local_response)
+        return self._detect_intent_with_cai(request)
+
+    def _detect_intent_with_cai(
+        self,
+        request: session_pb2.DetectIntentRequest,
+    ) -> session_pb2.DetectIntentResponse:
+        cache_key, cached_response = self._get_cached_response(request)
+        if cached_response is not None:
+            return cached_response
+        response: session_pb2.DetectIntentResponse
+        started_at: float = time.perf_counter()
+        if self.detect_intent_hedger is not None:
+            # a hedge could overtake the pending context writes of the session in CAI
+            response = self.detect_intent_hedger.detect_intent(
+                request=request,
+                allow_hedge=not self.context_sync.has_pending(request.session),
+                timeout=time_remaining(),
+            )
+        else:
+            response = self.client.services.sessions.detect_intent(request)
+        observe_stage(
+            stage="cai_detect_intent", started_at=started_at, intent_name=response.query_result.intent.display_name,
+        )
+        self._cache_response(cache_key=cache_key, response=response)
+        lazy_log.debug(lambda: f'DONE: BpiSessionsServices: perform_detect_intent: response: \n{response}')
+        return response
+
+    def _answer_locally(
+        self,
+        request: session_pb2.DetectIntentRequest,
+        response: session_pb2.DetectIntentResponse,
+    ) -> session_pb2.DetectIntentResponse:
+        """complete the response of a pre-DetectIntent hook and record the turn in CAI"""
+        response = adapt_local_response(response=response, request=request)
+        BPI_METRICS.increment("pre_detect_intent_answered_total")
+        lazy_log.debug(
+            lambda: f'BpiSessionsServices: DetectIntent of {request.session} answered by a pre-DetectIntent hook'
+        )
+        self.session_step_tracker.track(client=self.client, request=request, response=response)
         return response
 
-    @Timer(
-        logger=log.debug, log_arguments=True, recursive=True,
+    def _get_cached_response(
+        self,
+        request: session_pb2.DetectIntentRequest,
+    ) -> Tuple[Optional[ResponseCacheKey], Optional[session_pb2.DetectIntentResponse]]:
+        """
+        Returns:
+            the response cache key of the request (None if it is not cacheable) and the cached response on a hit
+        """
+        if self.response_cache is None:
+            return None, None
+        cache_key: Optional[ResponseCacheKey] = self.response_cache.get_key(
+            request=request,
+            alive_context_names=self.context_mirror.alive_context_names(request.session),
+        )
+        if cache_key is None:
+            return None, None
+        response: Optional[session_pb2.DetectIntentResponse] = self.response_cache.get(key=cache_key, request=request)
+        if response is not None:
+            lazy_log.debug(
+                lambda: f'BpiSessionsServices: DetectIntent of {request.session} answered from the response cache'
+            )
+            self.response_cache.track_session_step(client=self.client, request=request, response=response)
+        return cache_key, response
+
+    def _cache_response(
+        self,
+        cache_key: Optional[ResponseCacheKey],
+        response: session_pb2.DetectIntentResponse,
+    ) -> None:
+        if self.response_cache is None or cache_key is None:
+            return
+        # the intent handlers run on the cached response, which must not depend on or change contexts
+        handlers: List[Callable] = self._get_handlers_for_intent(
+            intent_name=response.query_result.intent.display_name,
+            assignors=self.intent_handlers,
+        )
+        if all(is_context_preserving(handler) for handler in handlers):
+            self.response_cache.put(key=cache_key, response=response)
+
+    @instrumented(
+        logger=log.debug, log_arguments=True,
         message='BpiSessionsServices: process_messages: Elapsed time: {:0.4f}'
     )
     def process_messages(
@@ -312,7 +664,11 @@ class BpiSessionsServices(AutoSessionsServicer):
         response: session_pb2.DetectIntentResponse,
     ) -> session_pb2.DetectIntentResponse:
         for j, message in enumerate(response.query_result.fulfillment_messages):
-            found_triggers = MessageHandler.get_triggers(message, get_session_from_response(response))
+            if is_abandoned():  # nobody waits for the result, hence no further triggers and quicksends
+                return response
+            found_triggers = MessageHandler.get_triggers(
+                message, get_session_from_response(response), trigger_scanner=self.trigger_scanner,
+            )
 
             for found_trigger in found_triggers:
                 new_response: Optional[session_pb2.DetectIntentResponse] = \
@@ -328,13 +684,27 @@ class BpiSessionsServices(AutoSessionsServicer):
             #     SingleMessageHandler.substitute_pattern_in_message(message, found_trigger, "")
             #     log.debug(f'BpiSessionsServices: process_messages: found_trigger: {found_trigger}')
 
-            self.quicksend_to_api(response, message, j)
+            self.quicksend(response, message, j)
         if not len(response.query_result.fulfillment_messages):
-            self.quicksend_to_api(response, None, 0)
+            self.quicksend(response, None, 0)
 
         return response
 
-    @Timer(
+    def quicksend(
+        self,
+        response: session_pb2.DetectIntentResponse,
+        message: Optional[intent_pb2.Intent.Message],
+        count: int,
+    ) -> None:
+        """calls quicksend_to_api directly or, with ONDEWO_BPI_QUICKSEND_ASYNC, queues it for the quicksend dispatcher"""
+        if self.quicksend_dispatcher is None:
+            self.quicksend_to_api(response, message, count)
+            return
+        self.quicksend_dispatcher.submit(
+            session_name=get_session_from_response(response), response=response, message=message, count=count,
+        )
+
+    @instrumented(
         logger=log.debug, log_arguments=False,
         message='BpiSessionsServices: quicksend_to_api: Elapsed time: {:0.4f}'
     )
@@ -346,22 +716,22 @@ class BpiSessionsServices(AutoSessionsServicer):
     ) -> None:
         log.warning({"message": "quicksend_to_api not written, please subclass and implement"})
 
-    @Timer(
-        logger=log.debug, log_arguments=True, recursive=True,
+    @instrumented(
+        logger=log.debug, log_arguments=True,
         message='BpiSessionsServices: process_intent_handler: Elapsed time: {:0.4f}'
     )
     def process_intent_handler(
         self,
         cai_response: session_pb2.DetectIntentResponse,
     ) -> session_pb2.DetectIntentResponse:
-        # Create an ordered dictionary by key value length
-        intent_name = cai_response.query_result.intent.display_name
-        handlers: List[Callable] = self._get_handlers_for_intent(
-            intent_name=intent_name,
-            assignors=self.intent_handlers,
-        )
-        for handler in handlers:
-            cai_response = handler(cai_response, self.client)
+        intent_name: str = cai_response.query_result.intent.display_name
+        for stage in self._get_handler_stages_for_intent(intent_name=intent_name):
+            if is_abandoned():  # nobody waits for the result, hence no further handlers
+                break
+            if len(stage) == 1:
+                cai_response = call_intent_handler(stage[0], intent_name, cai_response, self.client)
+            else:
+                cai_response = self._run_handler_stage(stage=stage, cai_response=cai_response)
             text = [i.text.text for i in cai_response.query_result.fulfillment_messages]
             log.info(
                 {
@@ -373,7 +743,31 @@ class BpiSessionsServices(AutoSessionsServicer):
             )
         return cai_response
 
-    @Timer(
+    def _run_handler_stage(
+        self,
+        stage: List[Callable],
+        cai_response: session_pb2.DetectIntentResponse,
+    ) -> session_pb2.DetectIntentResponse:
+        """run the handlers of a stage concurrently, each on its own copy of the response"""
+        intent_name: str = cai_response.query_result.intent.display_name
+        futures: List["Future[session_pb2.DetectIntentResponse]"] = []
+        for handler in stage:
+            response_copy: session_pb2.DetectIntentResponse = session_pb2.DetectIntentResponse()
+            response_copy.CopyFrom(cai_response)
+            # the copied context carries the deadline of the call into the executor thread
+            futures.append(self.intent_handler_executor.submit(
+                contextvars.copy_context().run, call_intent_handler, handler, intent_name, response_copy, self.client,
+            ))
+        return merge_handler_responses(cai_response, [future.result() for future in futures])
+
+    def _get_handler_stages_for_intent(self, intent_name: str) -> List[List[Callable]]:
+        index: Optional[IntentDispatchIndex] = self.intent_dispatch_index
+        if index is None:
+            index = self.freeze_intent_handlers()
+        assignor: Optional[IntentCallbackAssignor] = index.resolve_assignor(intent_name)
+        return assignor.stages if assignor is not None else []
+
+    @instrumented(
         logger=log.debug, log_arguments=False,
         message='BpiSessionsServices: _get_handlers_for_intent: Elapsed time: {:0.4f}'
     )
@@ -382,6 +776,11 @@ class BpiSessionsServices(AutoSessionsServicer):
         intent_name: str,
         assignors: List[IntentCallbackAssignor],
     ) -> List[Callable]:
+        if assignors is self.intent_handlers:
+            index: Optional[IntentDispatchIndex] = self.intent_dispatch_index
+            if index is None:
+                index = self.freeze_intent_handlers()
+            return list(index.resolve(intent_name))
         for assignor in assignors:
             # NOTE: the intent names are regex patterns. For exact intent match, prefix with ^ and postfix with $
             if re.match(assignor.intent_pattern, intent_name):
@@ -414,7 +813,32 @@ class BpiContextServices(AutoContextsServicer):
         self, request: context_pb2.CreateContextRequest, context: grpc.ServicerContext
     ) -> context_pb2.Context:
         log.info("passing create context request on to CAI")
-        return self.client.services.contexts.create_context(request=request)
+        response: context_pb2.Context = self.client.services.contexts.create_context(request=request)
+        SESSION_CONTEXT_MIRROR.update_from_write(response)
+        SESSION_STATE_CACHE.invalidate(response.name)
+        return response
+
+    def UpdateContext(
+        self, request: context_pb2.UpdateContextRequest, context: grpc.ServicerContext
+    ) -> context_pb2.Context:
+        response: context_pb2.Context = super().UpdateContext(request=request, context=context)
+        SESSION_CONTEXT_MIRROR.update_from_write(response)
+        SESSION_STATE_CACHE.invalidate(response.name)
+        return response
+
+    def DeleteContext(self, request: context_pb2.DeleteContextRequest, context: grpc.ServicerContext) -> Empty:
+        response: Empty = super().DeleteContext(request=request, context=context)
+        SESSION_CONTEXT_MIRROR.remove_context(request.name)
+        SESSION_STATE_CACHE.invalidate(request.name)
+        return response
+
+    def DeleteAllContexts(
+        self, request: context_pb2.DeleteAllContextsRequest, context: grpc.ServicerContext
+    ) -> Empty:
+        response: Empty = super().DeleteAllContexts(request=request, context=context)
+        SESSION_CONTEXT_MIRROR.set_alive_contexts(session_name=request.session_id, contexts=[])
+        SESSION_STATE_CACHE.invalidate_session(request.session_id)
+        return response
 
 
 class BpiAgentsServices(AutoAgentsServicer):
@@ -15,6 +15,7 @@ import json
 import os
 from typing import (
     Any,
+    List,
     Optional,
     Set,
     Tuple,
@@ -29,15 +30,60 @@ from ondewo.nlu.client_config import ClientConfig
 import ondewo_bpi.__init__ as file_anchor
 from ondewo_bpi.helpers import (
     get_bool_from_env,
+    get_float_from_env,
     get_int_from_env,
     get_str_from_env,
 )
+from ondewo_bpi.instrumentation import (
+    INSTRUMENTATION_FULL,
+    configure_instrumentation,
+)
 
 parent = os.path.abspath(os.path.join(os.path.dirname(file_anchor.__file__), os.path.pardir))
 
 # ONDEWO BPI
 ONDEWO_BPI_HOST: str = get_str_from_env(env_variable_name="ONDEWO_BPI_HOST", default_value="[::]")  # accept all
 ONDEWO_BPI_PORT: str = get_str_from_env(env_variable_name="ONDEWO_BPI_PORT", default_value="50051")
+# timing and argument debug logs of the BPI functions: off, sampled (the calls of one in
+# ONDEWO_BPI_INSTRUMENTATION_SAMPLE_EVERY requests) or full, see ondewo_bpi.instrumentation
+ONDEWO_BPI_INSTRUMENTATION_MODE: str = get_str_from_env(
+    env_variable_name="ONDEWO_BPI_INSTRUMENTATION_MODE",
+    default_value=INSTRUMENTATION_FULL,
+)
+ONDEWO_BPI_INSTRUMENTATION_SAMPLE_EVERY: int = get_int_from_env(
+    env_variable_name="ONDEWO_BPI_INSTRUMENTATION_SAMPLE_EVERY",
+    default_value=100,
+)
+configure_instrumentation(
+    mode=ONDEWO_BPI_INSTRUMENTATION_MODE,
+    sample_every=ONDEWO_BPI_INSTRUMENTATION_SAMPLE_EVERY,
+)
+# comma separated session ids (or full session names) whose DetectIntent requests and responses are logged completely
+ONDEWO_BPI_PAYLOAD_LOG_SESSIONS: str = get_str_from_env(
+    env_variable_name="ONDEWO_BPI_PAYLOAD_LOG_SESSIONS",
+    default_value="",
+)
+# fraction (0-1) of all sessions whose payloads are logged completely, e.g. 0.001
+ONDEWO_BPI_PAYLOAD_LOG_SESSION_RATIO: float = get_float_from_env(
+    env_variable_name="ONDEWO_BPI_PAYLOAD_LOG_SESSION_RATIO",
+    default_value=0.0,
+)
+# the servers hand log records to a background writer thread instead of writing them in the serving threads; off by
+# default, records still queued are lost on a hard exit
+ONDEWO_BPI_LOG_QUEUE_ENABLED: bool = get_bool_from_env(
+    env_variable_name="ONDEWO_BPI_LOG_QUEUE_ENABLED",
+    default_value=False,
+)
+# log records waiting for the writer thread; beyond it new records are dropped (and counted)
+ONDEWO_BPI_LOG_QUEUE_MAX_SIZE: int = get_int_from_env(
+    env_variable_name="ONDEWO_BPI_LOG_QUEUE_MAX_SIZE",
+    default_value=10000,
+)
+# log records the writer thread writes at once
+ONDEWO_BPI_LOG_QUEUE_BATCH_SIZE: int = get_int_from_env(
+    env_variable_name="ONDEWO_BPI_LOG_QUEUE_BATCH_SIZE",
+    default_value=256,
+)
 
 # ONDEWO NLU CAI
 ONDEWO_BPI_CAI_HOST: Optional[str] = get_str_from_env(
@@ -77,6 +123,233 @@ ONDEWO_BPI_CAI_CAI_TOKEN: Optional[str] = get_str_from_env(
     default_value="",
 )
 
+# ONDEWO BPI asyncio server
+ONDEWO_BPI_ASYNC_SYNC_HANDLER_MAX_WORKERS: int = get_int_from_env(
+    env_variable_name="ONDEWO_BPI_ASYNC_SYNC_HANDLER_MAX_WORKERS",
+    default_value=32,
+)
+ONDEWO_BPI_ASYNC_RELAY_MAX_WORKERS: int = get_int_from_env(
+    env_variable_name="ONDEWO_BPI_ASYNC_RELAY_MAX_WORKERS",
+    default_value=16,
+)
+
+# ONDEWO BPI prefork: number of worker processes, 0 means one worker per CPU core
+ONDEWO_BPI_PREFORK_WORKERS: int = get_int_from_env(
+    env_variable_name="ONDEWO_BPI_PREFORK_WORKERS",
+    default_value=0,
+)
+# a crashed worker is restarted after a backoff doubling from the base up to the max with every rapid failure, i.e.
+# an exit within ONDEWO_BPI_PREFORK_RAPID_FAILURE_SECONDS of its start; after max rapid failures in a row the launcher
+# stops all workers and gives up
+ONDEWO_BPI_PREFORK_RESTART_BACKOFF_SECONDS: float = get_float_from_env(
+    env_variable_name="ONDEWO_BPI_PREFORK_RESTART_BACKOFF_SECONDS",
+    default_value=1.0,
+)
+ONDEWO_BPI_PREFORK_RESTART_BACKOFF_MAX_SECONDS: float = get_float_from_env(
+    env_variable_name="ONDEWO_BPI_PREFORK_RESTART_BACKOFF_MAX_SECONDS",
+    default_value=60.0,
+)
+ONDEWO_BPI_PREFORK_RAPID_FAILURE_SECONDS: float = get_float_from_env(
+    env_variable_name="ONDEWO_BPI_PREFORK_RAPID_FAILURE_SECONDS",
+    default_value=30.0,
+)
+ONDEWO_BPI_PREFORK_MAX_RAPID_FAILURES: int = get_int_from_env(
+    env_variable_name="ONDEWO_BPI_PREFORK_MAX_RAPID_FAILURES",
+    default_value=5,
+)
+
+# ONDEWO BPI admission control
+ONDEWO_BPI_MAX_WORKERS: int = get_int_from_env(env_variable_name="ONDEWO_BPI_MAX_WORKERS", default_value=100)
+# requests waiting for a free worker; 0 means unbounded. Beyond max workers + queue depth, calls are rejected
+# immediately with RESOURCE_EXHAUSTED by grpc itself
+ONDEWO_BPI_MAX_QUEUE_DEPTH: int = get_int_from_env(env_variable_name="ONDEWO_BPI_MAX_QUEUE_DEPTH", default_value=0)
+# explicit override of maximum_concurrent_rpcs of the grpc server; 0 means derived from workers and queue depth
+ONDEWO_BPI_MAXIMUM_CONCURRENT_RPCS: int = get_int_from_env(
+    env_variable_name="ONDEWO_BPI_MAXIMUM_CONCURRENT_RPCS",
+    default_value=0,
+)
+ONDEWO_BPI_ADAPTIVE_CONCURRENCY: bool = get_bool_from_env(
+    env_variable_name="ONDEWO_BPI_ADAPTIVE_CONCURRENCY",
+    default_value=False,
+)
+ONDEWO_BPI_ADAPTIVE_CONCURRENCY_MIN_LIMIT: int = get_int_from_env(
+    env_variable_name="ONDEWO_BPI_ADAPTIVE_CONCURRENCY_MIN_LIMIT",
+    default_value=4,
+)
+ONDEWO_BPI_ADAPTIVE_CONCURRENCY_LATENCY_SECONDS: float = get_float_from_env(
+    env_variable_name="ONDEWO_BPI_ADAPTIVE_CONCURRENCY_LATENCY_SECONDS",
+    default_value=2.0,
+)
+ONDEWO_BPI_RETRY_AFTER_MS: int = get_int_from_env(env_variable_name="ONDEWO_BPI_RETRY_AFTER_MS", default_value=1000)
+
+# ONDEWO BPI execution lanes: JSON list of lanes, "default" means the default admin lane, empty disables the lanes
+ONDEWO_BPI_EXECUTION_LANES: str = get_str_from_env(env_variable_name="ONDEWO_BPI_EXECUTION_LANES", default_value="")
+
+# ONDEWO BPI context sync: worker threads writing modified contexts back to CAI and the bound of its queue
+ONDEWO_BPI_CONTEXT_SYNC_WORKERS: int = get_int_from_env(
+    env_variable_name="ONDEWO_BPI_CONTEXT_SYNC_WORKERS",
+    default_value=4,
+)
+ONDEWO_BPI_CONTEXT_SYNC_MAX_PENDING_SESSIONS: int = get_int_from_env(
+    env_variable_name="ONDEWO_BPI_CONTEXT_SYNC_MAX_PENDING_SESSIONS",
+    default_value=10000,
+)
+
+# ONDEWO BPI session context mirror: alive contexts of the recently active sessions
+ONDEWO_BPI_CONTEXT_MIRROR_MAX_SESSIONS: int = get_int_from_env(
+    env_variable_name="ONDEWO_BPI_CONTEXT_MIRROR_MAX_SESSIONS",
+    default_value=50000,
+)
+ONDEWO_BPI_CONTEXT_MIRROR_TTL_SECONDS: float = get_float_from_env(
+    env_variable_name="ONDEWO_BPI_CONTEXT_MIRROR_TTL_SECONDS",
+    default_value=600.0,
+)
+# cache the contexts read and written by the helpers and write them once per turn, see ondewo_bpi.session_state_cache
+ONDEWO_BPI_SESSION_STATE_CACHE_ENABLED: bool = get_bool_from_env(
+    env_variable_name="ONDEWO_BPI_SESSION_STATE_CACHE_ENABLED",
+    default_value=False,
+)
+ONDEWO_BPI_SESSION_STATE_CACHE_MAX_ENTRIES: int = get_int_from_env(
+    env_variable_name="ONDEWO_BPI_SESSION_STATE_CACHE_MAX_ENTRIES",
+    default_value=100000,
+)
+# contexts not refreshed by a DetectIntentResponse or a write for this long are read from CAI again
+ONDEWO_BPI_SESSION_STATE_CACHE_TTL_SECONDS: float = get_float_from_env(
+    env_variable_name="ONDEWO_BPI_SESSION_STATE_CACHE_TTL_SECONDS",
+    default_value=60.0,
+)
+
+# ONDEWO BPI context writer: attempts (first call + retries) and deadline of a single UpdateContext call
+ONDEWO_BPI_CONTEXT_WRITE_MAX_ATTEMPTS: int = get_int_from_env(
+    env_variable_name="ONDEWO_BPI_CONTEXT_WRITE_MAX_ATTEMPTS",
+    default_value=2,
+)
+ONDEWO_BPI_CONTEXT_WRITE_TIMEOUT_SECONDS: float = get_float_from_env(
+    env_variable_name="ONDEWO_BPI_CONTEXT_WRITE_TIMEOUT_SECONDS",
+    default_value=5.0,
+)
+
+# ONDEWO BPI hedged DetectIntent requests, see ondewo_bpi.hedging.HedgedDetectIntent before enabling
+ONDEWO_BPI_HEDGING_ENABLED: bool = get_bool_from_env(env_variable_name="ONDEWO_BPI_HEDGING_ENABLED", default_value=False)
+# host and port of the replica the hedge request is sent to, defaults to ONDEWO_BPI_CAI_HOST / ONDEWO_BPI_CAI_PORT
+ONDEWO_BPI_HEDGING_CAI_HOST: str = get_str_from_env(env_variable_name="ONDEWO_BPI_HEDGING_CAI_HOST", default_value="")
+ONDEWO_BPI_HEDGING_CAI_PORT: str = get_str_from_env(env_variable_name="ONDEWO_BPI_HEDGING_CAI_PORT", default_value="")
+ONDEWO_BPI_HEDGING_PERCENTILE: float = get_float_from_env(
+    env_variable_name="ONDEWO_BPI_HEDGING_PERCENTILE",
+    default_value=95.0,
+)
+ONDEWO_BPI_HEDGING_MIN_DELAY_SECONDS: float = get_float_from_env(
+    env_variable_name="ONDEWO_BPI_HEDGING_MIN_DELAY_SECONDS",
+    default_value=0.05,
+)
+ONDEWO_BPI_HEDGING_MIN_SAMPLES: int = get_int_from_env(
+    env_variable_name="ONDEWO_BPI_HEDGING_MIN_SAMPLES",
+    default_value=100,
+)
+# maximum share of the recent DetectIntent calls which may be hedged
+ONDEWO_BPI_HEDGING_MAX_RATIO: float = get_float_from_env(
+    env_variable_name="ONDEWO_BPI_HEDGING_MAX_RATIO",
+    default_value=0.1,
+)
+# number of intent names whose resolved intent handlers are memoized
+ONDEWO_BPI_INTENT_DISPATCH_MEMO_SIZE: int = get_int_from_env(
+    env_variable_name="ONDEWO_BPI_INTENT_DISPATCH_MEMO_SIZE",
+    default_value=4096,
+)
+# threads running independent intent handlers concurrently (shared by all calls)
+ONDEWO_BPI_INTENT_HANDLER_MAX_WORKERS: int = get_int_from_env(
+    env_variable_name="ONDEWO_BPI_INTENT_HANDLER_MAX_WORKERS",
+    default_value=32,
+)
+# threads running the synchronous handlers registered with a timeout, see ondewo_bpi.handler_resilience
+ONDEWO_BPI_HANDLER_TIMEOUT_MAX_WORKERS: int = get_int_from_env(
+    env_variable_name="ONDEWO_BPI_HANDLER_TIMEOUT_MAX_WORKERS",
+    default_value=64,
+)
+# store shared by the replicas for the response cache and single flight, e.g. redis://redis:6379/0 (needs the redis
+# package) or memory:// for an in-process store; unset: each replica keeps its state to itself
+ONDEWO_BPI_STATE_STORE_URL: str = get_str_from_env(
+    env_variable_name="ONDEWO_BPI_STATE_STORE_URL",
+    default_value="",
+)
+# prefix of all keys in the shared state store, e.g. to separate several BPIs using the same Redis
+ONDEWO_BPI_STATE_STORE_KEY_PREFIX: str = get_str_from_env(
+    env_variable_name="ONDEWO_BPI_STATE_STORE_KEY_PREFIX",
+    default_value="ondewo_bpi:",
+)
+# cache of the CAI responses of context-free turns, see ondewo_bpi.response_cache
+ONDEWO_BPI_RESPONSE_CACHE_ENABLED: bool = get_bool_from_env(
+    env_variable_name="ONDEWO_BPI_RESPONSE_CACHE_ENABLED",
+    default_value=False,
+)
+ONDEWO_BPI_RESPONSE_CACHE_MAX_ENTRIES: int = get_int_from_env(
+    env_variable_name="ONDEWO_BPI_RESPONSE_CACHE_MAX_ENTRIES",
+    default_value=10000,
+)
+ONDEWO_BPI_RESPONSE_CACHE_TTL_SECONDS: float = get_float_from_env(
+    env_variable_name="ONDEWO_BPI_RESPONSE_CACHE_TTL_SECONDS",
+    default_value=300.0,
+)
+# comma separated intent display names; only these intents are cached if set
+ONDEWO_BPI_RESPONSE_CACHE_ALLOWED_INTENTS: str = get_str_from_env(
+    env_variable_name="ONDEWO_BPI_RESPONSE_CACHE_ALLOWED_INTENTS",
+    default_value="",
+)
+# comma separated intent display names which are never cached
+ONDEWO_BPI_RESPONSE_CACHE_DENIED_INTENTS: str = get_str_from_env(
+    env_variable_name="ONDEWO_BPI_RESPONSE_CACHE_DENIED_INTENTS",
+    default_value="",
+)
+# session steps of turns answered without CAI (cache hits, pre DetectIntent hooks): threads sending them to CAI and
+# the bound of the steps waiting to be sent, beyond it further steps are dropped
+ONDEWO_BPI_SESSION_STEP_WORKERS: int = get_int_from_env(
+    env_variable_name="ONDEWO_BPI_SESSION_STEP_WORKERS",
+    default_value=1,
+)
+ONDEWO_BPI_SESSION_STEP_MAX_PENDING: int = get_int_from_env(
+    env_variable_name="ONDEWO_BPI_SESSION_STEP_MAX_PENDING",
+    default_value=1000,
+)
+# deduplication of identical DetectIntent requests (e.g. retries), see ondewo_bpi.single_flight
+ONDEWO_BPI_SINGLE_FLIGHT_ENABLED: bool = get_bool_from_env(
+    env_variable_name="ONDEWO_BPI_SINGLE_FLIGHT_ENABLED",
+    default_value=False,
+)
+# time after the end of a call during which an identical request gets a copy of its response
+ONDEWO_BPI_SINGLE_FLIGHT_WINDOW_SECONDS: float = get_float_from_env(
+    env_variable_name="ONDEWO_BPI_SINGLE_FLIGHT_WINDOW_SECONDS",
+    default_value=5.0,
+)
+ONDEWO_BPI_SINGLE_FLIGHT_MAX_ENTRIES: int = get_int_from_env(
+    env_variable_name="ONDEWO_BPI_SINGLE_FLIGHT_MAX_ENTRIES",
+    default_value=10000,
+)
+# deliver quicksend_to_api in the background instead of inside DetectIntent, see ondewo_bpi.quicksend_dispatcher
+ONDEWO_BPI_QUICKSEND_ASYNC: bool = get_bool_from_env(
+    env_variable_name="ONDEWO_BPI_QUICKSEND_ASYNC",
+    default_value=False,
+)
+# number of sessions whose quicksend messages are delivered at the same time
+ONDEWO_BPI_QUICKSEND_MAX_CONCURRENCY: int = get_int_from_env(
+    env_variable_name="ONDEWO_BPI_QUICKSEND_MAX_CONCURRENCY",
+    default_value=8,
+)
+# undelivered quicksend messages over all sessions; beyond it new messages wait and are then dropped
+ONDEWO_BPI_QUICKSEND_MAX_PENDING: int = get_int_from_env(
+    env_variable_name="ONDEWO_BPI_QUICKSEND_MAX_PENDING",
+    default_value=10000,
+)
+# time a new message waits for space in a full quicksend queue before it is dropped
+ONDEWO_BPI_QUICKSEND_ENQUEUE_TIMEOUT_SECONDS: float = get_float_from_env(
+    env_variable_name="ONDEWO_BPI_QUICKSEND_ENQUEUE_TIMEOUT_SECONDS",
+    default_value=0.05,
+)
+# quicksend messages which waited longer for delivery are stale and expire
+ONDEWO_BPI_QUICKSEND_MESSAGE_TTL_SECONDS: float = get_float_from_env(
+    env_variable_name="ONDEWO_BPI_QUICKSEND_MESSAGE_TTL_SECONDS",
+    default_value=30.0,
+)
+
 
 class CentralClientProvider:
     """
@@ -86,6 +359,7 @@ class CentralClientProvider:
     def __init__(self, config: Optional[ClientConfig] = None) -> None:
         self.config = config
         self.client = None
+        self.options: Set[Tuple[str, Any]] = set()
         self._built = False
 
     @Timer(
@@ -103,6 +377,20 @@ class CentralClientProvider:
         message='CentralClientProvider: _instantiate_client: Elapsed time: {:0.4f}'
     )
     def _instantiate_client(self) -> Client:
+        self.options = self._get_channel_options()
+
+        if ONDEWO_BPI_CAI_GRPC_SECURE:
+            log.info("configuring secure connection")
+            self._instantiate_config(grpc_cert=ONDEWO_BPI_CAI_GRPC_CERT)
+            self.client = Client(config=self.config, options=self.options)
+        else:
+            log.info("configuring INSECURE connection")
+            self._instantiate_config()
+            self.client = Client(config=self.config, use_secure_channel=False, options=self.options)
+        return self.client
+
+    @staticmethod
+    def _get_channel_options() -> Set[Tuple[str, Any]]:
         # https://github.com/grpc/grpc-proto/blob/master/grpc/service_config/service_config.proto
         service_config_json: str = json.dumps(
             {
@@ -156,16 +444,52 @@ class CentralClientProvider:
             ("grpc.enable_retries", 1),
             ("grpc.service_config", service_config_json)
         }
+        return options
+
+    @Timer(
+        logger=log.debug, log_arguments=False,
+        message='CentralClientProvider: get_async_channel: Elapsed time: {:0.4f}'
+    )
+    def get_async_channel(self) -> grpc.aio.Channel:
+        """
+        create a grpc.aio channel to CAI with the same configuration as the nlu-client channels
 
+        the channel is bound to the running event loop, hence it has to be created from within that loop
+        """
+        self.get_client()
+        assert self.config is not None, "the config is instantiated with the client"
+        target: str = self.config.host_and_port
+        options: List[Tuple[str, Any]] = list(self.options)
         if ONDEWO_BPI_CAI_GRPC_SECURE:
-            log.info("configuring secure connection")
-            self._instantiate_config(grpc_cert=ONDEWO_BPI_CAI_GRPC_CERT)
-            self.client = Client(config=self.config, options=options)
-        else:
-            log.info("configuring INSECURE connection")
-            self._instantiate_config()
-            self.client = Client(config=self.config, use_secure_channel=False, options=options)
-        return self.client
+            credentials: grpc.ChannelCredentials = grpc.ssl_channel_credentials(
+                root_certificates=self.config.grpc_cert,
+            )
+            return grpc.aio.secure_channel(target=target, credentials=credentials, options=options)
+        return grpc.aio.insecure_channel(target=target, options=options)
+
+    @Timer(
+        logger=log.debug, log_arguments=False,
+        message='CentralClientProvider: get_separate_channel: Elapsed time: {:0.4f}'
+    )
+    def get_separate_channel(self, target: Optional[str] = None) -> grpc.Channel:
+        """
+        create a channel with the configuration of the nlu-client channels, but with its own connection
+
+        Args:
+            target: host:port to connect to, defaults to the CAI of the nlu-client
+        """
+        self.get_client()
+        assert self.config is not None, "the config is instantiated with the client"
+        # without a local subchannel pool, channels with equal arguments share their connections
+        options: List[Tuple[str, Any]] = [*self.options, ("grpc.use_local_subchannel_pool", 1)]
+        if ONDEWO_BPI_CAI_GRPC_SECURE:
+            credentials: grpc.ChannelCredentials = grpc.ssl_channel_credentials(
+                root_certificates=self.config.grpc_cert,
+            )
+            return grpc.secure_channel(
+                target=target or self.config.host_and_port, credentials=credentials, options=options,
+            )
+        return grpc.insecure_channel(target=target or self.config.host_and_port, options=options)
 
     @Timer(
         logger=log.debug, log_arguments=False,
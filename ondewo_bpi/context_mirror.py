@@ -0,0 +1,140 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+from collections import OrderedDict
+from dataclasses import (
+    dataclass,
+    field,
+)
+from threading import Lock
+from typing import (
+    Iterable,
+    Optional,
+    Set,
+)
+
+from ondewo.nlu import (
+    context_pb2,
+    session_pb2,
+)
+
+from ondewo_bpi.config import (
+    ONDEWO_BPI_CONTEXT_MIRROR_MAX_SESSIONS,
+    ONDEWO_BPI_CONTEXT_MIRROR_TTL_SECONDS,
+)
+from ondewo_bpi.metrics import (
+    BPI_METRICS,
+    MetricsRegistry,
+)
+
+
+def get_session_from_context_name(context_name: str) -> str:
+    """projects/<p>/agent/sessions/<s>/contexts/<c> -> projects/<p>/agent/sessions/<s>"""
+    return context_name.split("/contexts/", 1)[0]
+
+
+@dataclass
+class _MirroredSession:
+    alive_context_names: Set[str] = field(default_factory=set)
+    updated_at: float = field(default_factory=time.monotonic)
+
+
+class SessionContextMirror:
+    """
+    In-process LRU mirror of the alive (lifespan_count > 0) contexts of the recently active sessions
+
+    The mirror is fed by the output contexts of every DetectIntentResponse from CAI and by the context writes of the
+    BPI itself, so whether a context is still alive can be answered without a ListContexts call to CAI. Sessions
+    which were not seen for `ttl_seconds` (or were evicted) are a miss and have to be looked up in CAI again.
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = ONDEWO_BPI_CONTEXT_MIRROR_MAX_SESSIONS,
+        ttl_seconds: float = ONDEWO_BPI_CONTEXT_MIRROR_TTL_SECONDS,
+        metrics: MetricsRegistry = BPI_METRICS,
+    ) -> None:
+        self.max_sessions: int = max_sessions
+        self.ttl_seconds: float = ttl_seconds
+        self.metrics: MetricsRegistry = metrics
+        self._sessions: "OrderedDict[str, _MirroredSession]" = OrderedDict()
+        self._lock: Lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _store(self, session_name: str, alive_context_names: Set[str]) -> None:
+        """must be called with the lock held"""
+        self._sessions[session_name] = _MirroredSession(alive_context_names=alive_context_names)
+        self._sessions.move_to_end(session_name)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def _get(self, session_name: str) -> Optional[_MirroredSession]:
+        """must be called with the lock held"""
+        mirrored: Optional[_MirroredSession] = self._sessions.get(session_name)
+        if mirrored is None:
+            return None
+        if time.monotonic() - mirrored.updated_at > self.ttl_seconds:
+            del self._sessions[session_name]
+            return None
+        return mirrored
+
+    def set_alive_contexts(self, session_name: str, contexts: Iterable[context_pb2.Context]) -> None:
+        """replace the mirrored state of the session, e.g. with the result of ListContexts"""
+        with self._lock:
+            self._store(session_name, {context.name for context in contexts if context.lifespan_count > 0})
+
+    def update_from_response(self, session_name: str, response: session_pb2.DetectIntentResponse) -> None:
+        """the output contexts of a DetectIntentResponse are the alive contexts of the session after the turn"""
+        self.set_alive_contexts(session_name=session_name, contexts=response.query_result.output_contexts)
+
+    def update_from_write(self, context: context_pb2.Context) -> None:
+        """record a context created or updated by the BPI"""
+        with self._lock:
+            mirrored: Optional[_MirroredSession] = self._get(get_session_from_context_name(context.name))
+            if mirrored is None:
+                return  # partial knowledge must not turn into a hit
+            if context.lifespan_count > 0:
+                mirrored.alive_context_names.add(context.name)
+            else:
+                mirrored.alive_context_names.discard(context.name)
+
+    def remove_context(self, context_name: str) -> None:
+        with self._lock:
+            mirrored: Optional[_MirroredSession] = self._get(get_session_from_context_name(context_name))
+            if mirrored is not None:
+                mirrored.alive_context_names.discard(context_name)
+
+    def invalidate(self, session_name: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_name, None)
+
+    def alive_context_names(self, session_name: str) -> Optional[Set[str]]:
+        """
+        Returns:
+            the names of the alive contexts of the session, None if the session is not mirrored (a miss)
+        """
+        with self._lock:
+            mirrored: Optional[_MirroredSession] = self._get(session_name)
+            if mirrored is None:
+                self.metrics.increment("context_mirror_misses_total")
+                return None
+            self._sessions.move_to_end(session_name)
+            self.metrics.increment("context_mirror_hits_total")
+            return set(mirrored.alive_context_names)
+
+
+# process wide mirror shared by the DetectIntent pipeline, the context sync and the context relays
+SESSION_CONTEXT_MIRROR: SessionContextMirror = SessionContextMirror()
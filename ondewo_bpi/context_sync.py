@@ -0,0 +1,270 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import math
+import time
+from collections import OrderedDict
+from dataclasses import (
+    dataclass,
+    field,
+)
+from threading import (
+    Condition,
+    Lock,
+    Thread,
+)
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+)
+
+import grpc
+from ondewo.logging.logger import logger_console as log
+from ondewo.nlu import context_pb2
+from ondewo.nlu.client import Client as NluClient
+from ondewo.nlu.context_pb2 import (
+    ListContextsRequest,
+    ListContextsResponse,
+)
+
+from ondewo_bpi.config import (
+    ONDEWO_BPI_CONTEXT_SYNC_MAX_PENDING_SESSIONS,
+    ONDEWO_BPI_CONTEXT_SYNC_WORKERS,
+)
+from ondewo_bpi.context_mirror import (
+    SESSION_CONTEXT_MIRROR,
+    SessionContextMirror,
+)
+from ondewo_bpi.context_writer import (
+    ContextWriter,
+    ContextWriteResult,
+)
+from ondewo_bpi.instrumentation import instrumented
+from ondewo_bpi.metrics import (
+    BPI_METRICS,
+    MetricsRegistry,
+)
+from ondewo_bpi.stage_timing import CONTEXT_SYNC_SECONDS
+
+
+@dataclass
+class _PendingSession:
+    # context name -> latest context to write, i.e. last write wins
+    contexts: Dict[str, context_pb2.Context] = field(default_factory=dict)
+    # time the oldest unsent update of the session was enqueued
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class _Shard:
+    """sessions of one worker thread; a session always maps to the same shard, so its writes stay in order"""
+
+    def __init__(self, max_pending_sessions: int) -> None:
+        self.max_pending_sessions: int = max_pending_sessions
+        self.pending: "OrderedDict[str, _PendingSession]" = OrderedDict()
+        self.busy: bool = False
+        self.busy_session: Optional[str] = None
+        self.condition: Condition = Condition()
+
+
+class ContextSyncWorker:
+    """
+    Long-lived write-behind writer of the contexts modified by the BPI back to CAI
+
+    Updates are queued per session in a bounded queue and written by a fixed number of worker threads. Several
+    pending updates of the same context of a session are coalesced, only the last one is written. Contexts which
+    are no longer alive are not written back; whether a context is alive is answered by the SessionContextMirror,
+    only on a miss the contexts of the session are listed in CAI. The updates of a session are written
+    concurrently by the ContextWriter.
+
+    Metrics (see ondewo_bpi.metrics): context_sync_queue_depth, context_sync_lag_seconds, the counters
+    context_sync_{enqueued,coalesced,updates_sent,dropped,errors}_total and the histogram context_sync_seconds.
+    """
+
+    def __init__(
+        self,
+        client_provider: Callable[[], NluClient],
+        num_workers: int = ONDEWO_BPI_CONTEXT_SYNC_WORKERS,
+        max_pending_sessions: int = ONDEWO_BPI_CONTEXT_SYNC_MAX_PENDING_SESSIONS,
+        enqueue_timeout_seconds: float = 0.5,
+        context_mirror: SessionContextMirror = SESSION_CONTEXT_MIRROR,
+        context_writer: Optional[ContextWriter] = None,
+        metrics: MetricsRegistry = BPI_METRICS,
+    ) -> None:
+        assert num_workers > 0, "num_workers must be positive"
+        self.client_provider: Callable[[], NluClient] = client_provider
+        self.num_workers: int = num_workers
+        self.enqueue_timeout_seconds: float = enqueue_timeout_seconds
+        self.context_mirror: SessionContextMirror = context_mirror
+        self.context_writer: ContextWriter = context_writer or ContextWriter(
+            client_provider=client_provider,
+            metrics=metrics,
+        )
+        self.metrics: MetricsRegistry = metrics
+        shard_size: int = max(1, math.ceil(max_pending_sessions / num_workers))
+        self._shards: List[_Shard] = [_Shard(max_pending_sessions=shard_size) for _ in range(num_workers)]
+        self._threads: List[Thread] = []
+        self._running: bool = False
+        self._start_lock: Lock = Lock()
+        self._depth: int = 0
+        self._depth_lock: Lock = Lock()
+
+    @property
+    def queue_depth(self) -> int:
+        """number of contexts waiting to be written"""
+        return self._depth
+
+    def has_pending(self, session_name: str) -> bool:
+        """whether context writes of the session are queued or being written"""
+        shard: _Shard = self._shards[hash(session_name) % self.num_workers]
+        with shard.condition:
+            return session_name in shard.pending or shard.busy_session == session_name
+
+    def _change_depth(self, delta: int) -> None:
+        with self._depth_lock:
+            self._depth += delta
+            self.metrics.set_gauge("context_sync_queue_depth", self._depth)
+
+    def start(self) -> None:
+        with self._start_lock:
+            if self._running:
+                return
+            self._running = True
+            self._threads = [
+                Thread(target=self._run, args=(shard,), name=f"bpi_context_sync_{index}", daemon=True)
+                for index, shard in enumerate(self._shards)
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def submit(self, session_name: str, contexts: List[context_pb2.Context]) -> bool:
+        """
+        queue the given contexts of the session to be written to CAI
+
+        Returns:
+            False if the queue stayed full for enqueue_timeout_seconds and the update was dropped
+        """
+        if not contexts:
+            return True
+        if not self._running:
+            self.start()
+        shard: _Shard = self._shards[hash(session_name) % self.num_workers]
+        with shard.condition:
+            if session_name not in shard.pending:
+                if not shard.condition.wait_for(
+                    lambda: len(shard.pending) < shard.max_pending_sessions,
+                    timeout=self.enqueue_timeout_seconds,
+                ):
+                    self.metrics.increment("context_sync_dropped_total", len(contexts))
+                    log.warning(f"context sync queue is full, dropped context update of session {session_name}")
+                    return False
+                shard.pending[session_name] = _PendingSession()
+            pending: _PendingSession = shard.pending[session_name]
+            added: int = 0
+            for context in contexts:
+                if context.name in pending.contexts:
+                    self.metrics.increment("context_sync_coalesced_total")
+                else:
+                    added += 1
+                copied_context: context_pb2.Context = context_pb2.Context()
+                copied_context.CopyFrom(context)
+                pending.contexts[context.name] = copied_context
+            self.metrics.increment("context_sync_enqueued_total", len(contexts))
+            self._change_depth(added)
+            shard.condition.notify_all()
+        return True
+
+    def _run(self, shard: _Shard) -> None:
+        while True:
+            with shard.condition:
+                shard.condition.wait_for(lambda: bool(shard.pending) or not self._running)
+                if not shard.pending:
+                    return
+                session_name, pending = shard.pending.popitem(last=False)
+                shard.busy = True
+                shard.busy_session = session_name
+                shard.condition.notify_all()
+            self._change_depth(-len(pending.contexts))
+            self.metrics.set_gauge("context_sync_lag_seconds", time.monotonic() - pending.enqueued_at)
+            started_at: float = time.perf_counter()
+            try:
+                self._sync_session(session_name=session_name, contexts=pending.contexts)
+            except Exception as e:
+                self.metrics.increment("context_sync_errors_total")
+                log.exception(f"context sync of session {session_name} failed: {e}")
+            finally:
+                self.metrics.observe(CONTEXT_SYNC_SECONDS, time.perf_counter() - started_at)
+                with shard.condition:
+                    shard.busy = False
+                    shard.busy_session = None
+                    shard.condition.notify_all()
+
+    @instrumented(
+        logger=log.debug, log_arguments=False,
+        message='ContextSyncWorker: _sync_session: Elapsed time: {:0.4f}'
+    )
+    def _sync_session(self, session_name: str, contexts: Dict[str, context_pb2.Context]) -> None:
+        nlu_context_names: Optional[Set[str]] = self.context_mirror.alive_context_names(session_name)
+        if nlu_context_names is None:
+            nlu_context_names = self._list_alive_context_names(session_name=session_name)
+        # all updates of the session are in flight at the same time, we wait once for all of them
+        results: List[ContextWriteResult] = self.context_writer.wait(
+            self.context_writer.write_all(
+                [
+                    context for context_name, context in contexts.items()
+                    if context_name in nlu_context_names and context.lifespan_count > 0
+                ]
+            )
+        )
+        for result in results:
+            if result.ok:
+                self.context_mirror.update_from_write(result.context)
+                self.metrics.increment("context_sync_updates_sent_total")
+            elif result.status_code == grpc.StatusCode.NOT_FOUND:  # the context does not exist anymore
+                self.context_mirror.remove_context(result.context.name)
+
+    def _list_alive_context_names(self, session_name: str) -> Set[str]:
+        # Get the currently active contexts from NLU to prevent updating a decayed or non-existing context
+        list_context_response: ListContextsResponse = self.client_provider().services.contexts.list_contexts(
+            request=ListContextsRequest(session_id=session_name),
+        )
+        if not list_context_response.next_page_token:  # only a complete listing may be mirrored
+            self.context_mirror.set_alive_contexts(session_name=session_name, contexts=list_context_response.contexts)
+        return {c.name for c in list_context_response.contexts if c.lifespan_count > 0}
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Returns:
+            True if all queued updates were written within the timeout
+        """
+        deadline: Optional[float] = time.monotonic() + timeout if timeout is not None else None
+        for shard in self._shards:
+            with shard.condition:
+                remaining: Optional[float] = max(0.0, deadline - time.monotonic()) if deadline is not None else None
+                if not shard.condition.wait_for(lambda: not shard.pending and not shard.busy, timeout=remaining):
+                    return False
+        return True
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """write the remaining updates and stop the worker threads"""
+        if not self._running:
+            return
+        self.flush(timeout=timeout)
+        self._running = False
+        for shard in self._shards:
+            with shard.condition:
+                shard.condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=timeout)
@@ -0,0 +1,194 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import (
+    Any,
+    Callable,
+    FrozenSet,
+    List,
+    Optional,
+)
+
+import grpc
+from ondewo.logging.logger import logger_console as log
+from ondewo.nlu import context_pb2
+from ondewo.nlu.client import Client as NluClient
+
+from ondewo_bpi.config import (
+    ONDEWO_BPI_CONTEXT_WRITE_MAX_ATTEMPTS,
+    ONDEWO_BPI_CONTEXT_WRITE_TIMEOUT_SECONDS,
+)
+from ondewo_bpi.helpers import clear_created_modified
+from ondewo_bpi.metrics import (
+    BPI_METRICS,
+    MetricsRegistry,
+)
+
+# status codes for which another attempt cannot succeed
+NON_RETRIABLE_STATUS_CODES: FrozenSet[grpc.StatusCode] = frozenset(
+    {
+        grpc.StatusCode.NOT_FOUND,
+        grpc.StatusCode.INVALID_ARGUMENT,
+        grpc.StatusCode.PERMISSION_DENIED,
+        grpc.StatusCode.UNAUTHENTICATED,
+        grpc.StatusCode.CANCELLED,
+    }
+)
+
+
+@dataclass
+class ContextWriteResult:
+    context: context_pb2.Context
+    status_code: grpc.StatusCode
+    attempts: int
+    latency_seconds: float
+
+    @property
+    def ok(self) -> bool:
+        return bool(self.status_code == grpc.StatusCode.OK)
+
+
+class ContextWriter:
+    """
+    Writes contexts to CAI with UpdateContext futures instead of blocking calls
+
+    All updates of a turn are in flight at the same time over the shared channel of the nlu-client; a failed attempt
+    is retried from the completion callback of the call, so no thread waits for a retry. The returned
+    concurrent.futures.Future objects can be waited for (concurrent.futures.wait) or awaited in asyncio code
+    (asyncio.wrap_future).
+
+    Metrics: context_write_{sent,succeeded,failed,retries}_total, context_write_latency_seconds_sum (divide by
+    context_write_succeeded_total + context_write_failed_total for the mean) and context_write_last_latency_seconds.
+    """
+
+    def __init__(
+        self,
+        client_provider: Callable[[], NluClient],
+        max_attempts: int = ONDEWO_BPI_CONTEXT_WRITE_MAX_ATTEMPTS,
+        timeout_seconds: float = ONDEWO_BPI_CONTEXT_WRITE_TIMEOUT_SECONDS,
+        metrics: MetricsRegistry = BPI_METRICS,
+    ) -> None:
+        assert max_attempts > 0, "max_attempts must be positive"
+        self.client_provider: Callable[[], NluClient] = client_provider
+        self.max_attempts: int = max_attempts
+        self.timeout_seconds: float = timeout_seconds
+        self.metrics: MetricsRegistry = metrics
+
+    def write(self, context: context_pb2.Context) -> "Future[ContextWriteResult]":
+        """start writing the context, the future never raises but reports failures in its ContextWriteResult"""
+        clear_created_modified(context)
+        result: "Future[ContextWriteResult]" = Future()
+        result.set_running_or_notify_cancel()
+        self._attempt(
+            client=self.client_provider(),
+            request=context_pb2.UpdateContextRequest(context=context),
+            result=result,
+            attempt=1,
+            start=time.monotonic(),
+        )
+        return result
+
+    def write_all(self, contexts: List[context_pb2.Context]) -> List["Future[ContextWriteResult]"]:
+        return [self.write(context) for context in contexts]
+
+    def _attempt(
+        self,
+        client: NluClient,
+        request: context_pb2.UpdateContextRequest,
+        result: "Future[ContextWriteResult]",
+        attempt: int,
+        start: float,
+    ) -> None:
+        self.metrics.increment("context_write_sent_total")
+        try:
+            call: Any = client.services.contexts.stub.UpdateContext.future(
+                request,
+                metadata=client.services.contexts.metadata,
+                timeout=self.timeout_seconds,
+            )
+        except Exception as e:  # e.g. ValueError of a closed channel during shutdown, another attempt cannot help
+            log.warning(f"Context update could not be sent for {request.context.name}: {e}")
+            self._finish(request=request, result=result, attempt=attempt, start=start, status_code=grpc.StatusCode.UNKNOWN)
+            return
+        call.add_done_callback(
+            lambda done_call: self._on_done(
+                client=client, request=request, result=result, attempt=attempt, start=start, call=done_call,
+            )
+        )
+
+    def _on_done(
+        self,
+        client: NluClient,
+        request: context_pb2.UpdateContextRequest,
+        result: "Future[ContextWriteResult]",
+        attempt: int,
+        start: float,
+        call: Any,
+    ) -> None:
+        status_code: grpc.StatusCode = call.code()
+        if status_code != grpc.StatusCode.OK and status_code not in NON_RETRIABLE_STATUS_CODES \
+                and attempt < self.max_attempts:
+            log.warning(f"Context update failed for {request.context.name} with {status_code}, hence retry")
+            self.metrics.increment("context_write_retries_total")
+            self._attempt(client=client, request=request, result=result, attempt=attempt + 1, start=start)
+            return
+        self._finish(request=request, result=result, attempt=attempt, start=start, status_code=status_code)
+
+    def _finish(
+        self,
+        request: context_pb2.UpdateContextRequest,
+        result: "Future[ContextWriteResult]",
+        attempt: int,
+        start: float,
+        status_code: grpc.StatusCode,
+    ) -> None:
+        latency: float = time.monotonic() - start
+        self.metrics.increment("context_write_latency_seconds_sum", latency)
+        self.metrics.set_gauge("context_write_last_latency_seconds", latency)
+        if status_code == grpc.StatusCode.OK:
+            self.metrics.increment("context_write_succeeded_total")
+        else:
+            self.metrics.increment("context_write_failed_total")
+            if status_code != grpc.StatusCode.NOT_FOUND:  # a context which does not exist anymore is not an error
+                log.warning(f"Context update failed for {request.context.name} after {attempt} attempts: {status_code}")
+        result.set_result(
+            ContextWriteResult(
+                context=request.context,
+                status_code=status_code,
+                attempts=attempt,
+                latency_seconds=latency,
+            )
+        )
+
+    def wait(
+        self,
+        futures: List["Future[ContextWriteResult]"],
+        timeout: Optional[float] = None,
+    ) -> List[ContextWriteResult]:
+        """
+        wait once for all writes of a turn
+
+        Args:
+            timeout: seconds to wait for all writes, defaults to the time all attempts of a write may take
+
+        Raises:
+            concurrent.futures.TimeoutError if the writes did not finish within the timeout
+        """
+        if timeout is None:
+            # the attempts of a write follow each other, each with a deadline of timeout_seconds
+            timeout = self.timeout_seconds * self.max_attempts + 1.0
+        deadline: float = time.monotonic() + timeout
+        return [future.result(timeout=max(0.0, deadline - time.monotonic())) for future in futures]
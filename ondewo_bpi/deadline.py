@@ -0,0 +1,176 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import collections
+import dataclasses
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import (
+    Any,
+    Callable,
+    Iterator,
+    Optional,
+)
+
+import grpc
+from ondewo.logging.logger import logger_console as log
+from ondewo.nlu.client import Client as NluClient
+
+# deadlines further away than this are treated as no deadline, grpc reports "infinite" deadlines as a huge number
+_NO_DEADLINE_THRESHOLD_SECONDS: float = 365 * 24 * 3600.0
+
+# absolute deadline (time.monotonic()) of the call currently served, None without a deadline
+_deadline: "ContextVar[Optional[float]]" = ContextVar("bpi_deadline", default=None)
+# servicer context of the call currently served
+_servicer_context: "ContextVar[Optional[Any]]" = ContextVar("bpi_servicer_context", default=None)
+
+
+@contextmanager
+def request_budget(context: Any) -> Iterator[None]:
+    """
+    make the deadline and the cancellation state of the incoming call available to everything it calls
+
+    Args:
+        context: the grpc.ServicerContext (or grpc.aio.ServicerContext) of the incoming call
+    """
+    remaining: Optional[float] = get_context_time_remaining(context)
+    deadline_token = _deadline.set(time.monotonic() + remaining if remaining is not None else None)
+    context_token = _servicer_context.set(context)
+    try:
+        yield
+    finally:
+        _servicer_context.reset(context_token)
+        _deadline.reset(deadline_token)
+
+
+def get_context_time_remaining(context: Any) -> Optional[float]:
+    """
+    Returns:
+        the seconds left until the deadline of the call of the servicer context, None without a deadline
+    """
+    try:
+        remaining: Any = context.time_remaining()
+    except Exception:  # e.g. a context without deadline support in tests
+        return None
+    if not isinstance(remaining, (int, float)) or remaining > _NO_DEADLINE_THRESHOLD_SECONDS:
+        return None
+    return float(remaining)
+
+
+def time_remaining() -> Optional[float]:
+    """
+    Returns:
+        the seconds left until the deadline of the call currently served, None without a deadline
+    """
+    deadline: Optional[float] = _deadline.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def is_abandoned() -> bool:
+    """whether the caller of the call currently served has cancelled it or its deadline has passed"""
+    remaining: Optional[float] = time_remaining()
+    if remaining is not None and remaining <= 0.0:
+        return True
+    context: Optional[Any] = _servicer_context.get()
+    if context is None:
+        return False
+    return not is_context_active(context)
+
+
+def is_context_active(context: Any) -> bool:
+    """whether the call of the grpc.ServicerContext (or grpc.aio.ServicerContext) is still going on"""
+    try:
+        if hasattr(context, "is_active"):
+            return bool(context.is_active())
+        return not context.cancelled()  # grpc.aio.ServicerContext
+    except Exception:
+        return True
+
+
+class _ClientCallDetails(
+    collections.namedtuple(
+        "_ClientCallDetails",
+        ("method", "timeout", "metadata", "credentials", "wait_for_ready", "compression"),
+    ),
+    grpc.ClientCallDetails,
+):
+    pass
+
+
+class DeadlineClientInterceptor(
+    grpc.UnaryUnaryClientInterceptor,
+    grpc.UnaryStreamClientInterceptor,
+    grpc.StreamUnaryClientInterceptor,
+    grpc.StreamStreamClientInterceptor,
+):
+    """
+    Sets the timeout of outgoing calls to the remaining time of the incoming call
+
+    An explicit timeout of the outgoing call is kept if it is shorter. Outside of `request_budget` (e.g. in the
+    context sync threads) the calls are not changed.
+    """
+
+    @staticmethod
+    def _with_budget(client_call_details: grpc.ClientCallDetails) -> grpc.ClientCallDetails:
+        remaining: Optional[float] = time_remaining()
+        if remaining is None:
+            return client_call_details
+        timeout: Optional[float] = client_call_details.timeout
+        return _ClientCallDetails(
+            method=client_call_details.method,
+            timeout=remaining if timeout is None else min(timeout, remaining),
+            metadata=client_call_details.metadata,
+            credentials=client_call_details.credentials,
+            wait_for_ready=getattr(client_call_details, "wait_for_ready", None),
+            compression=getattr(client_call_details, "compression", None),
+        )
+
+    def intercept_unary_unary(self, continuation: Callable, client_call_details: Any, request: Any) -> Any:
+        return continuation(self._with_budget(client_call_details), request)
+
+    def intercept_unary_stream(self, continuation: Callable, client_call_details: Any, request: Any) -> Any:
+        return continuation(self._with_budget(client_call_details), request)
+
+    def intercept_stream_unary(self, continuation: Callable, client_call_details: Any, request_iterator: Any) -> Any:
+        return continuation(self._with_budget(client_call_details), request_iterator)
+
+    def intercept_stream_stream(self, continuation: Callable, client_call_details: Any, request_iterator: Any) -> Any:
+        return continuation(self._with_budget(client_call_details), request_iterator)
+
+
+def with_deadline_propagation(channel: grpc.Channel) -> grpc.Channel:
+    return grpc.intercept_channel(channel, DeadlineClientInterceptor())
+
+
+def install_deadline_propagation(client: NluClient) -> NluClient:
+    """
+    wrap the channels of all services of the nlu-client with the DeadlineClientInterceptor
+
+    The stubs of the nlu-client services are created from their channel on every access, so calls through
+    `client.services.<service>` pick up the deadline of the incoming call from now on. Installing twice is a no-op.
+    """
+    if getattr(client, "_bpi_deadline_propagation", False):
+        return client
+    services: Any = getattr(client, "services", None)
+    if not dataclasses.is_dataclass(services):
+        log.warning("deadline propagation not installed, the client has no nlu-client services")
+        return client
+    for services_field in dataclasses.fields(services):
+        service: Any = getattr(services, services_field.name)
+        if isinstance(getattr(service, "grpc_channel", None), grpc.Channel):
+            service.grpc_channel = with_deadline_propagation(service.grpc_channel)
+    setattr(client, "_bpi_deadline_propagation", True)
+    return client
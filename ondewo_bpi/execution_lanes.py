@@ -0,0 +1,209 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+from dataclasses import (
+    dataclass,
+    field,
+)
+from threading import (
+    BoundedSemaphore,
+    Lock,
+)
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+)
+
+import grpc
+from ondewo.logging.logger import logger_console as log
+
+from ondewo_bpi.interceptor_helpers import (
+    Behavior,
+    abort_resource_exhausted,
+    replace_behavior,
+)
+
+# heavyweight relays which must not starve the conversational path (DetectIntent)
+DEFAULT_ADMIN_LANE_METHODS: List[str] = [
+    "/ondewo.nlu.Agents/ExportAgent",
+    "/ondewo.nlu.Agents/TrainAgent",
+    "/ondewo.nlu.Agents/BuildCache",
+    "/ondewo.nlu.Sessions/ListSessions",
+    "/ondewo.nlu.Utilities/AddTrainingPhrasesFromCSV",
+]
+
+
+@dataclass
+class ExecutionLaneConfig:
+    """
+    Args:
+        name: name of the lane, used in logs and error messages
+        methods: full method names ("/ondewo.nlu.Agents/ExportAgent"), service names ("ondewo.nlu.Agents") or bare
+            method names ("ExportAgent") which are served in this lane
+        max_concurrency: maximum number of calls of the lane that are executed at the same time
+        max_queue_depth: maximum number of calls of the lane waiting for a free slot, further calls are rejected
+    """
+    name: str
+    methods: List[str] = field(default_factory=list)
+    max_concurrency: int = 4
+    max_queue_depth: int = 16
+
+
+DEFAULT_EXECUTION_LANES: List[ExecutionLaneConfig] = [
+    ExecutionLaneConfig(name="admin", methods=DEFAULT_ADMIN_LANE_METHODS, max_concurrency=4, max_queue_depth=16),
+]
+
+
+def parse_execution_lanes(lanes_json: str) -> List[ExecutionLaneConfig]:
+    """
+    parse the lane configuration, e.g.
+        '[{"name": "admin", "methods": ["ondewo.nlu.Agents"], "max_concurrency": 2, "max_queue_depth": 4}]'
+
+    Returns:
+        no lanes for an empty string or '[]', DEFAULT_EXECUTION_LANES for 'default'
+    """
+    if not lanes_json.strip():
+        return []
+    if lanes_json.strip() == "default":
+        return list(DEFAULT_EXECUTION_LANES)
+    return [ExecutionLaneConfig(**lane) for lane in json.loads(lanes_json)]
+
+
+class ExecutionLane:
+    """a concurrency cap with a bounded wait queue"""
+
+    def __init__(self, config: ExecutionLaneConfig) -> None:
+        assert config.max_concurrency > 0, f"lane {config.name}: max_concurrency must be positive"
+        self.config: ExecutionLaneConfig = config
+        self._slots: BoundedSemaphore = BoundedSemaphore(config.max_concurrency)
+        self._waiting: int = 0
+        self._lock: Lock = Lock()
+        self.rejected_calls: int = 0
+
+    @property
+    def name(self) -> str:
+        return self.config.name
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+    def matches(self, method: str) -> bool:
+        _, service_name, method_name = method.split("/", 2)
+        return any(entry in (method, service_name, method_name) for entry in self.config.methods)
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """
+        Args:
+            timeout: maximum time to wait in the queue of the lane, None waits without limit
+
+        Returns:
+            True if a slot was acquired, False if the queue is full or the timeout expired
+        """
+        if self._slots.acquire(blocking=False):
+            return True
+        with self._lock:
+            if self._waiting >= self.config.max_queue_depth:
+                self.rejected_calls += 1
+                return False
+            self._waiting += 1
+        try:
+            acquired: bool = self._slots.acquire(timeout=timeout)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        if not acquired:
+            self.rejected_calls += 1
+        return acquired
+
+    def release(self) -> None:
+        self._slots.release()
+
+
+class ExecutionLanesInterceptor(grpc.ServerInterceptor):
+    """
+    Server interceptor which runs the methods of a lane under the concurrency cap and wait queue of that lane
+
+    With the threaded grpc server a call is always executed by one of the server workers, hence a lane bounds how
+    many workers its methods can occupy (max_concurrency + max_queue_depth). As long as the lanes together stay below
+    the number of server workers, a burst of e.g. agent exports cannot starve DetectIntent. Methods which do not
+    belong to a lane (DetectIntent above all) are not touched at all.
+    """
+
+    def __init__(self, lanes: List[ExecutionLaneConfig], retry_after_ms: int = 1000) -> None:
+        self.lanes: List[ExecutionLane] = [ExecutionLane(config) for config in lanes]
+        self.retry_after_ms: int = retry_after_ms
+        self._lane_by_method: Dict[str, Optional[ExecutionLane]] = {}
+
+    def lane_for_method(self, method: str) -> Optional[ExecutionLane]:
+        if method not in self._lane_by_method:
+            self._lane_by_method[method] = next((lane for lane in self.lanes if lane.matches(method)), None)
+        return self._lane_by_method[method]
+
+    def check_capacity(self, max_workers: int) -> None:
+        """warn if the lanes together can occupy all server workers"""
+        lane_workers: int = sum(lane.config.max_concurrency + lane.config.max_queue_depth for lane in self.lanes)
+        if lane_workers >= max_workers:
+            log.warning(
+                f"execution lanes can occupy {lane_workers} of {max_workers} server workers, "
+                f"DetectIntent is not isolated from lane traffic"
+            )
+
+    def _enter(self, lane: ExecutionLane, context: grpc.ServicerContext) -> None:
+        if not lane.acquire(timeout=context.time_remaining()):
+            log.debug(f"ExecutionLanesInterceptor: lane {lane.name} is saturated, rejecting call")
+            abort_resource_exhausted(
+                context=context,
+                details=f"execution lane {lane.name} is saturated, retry after {self.retry_after_ms} ms",
+                retry_after_ms=self.retry_after_ms,
+            )
+
+    def _wrap_unary_response(self, behavior: Behavior, lane: ExecutionLane) -> Behavior:
+        def wrapper(request_or_iterator: Any, context: grpc.ServicerContext) -> Any:
+            self._enter(lane, context)
+            try:
+                return behavior(request_or_iterator, context)
+            finally:
+                lane.release()
+
+        return wrapper
+
+    def _wrap_stream_response(self, behavior: Behavior, lane: ExecutionLane) -> Behavior:
+        def wrapper(request_or_iterator: Any, context: grpc.ServicerContext) -> Iterator[Any]:
+            self._enter(lane, context)
+            try:
+                yield from behavior(request_or_iterator, context)
+            finally:
+                lane.release()
+
+        return wrapper
+
+    def intercept_service(
+        self,
+        continuation: Callable[[grpc.HandlerCallDetails], Optional[grpc.RpcMethodHandler]],
+        handler_call_details: grpc.HandlerCallDetails,
+    ) -> Optional[grpc.RpcMethodHandler]:
+        handler: Optional[grpc.RpcMethodHandler] = continuation(handler_call_details)
+        lane: Optional[ExecutionLane] = self.lane_for_method(handler_call_details.method)
+        if handler is None or lane is None:
+            return handler
+        return replace_behavior(
+            handler=handler,
+            wrap_unary_response=lambda behavior: self._wrap_unary_response(behavior, lane),  # type: ignore
+            wrap_stream_response=lambda behavior: self._wrap_stream_response(behavior, lane),  # type: ignore
+        )
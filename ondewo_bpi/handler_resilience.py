@@ -0,0 +1,297 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import contextvars
+import functools
+import inspect
+import time
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+)
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass
+from threading import (
+    BoundedSemaphore,
+    Lock,
+)
+from typing import (
+    Any,
+    Callable,
+    List,
+    Optional,
+    Tuple,
+)
+
+from ondewo.logging.logger import logger_console as log
+from ondewo.nlu import (
+    intent_pb2,
+    session_pb2,
+)
+
+from ondewo_bpi.config import ONDEWO_BPI_HANDLER_TIMEOUT_MAX_WORKERS
+from ondewo_bpi.deadline import time_remaining
+from ondewo_bpi.metrics import (
+    BPI_METRICS,
+    MetricsRegistry,
+    get_callable_name,
+)
+from ondewo_bpi.response_merge import merge_changes
+
+
+@dataclass(frozen=True)
+class HandlerPolicy:
+    """
+    Limits for one intent or trigger handler, see `with_policy`
+
+    Attributes:
+        timeout_seconds: the handler is given up after this time (also after the deadline of the call)
+        max_concurrency: calls of the handler running at the same time (bulkhead), further calls are skipped
+        failure_threshold: consecutive failures (errors, timeouts) which open the circuit breaker
+        reset_timeout_seconds: time the circuit stays open before one trial call is let through
+        fallback: called like the handler when it is skipped or fails, returns the response to use; by default the
+            unmodified response is used
+        name: name of the handler in the metrics, defaults to its qualified name
+    """
+    timeout_seconds: Optional[float] = None
+    max_concurrency: Optional[int] = None
+    failure_threshold: Optional[int] = None
+    reset_timeout_seconds: float = 30.0
+    fallback: Optional[Callable] = None
+    name: Optional[str] = None
+
+
+class CircuitBreaker:
+    """
+    closed -> (failure_threshold consecutive failures) -> open -> (reset_timeout_seconds) -> half open: one trial call,
+    its success closes the circuit again and its failure opens it for another reset_timeout_seconds
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout_seconds: float) -> None:
+        self.failure_threshold: int = failure_threshold
+        self.reset_timeout_seconds: float = reset_timeout_seconds
+        self.failures: int = 0
+        self.opened_at: Optional[float] = None
+        self._trial_running: bool = False
+        self._lock: Lock = Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._trial_running or time.monotonic() - self.opened_at < self.reset_timeout_seconds:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+
+_TIMEOUT_EXECUTOR: Optional[ThreadPoolExecutor] = None
+_TIMEOUT_EXECUTOR_LOCK: Lock = Lock()
+
+
+def _get_timeout_executor() -> ThreadPoolExecutor:
+    """threads for synchronous handlers with a timeout, a timed out handler keeps its thread until it returns"""
+    global _TIMEOUT_EXECUTOR
+    with _TIMEOUT_EXECUTOR_LOCK:
+        if _TIMEOUT_EXECUTOR is None:
+            _TIMEOUT_EXECUTOR = ThreadPoolExecutor(
+                max_workers=ONDEWO_BPI_HANDLER_TIMEOUT_MAX_WORKERS,
+                thread_name_prefix="bpi_handler_timeout",
+            )
+        return _TIMEOUT_EXECUTOR
+
+
+class _HandlerGuard:
+    """state and bookkeeping shared by the synchronous and the asynchronous wrapper of a handler"""
+
+    def __init__(self, handler: Callable, policy: HandlerPolicy, metrics: MetricsRegistry) -> None:
+        self.handler: Callable = handler
+        self.policy: HandlerPolicy = policy
+        self.metrics: MetricsRegistry = metrics
+        self.label: str = f'{{handler="{policy.name or get_callable_name(handler)}"}}'
+        self.breaker: Optional[CircuitBreaker] = CircuitBreaker(
+            failure_threshold=policy.failure_threshold,
+            reset_timeout_seconds=policy.reset_timeout_seconds,
+        ) if policy.failure_threshold else None
+        self.bulkhead: Optional[BoundedSemaphore] = BoundedSemaphore(
+            policy.max_concurrency
+        ) if policy.max_concurrency else None
+
+    def increment(self, name: str, value: float = 1) -> None:
+        self.metrics.increment(name + self.label, value)
+
+    def admit(self) -> bool:
+        """
+        Returns:
+            whether the handler may be called now; if so `release` has to be called once it returned
+        """
+        if self.bulkhead is not None and not self.bulkhead.acquire(blocking=False):
+            self.increment("handler_rejected_total")
+            return False
+        if self.breaker is not None and not self.breaker.allow():
+            self.increment("handler_circuit_open_total")
+            self.release()
+            return False
+        return True
+
+    def release(self) -> None:
+        if self.bulkhead is not None:
+            self.bulkhead.release()
+
+    def get_timeout(self) -> Optional[float]:
+        timeouts: List[float] = [
+            timeout for timeout in [self.policy.timeout_seconds, time_remaining()] if timeout is not None
+        ]
+        return max(min(timeouts), 0.0) if timeouts else None
+
+    def record(self, started_at: float, error: Optional[BaseException]) -> None:
+        self.increment("handler_calls_total")
+        self.increment("handler_latency_seconds_sum", time.monotonic() - started_at)
+        if error is None:
+            if self.breaker is not None:
+                self.breaker.record_success()
+            return
+        if isinstance(error, (FutureTimeoutError, asyncio.TimeoutError)):
+            self.increment("handler_timeouts_total")
+            log.warning(f"handler {self.label} timed out, it is skipped")
+        else:
+            self.increment("handler_failures_total")
+            log.exception(f"handler {self.label} failed, it is skipped: {error}")
+        if self.breaker is not None:
+            was_open: bool = self.breaker.is_open
+            self.breaker.record_failure()
+            if self.breaker.is_open and not was_open:
+                self.increment("handler_circuit_opened_total")
+
+    def prepare(
+        self,
+        response: session_pb2.DetectIntentResponse,
+        args: Tuple[Any, ...],
+    ) -> Tuple[session_pb2.DetectIntentResponse, Tuple[Any, ...]]:
+        """
+        Returns:
+            a working copy of the response and the arguments for the handler; a fulfillment message of the response
+            (first argument of trigger handlers) is replaced by the same message of the copy
+        """
+        working_copy: session_pb2.DetectIntentResponse = session_pb2.DetectIntentResponse()
+        working_copy.CopyFrom(response)
+        if args and isinstance(args[0], intent_pb2.Intent.Message):
+            messages: Any = response.query_result.fulfillment_messages
+            for position in range(len(messages)):
+                if messages[position] is args[0] or messages[position] == args[0]:
+                    args = (working_copy.query_result.fulfillment_messages[position], *args[1:])
+                    break
+        return working_copy, args
+
+    @staticmethod
+    def apply(
+        response: session_pb2.DetectIntentResponse,
+        working_copy: session_pb2.DetectIntentResponse,
+        result: Any,
+    ) -> Any:
+        """take over the changes of a successful handler call into the response which was passed in"""
+        if result is None or result is working_copy:
+            base: session_pb2.DetectIntentResponse = session_pb2.DetectIntentResponse()
+            base.CopyFrom(response)
+            merge_changes(target=response, base=base, changed=working_copy)
+            return None if result is None else response
+        return result
+
+    def fall_back(self, response: session_pb2.DetectIntentResponse, args: Tuple[Any, ...]) -> Any:
+        if self.policy.fallback is not None:
+            return self.policy.fallback(response, *args)
+        return response
+
+
+def with_policy(
+    handler: Callable,
+    policy: HandlerPolicy,
+    metrics: MetricsRegistry = BPI_METRICS,
+) -> Callable:
+    """
+    Wrap an intent handler (response, client) or trigger handler (response, message, trigger, found_triggers) so that
+    it is skipped, and the unmodified response (or the fallback) is returned, if it fails, times out, its bulkhead is
+    full or its circuit is open. The handler works on a copy of the response, its changes are only taken over once it
+    returned successfully. Coroutine handlers give a coroutine function.
+
+    Metrics (labelled with handler="<name>"): handler_{calls,failures,timeouts,rejected,circuit_open,
+    circuit_opened}_total and handler_latency_seconds_sum.
+    """
+    guard: _HandlerGuard = _HandlerGuard(handler=handler, policy=policy, metrics=metrics)
+
+    if inspect.iscoroutinefunction(handler):
+        @functools.wraps(handler)
+        async def guarded_handler_async(response: session_pb2.DetectIntentResponse, *args: Any) -> Any:
+            if not guard.admit():
+                return guard.fall_back(response, args)
+            working_copy, handler_args = guard.prepare(response, args)
+            started_at: float = time.monotonic()
+            try:
+                result: Any = await asyncio.wait_for(handler(working_copy, *handler_args), timeout=guard.get_timeout())
+            except Exception as e:
+                guard.record(started_at=started_at, error=e)
+                return guard.fall_back(response, args)
+            finally:
+                guard.release()
+            guard.record(started_at=started_at, error=None)
+            return guard.apply(response, working_copy, result)
+
+        guarded_handler_async.handler_guard = guard  # type: ignore
+        return guarded_handler_async
+
+    @functools.wraps(handler)
+    def guarded_handler(response: session_pb2.DetectIntentResponse, *args: Any) -> Any:
+        if not guard.admit():
+            return guard.fall_back(response, args)
+        working_copy, handler_args = guard.prepare(response, args)
+        started_at: float = time.monotonic()
+        timeout: Optional[float] = guard.get_timeout()
+        try:
+            if timeout is None:
+                try:
+                    result: Any = handler(working_copy, *handler_args)
+                finally:
+                    guard.release()
+            else:
+                # the bulkhead stays taken until the handler really returned, also after a timeout
+                future: "Future[Any]" = _get_timeout_executor().submit(
+                    contextvars.copy_context().run, handler, working_copy, *handler_args,
+                )
+                future.add_done_callback(lambda _: guard.release())
+                result = future.result(timeout=timeout)
+        except Exception as e:
+            guard.record(started_at=started_at, error=e)
+            return guard.fall_back(response, args)
+        guard.record(started_at=started_at, error=None)
+        return guard.apply(response, working_copy, result)
+
+    guarded_handler.handler_guard = guard  # type: ignore
+    return guarded_handler
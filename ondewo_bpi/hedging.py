@@ -0,0 +1,174 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import math
+import time
+from collections import deque
+from queue import (
+    Empty,
+    Queue,
+)
+from threading import Lock
+from typing import (
+    Any,
+    Deque,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import grpc
+from ondewo.logging.logger import logger_console as log
+from ondewo.nlu import session_pb2
+from ondewo.nlu.session_pb2_grpc import SessionsStub
+
+from ondewo_bpi.config import (
+    ONDEWO_BPI_HEDGING_MAX_RATIO,
+    ONDEWO_BPI_HEDGING_MIN_DELAY_SECONDS,
+    ONDEWO_BPI_HEDGING_MIN_SAMPLES,
+    ONDEWO_BPI_HEDGING_PERCENTILE,
+)
+from ondewo_bpi.metrics import (
+    BPI_METRICS,
+    MetricsRegistry,
+)
+
+
+class LatencyWindow:
+    """latencies of the most recent calls, to derive a percentile-based hedging delay"""
+
+    def __init__(self, size: int = 1000) -> None:
+        self._latencies: Deque[float] = deque(maxlen=size)
+        self._lock: Lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._latencies)
+
+    def add(self, latency_seconds: float) -> None:
+        with self._lock:
+            self._latencies.append(latency_seconds)
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        with self._lock:
+            if not self._latencies:
+                return None
+            ordered: List[float] = sorted(self._latencies)
+        index: int = min(len(ordered) - 1, max(0, math.ceil(percentile / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+
+class HedgedDetectIntent:
+    """
+    DetectIntent to CAI with an optional hedge request
+
+    If the primary call has not answered after the `percentile` latency of the recent calls, an identical request is
+    sent over the hedge channel (another replica, or at least another connection). The first successful answer is
+    returned and the other call is cancelled.
+
+    Be aware that DetectIntent is not idempotent: when both calls reach CAI, the turn may be processed twice (e.g.
+    context lifespans are decremented twice). Hence hedging is off by default, it does not start before
+    `min_samples` latencies were observed, the caller can veto a hedge (e.g. while context writes of the session
+    are pending) and at most `max_ratio` of the recent calls are hedged.
+
+    Metrics: detect_intent_hedge_{calls,sent,wins,skipped}_total and detect_intent_hedge_delay_seconds.
+    """
+
+    def __init__(
+        self,
+        primary_stub: SessionsStub,
+        hedge_stub: SessionsStub,
+        metadata: Sequence[Tuple[str, str]],
+        percentile: float = ONDEWO_BPI_HEDGING_PERCENTILE,
+        min_delay_seconds: float = ONDEWO_BPI_HEDGING_MIN_DELAY_SECONDS,
+        min_samples: int = ONDEWO_BPI_HEDGING_MIN_SAMPLES,
+        max_ratio: float = ONDEWO_BPI_HEDGING_MAX_RATIO,
+        metrics: MetricsRegistry = BPI_METRICS,
+    ) -> None:
+        self.primary_stub: SessionsStub = primary_stub
+        self.hedge_stub: SessionsStub = hedge_stub
+        self.metadata: Sequence[Tuple[str, str]] = metadata
+        self.percentile: float = percentile
+        self.min_delay_seconds: float = min_delay_seconds
+        self.min_samples: int = min_samples
+        self.max_ratio: float = max_ratio
+        self.metrics: MetricsRegistry = metrics
+        self.latencies: LatencyWindow = LatencyWindow()
+        # True for every recent call which was hedged, to cap the share of hedged calls
+        self._recent_hedges: Deque[bool] = deque(maxlen=1000)
+
+    def hedging_delay(self) -> Optional[float]:
+        """
+        Returns:
+            the time after which a hedge is sent, None while too few latencies were observed
+        """
+        if len(self.latencies) < self.min_samples:
+            return None
+        delay: float = max(self.min_delay_seconds, self.latencies.percentile(self.percentile) or 0.0)
+        self.metrics.set_gauge("detect_intent_hedge_delay_seconds", delay)
+        return delay
+
+    def _hedge_budget_left(self) -> bool:
+        if not self._recent_hedges:
+            return True
+        return sum(self._recent_hedges) / len(self._recent_hedges) < self.max_ratio
+
+    def detect_intent(
+        self,
+        request: session_pb2.DetectIntentRequest,
+        allow_hedge: bool = True,
+        timeout: Optional[float] = None,
+    ) -> session_pb2.DetectIntentResponse:
+        self.metrics.increment("detect_intent_hedge_calls_total")
+        start: float = time.monotonic()
+        finished: "Queue[Tuple[str, Any]]" = Queue()
+        primary: Any = self.primary_stub.DetectIntent.future(request, metadata=self.metadata, timeout=timeout)
+        primary.add_done_callback(lambda call: finished.put(("primary", call)))
+        calls: List[Tuple[str, Any]] = [("primary", primary)]
+
+        delay: Optional[float] = self.hedging_delay()
+        hedged: bool = False
+        first: Optional[Tuple[str, Any]] = None
+        if delay is not None:
+            try:
+                first = finished.get(timeout=delay)
+            except Empty:  # the primary is slow
+                if allow_hedge and self._hedge_budget_left():
+                    remaining: Optional[float] = (
+                        max(0.0, timeout - (time.monotonic() - start)) if timeout is not None else None
+                    )
+                    hedge: Any = self.hedge_stub.DetectIntent.future(
+                        request, metadata=self.metadata, timeout=remaining,
+                    )
+                    hedge.add_done_callback(lambda call: finished.put(("hedge", call)))
+                    calls.append(("hedge", hedge))
+                    hedged = True
+                    self.metrics.increment("detect_intent_hedge_sent_total")
+                    log.debug(f"HedgedDetectIntent: no answer after {delay:.3f}s, hedging {request.session}")
+                else:
+                    self.metrics.increment("detect_intent_hedge_skipped_total")
+        self._recent_hedges.append(hedged)
+
+        for _ in range(len(calls)):
+            name, call = first if first is not None else finished.get()
+            first = None
+            if call.code() == grpc.StatusCode.OK:
+                for other_name, other_call in calls:
+                    if other_name != name:
+                        other_call.cancel()
+                if name == "hedge":
+                    self.metrics.increment("detect_intent_hedge_wins_total")
+                self.latencies.add(time.monotonic() - start)
+                return call.result()  # type: ignore
+        # every call failed: raise the error of the primary call
+        return primary.result()  # type: ignore
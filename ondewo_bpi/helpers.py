@@ -38,7 +38,6 @@ from typing import (
 import pandas as pd
 import six
 from grpc._channel import _InactiveRpcError  # noqa
-from ondewo.logging.decorators import Timer
 from ondewo.nlu import (
     context_pb2,
     session_pb2,
@@ -46,6 +45,8 @@ from ondewo.nlu import (
 from ondewo.nlu.client import Client
 from py._path.local import LocalPath  # noqa
 
+from ondewo_bpi.instrumentation import instrumented
+
 T = TypeVar("T")
 
 UUID4_RGX: str = r'[^\W_]{8}-[^\W_]{4}-[^\W_]{4}-[^\W_]{4}-[^\W_]{12}'
@@ -69,7 +70,22 @@ from ondewo.logging.logger import logger_console as log
 CREATED_BY_MODIFIED_BY_CREATED_AT_MODIFIED_AT_SET: Set[str] = {'created_by', 'modified_by', 'created_at', 'modified_at'}
 
 
-@Timer(
+def _get_current_turn() -> Any:
+    """the SessionStateTurn served in the current thread (or asyncio task), None outside of DetectIntent"""
+    # imported on use: ondewo_bpi.session_state_cache imports ondewo_bpi.config, which imports these helpers, i.e. a
+    # module level import fails on whichever of the modules is imported first
+    from ondewo_bpi.session_state_cache import get_current_turn
+    return get_current_turn()
+
+
+def _record_context_write(context: context_pb2.Context) -> None:
+    """record a context the helpers wrote to CAI in the SessionContextMirror, e.g. the response cache must see it"""
+    # imported on use for the same reason as in _get_current_turn
+    from ondewo_bpi.context_mirror import SESSION_CONTEXT_MIRROR
+    SESSION_CONTEXT_MIRROR.update_from_write(context)
+
+
+@instrumented(
     logger=log.debug, log_arguments=False,
     message='BPI helpers.py: add_params_to_cai_context: Elapsed time: {:0.4f}'
 )
@@ -87,7 +103,7 @@ def add_params_to_cai_context(
     )
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: _add_params_to_cai_context: Elapsed time: {:0.4f}'
 )
@@ -105,7 +121,25 @@ def _add_params_to_cai_context(
             "tags": ["parameters", "contexts"],
         }
     )
-    parameters = create_parameter_dict(parameter_dict=params)
+    parameters: Dict[str, context_pb2.Context.Parameter] = create_parameter_dict(parameter_dict=params)
+    turn: Any = _get_current_turn()
+    if turn is not None:  # the context is written once at the end of the turn
+        context_name: str = f"{session}/contexts/{context}"
+        existing_context: Optional[context_pb2.Context] = turn.read(context_name)
+        if existing_context is not None:
+            for k, v in parameters.items():
+                existing_context.parameters[k].CopyFrom(v)
+            existing_context.ClearField("created_at")
+            existing_context.ClearField("modified_at")
+            existing_context.ClearField("created_by")
+            existing_context.ClearField("modified_by")
+            turn.write(existing_context, exists=True)
+        else:
+            turn.write(
+                context_pb2.Context(name=context_name, lifespan_count=100, parameters=parameters, lifespan_time=1000),
+                exists=False,
+            )
+        return parameters
     try:
         request = context_pb2.GetContextRequest(name=f"{session}/contexts/{context}")
         existing_context = client.services.contexts.get_context(request=request)
@@ -118,6 +152,7 @@ def _add_params_to_cai_context(
         existing_context.ClearField('created_by')
         existing_context.ClearField('modified_by')
         client.services.contexts.update_context(request=context_pb2.UpdateContextRequest(context=existing_context))
+        _record_context_write(existing_context)
 
     except _InactiveRpcError:
         context = context_pb2.Context(
@@ -133,11 +168,12 @@ def _add_params_to_cai_context(
         client.services.contexts.create_context(
             request=context_pb2.CreateContextRequest(session_id=f'{session}', context=context)
         )
+        _record_context_write(context)
 
     return parameters
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: delete_param_from_cai_context: Elapsed time: {:0.4f}'
 )
@@ -157,6 +193,22 @@ def delete_param_from_cai_context(
     )
     session: str = get_session_from_response(response=response)
     context_name: str = f"{session}/contexts/{context}"
+    turn: Any = _get_current_turn()
+    if turn is not None:  # the context is deleted and created again once at the end of the turn
+        turn_context: Optional[context_pb2.Context] = turn.read(context_name)
+        if turn_context is None or param_name not in turn_context.parameters:
+            log.warning(
+                {
+                    "message": "tried to delete param that didnt exist",
+                    "parameter": param_name,
+                    "context": context,
+                    "tags": ["parameters", "contexts"],
+                }
+            )
+            return
+        del turn_context.parameters[param_name]
+        turn.write(turn_context, exists=True, recreate=True)
+        return
     existing_context: context_pb2.Context = client.services.contexts.get_context(
         request=context_pb2.GetContextRequest(name=context_name),
     )
@@ -166,6 +218,7 @@ def delete_param_from_cai_context(
         client.services.contexts.create_context(
             request=context_pb2.CreateContextRequest(session_id=session, context=existing_context)
         )
+        _record_context_write(existing_context)
     except KeyError:
         log.exception(
             {
@@ -177,7 +230,7 @@ def delete_param_from_cai_context(
         )
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: detect_intent: Elapsed time: {:0.4f}'
 )
@@ -197,7 +250,7 @@ def detect_intent(
     return result
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: get_detect_intent_request: Elapsed time: {:0.4f}'
 )
@@ -217,7 +270,7 @@ def get_detect_intent_request(
     return request
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: create_parameter_dict: Elapsed time: {:0.4f}'
 )
@@ -258,7 +311,7 @@ def create_parameter_dict(
 
 # This function creates a detect intent request that will trigger a specific intent
 #   using the 'exact intent' trigger
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: trigger_intent: Elapsed time: {:0.4f}'
 )
@@ -302,7 +355,7 @@ def trigger_intent(
     return result
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: create_context_struct: Elapsed time: {:0.4f}'
 )
@@ -320,7 +373,7 @@ def create_context(
 
 
 # This function deletes periods from the text in a request
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: strip_final_periods_from_request: Elapsed time: {:0.4f}'
 )
@@ -329,7 +382,7 @@ def strip_final_periods_from_request(request: session_pb2.DetectIntentRequest) -
     return request
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: get_session_from_response: Elapsed time: {:0.4f}'
 )
@@ -337,7 +390,7 @@ def get_session_from_response(response: session_pb2.DetectIntentResponse) -> str
     return response.query_result.diagnostic_info["sessionId"]  # type: ignore
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: remove_dir: Elapsed time: {:0.4f}'
 )
@@ -356,7 +409,7 @@ def remove_dir(dir_path: str, exception: bool = True) -> None:
     is_not_dir(dir_path=dir_path, exception=exception)
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: remove_dir_for_file_path: Elapsed time: {:0.4f}'
 )
@@ -379,7 +432,7 @@ def remove_dir_for_file_path(file_path: Union[str, LocalPath]) -> None:
                         raise
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: remove_file_for_file_path: Elapsed time: {:0.4f}'
 )
@@ -393,7 +446,7 @@ def remove_file_for_file_path(file_path: Union[str, LocalPath], exception: bool
                 raise e
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: create_dir_for_file_path: Elapsed time: {:0.4f}'
 )
@@ -406,7 +459,7 @@ def create_dir_for_file_path(file_path: Union[str, LocalPath]) -> None:
             raise
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: relative_normpath: Elapsed time: {:0.4f}'
 )
@@ -418,7 +471,7 @@ def relative_normpath(f: Optional[str], path: Union[str, LocalPath]) -> Optional
         return None
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: create_dir: Elapsed time: {:0.4f}'
 )
@@ -437,7 +490,7 @@ def create_dir(dir_path: Union[str, LocalPath], exception: bool = True) -> None:
     is_dir(dir_path, exception=exception)
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: create_dir_for_file: Elapsed time: {:0.4f}'
 )
@@ -454,7 +507,7 @@ def create_dir_for_file(file_path: Union[str, LocalPath]) -> Optional[str]:
     return None
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: list_directory: Elapsed time: {:0.4f}'
 )
@@ -484,7 +537,7 @@ def list_directory(path: Union[str, LocalPath]) -> List[str]:
         )
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: list_files: Elapsed time: {:0.4f}'
 )
@@ -494,7 +547,7 @@ def list_files(path: Union[str, LocalPath]) -> List[str]:
     return [fn for fn in list_directory(path) if os.path.isfile(fn)]
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: list_subdirectories: Elapsed time: {:0.4f}'
 )
@@ -504,7 +557,7 @@ def list_subdirectories(path: Union[str, LocalPath]) -> List[str]:
     return [fn for fn in glob.glob(os.path.join(path, '*')) if os.path.isdir(fn)]
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: list_to_str: Elapsed time: {:0.4f}'
 )
@@ -512,7 +565,7 @@ def list_to_str(l: List[str], delim: str = ", ", quote: str = "'") -> str:  # no
     return delim.join([quote + e + quote for e in l])
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: is_file: Elapsed time: {:0.4f}'
 )
@@ -539,7 +592,7 @@ def is_file(
     return file_exists
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: is_not_dir: Elapsed time: {:0.4f}'
 )
@@ -550,7 +603,7 @@ def is_not_dir(dir_path: Union[str, LocalPath], exception: object = False) -> bo
     return dir_exists
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: is_dir: Elapsed time: {:0.4f}'
 )
@@ -561,7 +614,7 @@ def is_dir(dir_path: Union[str, LocalPath], exception: bool = False) -> bool:
     return dir_exists
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: json_to_string: Elapsed time: {:0.4f}'
 )
@@ -569,7 +622,7 @@ def json_to_string(json_dict: Any, indent: int = 4, ensure_ascii: bool = False,
     return json.dumps(json_dict, indent=indent, ensure_ascii=ensure_ascii, **kwargs)
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: write_json_to_file: Elapsed time: {:0.4f}'
 )
@@ -579,7 +632,7 @@ def write_json_to_file(file_path: Union[str, LocalPath], json_dict: Any, **kwarg
     return json_dict
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: write_pb_message_to_file: Elapsed time: {:0.4f}'
 )
@@ -590,7 +643,7 @@ def write_pb_message_to_file(file_path: Union[str, LocalPath], message: Message)
         f.write(message.SerializeToString())
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: write_text_to_file: Elapsed time: {:0.4f}'
 )
@@ -611,7 +664,7 @@ def write_text_to_file(file_path: Union[str, LocalPath], text: str) -> str:
     return text
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: is_list_of_strings: Elapsed time: {:0.4f}'
 )
@@ -623,7 +676,7 @@ def is_list_of_strings(lst: Any) -> bool:
         return False
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: read_text_file: Elapsed time: {:0.4f}'
 )
@@ -641,7 +694,7 @@ def read_text_file(filename: Union[str, LocalPath], encoding: str = "utf-8-sig")
     return content
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: load_pickle: Elapsed time: {:0.4f}'
 )
@@ -650,7 +703,7 @@ def load_pickle(pickle_file: Union[str, LocalPath], access_mode: str = 'rb') ->
         return pickle.load(f)  # type:ignore
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: create_if_not_exists_containing_folder: Elapsed time: {:0.4f}'
 )
@@ -666,7 +719,7 @@ def create_if_not_exists_containing_folder(file_path: Union[str, LocalPath]) ->
     Path(os.path.dirname(file_path)).mkdir(parents=True, exist_ok=True)
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: dump_pickle: Elapsed time: {:0.4f}'
 )
@@ -677,7 +730,7 @@ def dump_pickle(obj: Any, pickle_file: Union[str, LocalPath], access_mode: str =
 
 
 # TODO(jober) typing should be read_json_file(filename: str) -> Union[dict, list] !!!
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: read_json_file: Elapsed time: {:0.4f}'
 )
@@ -696,7 +749,7 @@ def read_json_file(filename: Union[str, LocalPath]) -> Any:
         )
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: read_list_from_file: Elapsed time: {:0.4f}'
 )
@@ -713,7 +766,7 @@ def read_list_from_file(filename: Union[str, LocalPath]) -> List[str]:
         )
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: read_csv_file: Elapsed time: {:0.4f}'
 )
@@ -727,7 +780,7 @@ def read_csv_file(input_path: Union[str, LocalPath]) -> List[str]:
     return result
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: dict_to_dataframe: Elapsed time: {:0.4f}'
 )
@@ -767,7 +820,7 @@ def dict_to_dataframe(
     return df
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: write_dict_to_csv: Elapsed time: {:0.4f}'
 )
@@ -785,7 +838,7 @@ def write_dict_to_csv(
     df.to_csv(output_path, index=index)
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: is_url: Elapsed time: {:0.4f}'
 )
@@ -795,7 +848,7 @@ def is_url(resource_name: str) -> bool:
     return URL_REGEX.match(resource_name) is not None
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: log_keep_max_num: Elapsed time: {:0.4f}'
 )
@@ -807,7 +860,7 @@ def log_keep_max_num(log_path: Union[str, LocalPath]) -> None:
         os.remove(log_path + '/' + old_log)
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: get_int_from_env: Elapsed time: {:0.4f}'
 )
@@ -823,7 +876,7 @@ def get_int_from_env(env_variable_name: str, default_value: int = 0) -> int:
         return default_value
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: get_float_from_env: Elapsed time: {:0.4f}'
 )
@@ -839,7 +892,7 @@ def get_float_from_env(env_variable_name: str, default_value: float = 0.0) -> fl
         return default_value
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: get_bool_from_env: Elapsed time: {:0.4f}'
 )
@@ -848,7 +901,7 @@ def get_bool_from_env(env_variable_name: str, default_value: bool = False) -> bo
     return bool_value
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: get_str_from_env: Elapsed time: {:0.4f}'
 )
@@ -858,7 +911,7 @@ def get_str_from_env(env_variable_name: str, default_value: str = "") -> str:
     return str_value
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: get_context_and_decay_from_context_name: Elapsed time: {:0.4f}'
 )
@@ -879,7 +932,7 @@ def get_context_and_decay_from_context_name(context_name: str) -> Tuple[str, Dic
     }
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: safe_stringify: Elapsed time: {:0.4f}'
 )
@@ -898,7 +951,7 @@ def safe_stringify(dubious_object: Union[str, dict]) -> str:
         return dubious_object
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: find_key_in_nested_json: Elapsed time: {:0.4f}'
 )
@@ -930,7 +983,7 @@ def find_key_in_nested_json(json_object: Union[List[Any], Dict[str, Any]], key:
     return None
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: list_directories_in_directory: Elapsed time: {:0.4f}'
 )
@@ -944,7 +997,7 @@ def list_directories_in_directory(path: str) -> List[str]:
     return directory_names
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: list_files_in_directory_without_directories: Elapsed time: {:0.4f}'
 )
@@ -958,7 +1011,7 @@ def list_files_in_directory_without_directories(path: str) -> List[str]:
     return file_names
 
 
-@Timer(
+@instrumented(
     logger=log.debug, log_arguments=True,
     message='BPI helpers.py: clear_created_modified: Elapsed time: {:0.4f}'
 )
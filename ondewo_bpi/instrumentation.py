@@ -0,0 +1,163 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import functools
+import inspect
+import itertools
+import logging
+import time
+import traceback
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import get_ident
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    Optional,
+)
+
+from ondewo.logging.constants import START
+from ondewo.logging.decorators import (
+    log_args_kwargs_results,
+    log_exception,
+)
+from ondewo.logging.logger import logger_console as log
+
+INSTRUMENTATION_OFF: str = "off"
+INSTRUMENTATION_SAMPLED: str = "sampled"
+INSTRUMENTATION_FULL: str = "full"
+_MODES: Dict[str, int] = {INSTRUMENTATION_OFF: 0, INSTRUMENTATION_SAMPLED: 1, INSTRUMENTATION_FULL: 2}
+
+# read by every instrumented call, set by configure_instrumentation (from ondewo_bpi.config)
+_mode: int = _MODES[INSTRUMENTATION_FULL]
+_sample_every: int = 100
+_sample_counter: Iterator[int] = itertools.count()
+# whether the functions called for the current request are instrumented, None outside of a request
+_request_sampled: "ContextVar[Optional[bool]]" = ContextVar("bpi_instrumentation_sampled", default=None)
+
+
+def configure_instrumentation(mode: str, sample_every: int = 100) -> None:
+    """
+    Args:
+        mode: "off" (no timing and argument logs), "sampled" (the calls of one in `sample_every` requests) or "full"
+        sample_every: sampling rate of the "sampled" mode
+    """
+    global _mode, _sample_every
+    if mode not in _MODES:
+        raise ValueError(f"unknown instrumentation mode {mode}, use one of {', '.join(_MODES)}")
+    if sample_every < 1:
+        raise ValueError("sample_every must be positive")
+    _mode = _MODES[mode]
+    _sample_every = sample_every
+
+
+def _take_sample() -> bool:
+    return _mode == 2 or (_mode == 1 and next(_sample_counter) % _sample_every == 0)
+
+
+@contextmanager
+def instrumented_request() -> Iterator[bool]:
+    """
+    decide once for a request (e.g. a DetectIntent call) whether the instrumented functions it calls log, so a sampled
+    request is logged completely
+
+    Yields:
+        whether the request is sampled
+    """
+    sampled: bool = _take_sample()
+    token = _request_sampled.set(sampled)
+    try:
+        yield sampled
+    finally:
+        _request_sampled.reset(token)
+
+
+def _is_sampled() -> bool:
+    """sampling decision of a call in the "sampled" mode: the one of its request, else one in `sample_every` calls"""
+    sampled: Optional[bool] = _request_sampled.get()
+    return _take_sample() if sampled is None else sampled
+
+
+def _always() -> bool:
+    return True
+
+
+def _get_enabled_check(logger: Callable) -> Callable[[], bool]:
+    """
+    Returns:
+        whether a logging method like `log.debug` of a logging.Logger currently emits records (always true for other
+        callables)
+    """
+    owner: Any = getattr(logger, "__self__", None)
+    level: Any = logging.getLevelName(getattr(logger, "__name__", "").upper())
+    if not isinstance(owner, logging.Logger) or not isinstance(level, int):
+        return _always
+    return functools.partial(owner.isEnabledFor, level)
+
+
+def instrumented(
+    message: str,
+    logger: Callable = log.debug,
+    log_arguments: bool = False,
+    argument_max_length: int = 10000,
+) -> Callable[[Callable], Callable]:
+    """
+    Decorator logging the start, the duration (`message` is formatted with the elapsed time, the function name and the
+    thread id), the arguments and result (if `log_arguments`) and the exceptions of a synchronous function, like
+    ondewo.logging.decorators.Timer.
+
+    Which calls are logged depends on the mode of configure_instrumentation; nothing is logged (or formatted) if the
+    logger does not emit its level. A call which is not logged costs one global lookup (off) or one ContextVar lookup
+    (sampled) more than the plain call, see benchmarks/instrumentation_overhead.py.
+    """
+
+    def decorator(function: Callable) -> Callable:
+        assert not inspect.iscoroutinefunction(function), "instrumented supports synchronous functions only"
+        name: str = function.__name__
+        parameters: Any = list(inspect.signature(function).parameters)
+        # like Timer, the instance or class of methods is not logged as an argument
+        skipped_arguments: int = 1 if parameters and parameters[0] in ("self", "cls") else 0
+        is_logger_enabled: Callable[[], bool] = _get_enabled_check(logger)
+
+        def call_instrumented(args: Any, kwargs: Any) -> Any:
+            thread_id: int = get_ident()
+            logger({"message": START.format(name, thread_id)})
+            started_at: float = time.perf_counter()
+            try:
+                result: Any = function(*args, **kwargs)
+            except Exception as e:
+                log_exception(type(e), next(iter(e.args), None), traceback.format_exc(), name, logger)
+                elapsed_time: float = time.perf_counter() - started_at
+                logger({"message": message.format(elapsed_time, name, thread_id), "duration": elapsed_time,
+                        "tags": ["timing"]})
+                raise
+            elapsed_time = time.perf_counter() - started_at
+            if log_arguments:
+                log_args_kwargs_results(
+                    function, result, argument_max_length, logger, *args[skipped_arguments:], **kwargs,
+                )
+            logger({"message": message.format(elapsed_time, name, thread_id), "duration": elapsed_time,
+                    "tags": ["timing"]})
+            return result
+
+        @functools.wraps(function)
+        def instrumented_function(*args: Any, **kwargs: Any) -> Any:
+            if _mode == 0 or (_mode == 1 and not _is_sampled()) or not is_logger_enabled():
+                return function(*args, **kwargs)
+            return call_instrumented(args, kwargs)
+
+        return instrumented_function
+
+    return decorator
@@ -0,0 +1,182 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from dataclasses import (
+    dataclass,
+    field,
+)
+from functools import lru_cache
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Pattern,
+    Sequence,
+    Tuple,
+)
+
+import regex as re
+
+from ondewo_bpi.config import ONDEWO_BPI_INTENT_DISPATCH_MEMO_SIZE
+
+# characters with a special meaning in a regex, anything else (or any of them escaped) is a literal
+_REGEX_METACHARACTERS: str = ".^$*+?{}[]|()\\"
+
+
+@dataclass()
+class IntentCallbackAssignor:
+    """
+    Class for keeping track of the intents and their handlers
+
+    By default the handlers run one after the other. Handlers which are `independent` of each other, or which only
+    depend on the handlers listed in `dependencies` (handler -> handlers it needs the results of), run concurrently in
+    `stages`, see get_handler_stages.
+    """
+    sort_index: int = field(init=False, repr=False)
+    intent_pattern: str
+    handlers: List[Callable]
+    independent: bool = False
+    dependencies: Optional[Dict[Callable, Sequence[Callable]]] = field(default=None, repr=False)
+    stages: List[List[Callable]] = field(init=False, repr=False)
+
+    def __gt__(self, other: 'IntentCallbackAssignor') -> bool:
+        return self.sort_index > other.sort_index
+
+    def __lt__(self, other: 'IntentCallbackAssignor') -> bool:
+        return self.sort_index < other.sort_index
+
+    def __post_init__(self):
+        object.__setattr__(self, 'sort_index', len(self.intent_pattern))
+        object.__setattr__(
+            self, 'stages', get_handler_stages(self.handlers, independent=self.independent,
+                                               dependencies=self.dependencies),
+        )
+
+
+def get_handler_stages(
+    handlers: Sequence[Callable],
+    independent: bool = False,
+    dependencies: Optional[Dict[Callable, Sequence[Callable]]] = None,
+) -> List[List[Callable]]:
+    """
+    Group the handlers of an intent into stages: the handlers of a stage run concurrently and each stage runs after
+    all handlers it depends on.
+
+    Without `independent` and `dependencies` every handler depends on the one before it, i.e. they run one after the
+    other as before. With `dependencies` a handler is placed in the stage after the last of its dependencies (handlers
+    not listed have none); with just `independent` all handlers form one stage. Within a stage the handlers keep the
+    order of `handlers`, which is the order their changes of the response are merged in.
+
+    Raises:
+        ValueError: if a dependency is not one of the handlers or the dependencies are cyclic
+    """
+    if not independent and dependencies is None:
+        return [[handler] for handler in handlers]
+    dependencies = dependencies or {}
+    for handler, prerequisites in dependencies.items():
+        for prerequisite in [handler, *prerequisites]:
+            if prerequisite not in handlers:
+                raise ValueError(f"intent handler dependency {prerequisite} is not one of the handlers")
+    levels: Dict[int, int] = {}  # position in handlers -> stage
+    while len(levels) < len(handlers):
+        progressed: bool = False
+        for position, handler in enumerate(handlers):
+            if position in levels:
+                continue
+            prerequisite_positions: List[int] = [handlers.index(other) for other in dependencies.get(handler, ())]
+            if all(other in levels for other in prerequisite_positions):
+                levels[position] = max((levels[other] + 1 for other in prerequisite_positions), default=0)
+                progressed = True
+        if not progressed:
+            raise ValueError(f"the dependencies of the intent handlers {list(handlers)} are cyclic")
+    stages: List[List[Callable]] = [[] for _ in range(max(levels.values(), default=-1) + 1)]
+    for position, handler in enumerate(handlers):
+        stages[levels[position]].append(handler)
+    return stages
+
+
+def get_exact_intent_name(intent_pattern: str) -> Optional[str]:
+    """
+    Returns:
+        the intent name if the pattern (applied with re.match) only matches exactly this name, e.g. "^i\\.hello$",
+        else None
+    """
+    if not intent_pattern.endswith("$") or intent_pattern.endswith("\\$"):
+        return None  # re.match of an unterminated pattern matches every name starting with it
+    body: str = intent_pattern[1:-1] if intent_pattern.startswith("^") else intent_pattern[:-1]
+    name: List[str] = []
+    index: int = 0
+    while index < len(body):
+        character: str = body[index]
+        if character == "\\":
+            if index + 1 == len(body) or body[index + 1].isalnum():  # \d, \w, ... are character classes
+                return None
+            name.append(body[index + 1])
+            index += 2
+            continue
+        if character in _REGEX_METACHARACTERS:
+            return None
+        name.append(character)
+        index += 1
+    return "".join(name)
+
+
+class IntentDispatchIndex:
+    """
+    Resolves an intent name to the handlers of the first matching IntentCallbackAssignor
+
+    The assignors are ordered by descending pattern length (the order of registration for equal lengths) and the
+    first pattern which re.match-es the intent name wins, exactly as a linear scan would. Patterns which can only
+    match one name (e.g. "^i\\.hello$") are looked up in a dict, the other patterns are compiled once. Resolved
+    intent names are memoized in a bounded LRU cache, the intents of an agent are a small, fixed set.
+
+    The index is immutable, register new handlers by building a new index.
+    """
+
+    def __init__(
+        self,
+        assignors: Sequence[IntentCallbackAssignor],
+        memo_size: int = ONDEWO_BPI_INTENT_DISPATCH_MEMO_SIZE,
+    ) -> None:
+        self.assignors: Tuple[IntentCallbackAssignor, ...] = tuple(
+            sorted(assignors, key=lambda assignor: -assignor.sort_index)
+        )
+        # intent name -> position of the first assignor with this exact name
+        self._exact: Dict[str, int] = {}
+        # (position, compiled pattern) of all other assignors, in dispatch order
+        self._patterns: List[Tuple[int, Pattern]] = []
+        for position, assignor in enumerate(self.assignors):
+            exact_name: Optional[str] = get_exact_intent_name(assignor.intent_pattern)
+            if exact_name is not None:
+                self._exact.setdefault(exact_name, position)
+            else:
+                self._patterns.append((position, re.compile(assignor.intent_pattern)))
+        self.resolve_assignor: Callable[[str], Optional[IntentCallbackAssignor]] = lru_cache(maxsize=memo_size)(
+            self._resolve_assignor
+        )
+
+    def _resolve_assignor(self, intent_name: str) -> Optional[IntentCallbackAssignor]:
+        exact_position: Optional[int] = self._exact.get(intent_name)
+        for position, pattern in self._patterns:
+            if exact_position is not None and position > exact_position:
+                break  # the exact match comes first
+            if pattern.match(intent_name):
+                return self.assignors[position]
+        if exact_position is not None:
+            return self.assignors[exact_position]
+        return None
+
+    def resolve(self, intent_name: str) -> Tuple[Callable, ...]:
+        assignor: Optional[IntentCallbackAssignor] = self.resolve_assignor(intent_name)
+        return tuple(assignor.handlers) if assignor is not None else ()
@@ -6,7 +6,6 @@ from typing import (
 )
 
 from google.protobuf.json_format import MessageToDict
-from ondewo.logging.decorators import Timer
 from ondewo.logging.logger import logger_console as log
 from ondewo.nlu import context_pb2
 from ondewo.nlu.client import Client
@@ -20,12 +19,14 @@ from ondewo.nlu.session_pb2 import (
     TextInput,
 )
 
+from ondewo_bpi.instrumentation import instrumented
+
 
 class IntentMaxTriggerHandler:
     intent_with_max_number_triggers_dict = {'Default Fallback Intent': 2, 'Default Exit Intent': 2}
 
     @classmethod
-    @Timer(
+    @instrumented(
         logger=log.debug, log_arguments=True,
         message='IntentMaxTriggerHandler: _get_session: Elapsed time: {:0.4f}'
     )
@@ -38,7 +39,7 @@ class IntentMaxTriggerHandler:
         return nlu_session
 
     @classmethod
-    @Timer(
+    @instrumented(
         logger=log.debug, log_arguments=True,
         message='IntentMaxTriggerHandler: _get_matched_intents: Elapsed time: {:0.4f}'
     )
@@ -48,7 +49,7 @@ class IntentMaxTriggerHandler:
         return matched_intents
 
     @classmethod
-    @Timer(
+    @instrumented(
         logger=log.debug, log_arguments=True,
         message='IntentMaxTriggerHandler: _get_intent_display_name_list: Elapsed time: {:0.4f}'
     )
@@ -60,7 +61,7 @@ class IntentMaxTriggerHandler:
         return intent_display_name_list
 
     @classmethod
-    @Timer(
+    @instrumented(
         logger=log.debug, log_arguments=True,
         message='IntentMaxTriggerHandler: _get_intent_display_name_counter: Elapsed time: {:0.4f}'
     )
@@ -69,7 +70,7 @@ class IntentMaxTriggerHandler:
         return Counter(intent_display_name_list)
 
     @classmethod
-    @Timer(
+    @instrumented(
         logger=log.debug, log_arguments=True,
         message='IntentMaxTriggerHandler: _check_if_intent_reached_number_triggers_max: Elapsed time: {:0.4f}'
     )
@@ -83,7 +84,7 @@ class IntentMaxTriggerHandler:
         return False
 
     @classmethod
-    @Timer(
+    @instrumented(
         logger=log.debug, log_arguments=True,
         message='IntentMaxTriggerHandler: _get_default_exit_detect_intent_request: Elapsed time: {:0.4f}'
     )
@@ -105,7 +106,7 @@ class IntentMaxTriggerHandler:
         return nlu_request
 
     @classmethod
-    @Timer(
+    @instrumented(
         logger=log.debug, log_arguments=True,
         message='IntentMaxTriggerHandler: _create_context_for_triggering_default_exit_intent: Elapsed time: {:0.4f}'
     )
@@ -131,7 +132,7 @@ class IntentMaxTriggerHandler:
         return context
 
     @classmethod
-    @Timer(
+    @instrumented(
         logger=log.debug, log_arguments=True,
         message='IntentMaxTriggerHandler: handle_if_intent_reached_number_triggers_max: Elapsed time: {:0.4f}'
     )
@@ -0,0 +1,68 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import (
+    Any,
+    Callable,
+)
+
+import grpc
+
+RETRY_AFTER_METADATA_KEY: str = "retry-after-ms"
+
+Behavior = Callable[[Any, grpc.ServicerContext], Any]
+
+
+def abort_resource_exhausted(context: grpc.ServicerContext, details: str, retry_after_ms: int) -> None:
+    """abort the call with RESOURCE_EXHAUSTED and a retry-after-ms hint in the trailing metadata"""
+    context.set_trailing_metadata(((RETRY_AFTER_METADATA_KEY, str(retry_after_ms)),))
+    context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, details)
+
+
+def replace_behavior(
+    handler: grpc.RpcMethodHandler,
+    wrap_unary_response: Callable[[Behavior], Behavior],
+    wrap_stream_response: Callable[[Behavior], Behavior],
+) -> grpc.RpcMethodHandler:
+    """
+    wrap the behavior of a method handler, keeping its (de)serializers
+
+    Args:
+        handler: the handler returned by the continuation of a server interceptor
+        wrap_unary_response: wraps unary_unary and stream_unary behaviors
+        wrap_stream_response: wraps unary_stream and stream_stream behaviors, must return a generator function
+    """
+    if handler.unary_unary:
+        return handler._replace(unary_unary=wrap_unary_response(handler.unary_unary))
+    if handler.unary_stream:
+        return handler._replace(unary_stream=wrap_stream_response(handler.unary_stream))
+    if handler.stream_unary:
+        return handler._replace(stream_unary=wrap_unary_response(handler.stream_unary))
+    return handler._replace(stream_stream=wrap_stream_response(handler.stream_stream))
+
+
+def abort_handler(handler: grpc.RpcMethodHandler, behavior: Behavior) -> grpc.RpcMethodHandler:
+    """a handler of the same rpc type as `handler` which only runs `behavior`, e.g. to abort the call"""
+    if handler.request_streaming and handler.response_streaming:
+        factory: Callable = grpc.stream_stream_rpc_method_handler
+    elif handler.request_streaming:
+        factory = grpc.stream_unary_rpc_method_handler
+    elif handler.response_streaming:
+        factory = grpc.unary_stream_rpc_method_handler
+    else:
+        factory = grpc.unary_unary_rpc_method_handler
+    return factory(  # type: ignore
+        behavior,
+        request_deserializer=handler.request_deserializer,
+        response_serializer=handler.response_serializer,
+    )
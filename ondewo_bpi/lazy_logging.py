@@ -0,0 +1,126 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+from hashlib import blake2b
+from threading import Lock
+from typing import (
+    Any,
+    Callable,
+    FrozenSet,
+    Iterable,
+    Optional,
+    Set,
+)
+
+from google.protobuf.json_format import MessageToJson
+from google.protobuf.message import Message
+from ondewo.logging.logger import logger_console
+
+from ondewo_bpi.config import (
+    ONDEWO_BPI_PAYLOAD_LOG_SESSION_RATIO,
+    ONDEWO_BPI_PAYLOAD_LOG_SESSIONS,
+)
+
+
+class LazyLogger:
+    """
+    Logging facade which builds a message only if its level is enabled
+
+    The methods take a function returning the message (a string or a dict, as for the logger itself), e.g.
+    `lazy_log.debug(lambda: f"request: {request}")`: while the debug level is disabled, the request is never rendered.
+    """
+
+    def __init__(self, logger: logging.Logger = logger_console) -> None:
+        self.logger: logging.Logger = logger
+
+    def log(self, level: int, build_message: Callable[[], Any]) -> None:
+        if self.logger.isEnabledFor(level):
+            # the record names the caller of debug/info/warning, not this facade
+            self.logger.log(level, build_message(), stacklevel=3)
+
+    def debug(self, build_message: Callable[[], Any]) -> None:
+        self.log(logging.DEBUG, build_message)
+
+    def info(self, build_message: Callable[[], Any]) -> None:
+        self.log(logging.INFO, build_message)
+
+    def warning(self, build_message: Callable[[], Any]) -> None:
+        self.log(logging.WARNING, build_message)
+
+
+lazy_log: LazyLogger = LazyLogger()
+
+
+def parse_session_ids(session_ids: str) -> FrozenSet[str]:
+    """comma separated session ids -> set of ids"""
+    return frozenset(session_id.strip() for session_id in session_ids.split(",") if session_id.strip())
+
+
+class PayloadLog:
+    """
+    Logs the complete DetectIntent requests and responses (as JSON, at info level) of chosen sessions
+
+    A session is chosen if its id (the last part of the session name) or its full name was added, or if it falls into
+    the `session_ratio` of all sessions (chosen by a hash of the id, so a session is logged with all its turns). All
+    other sessions cost one set lookup per payload.
+    """
+
+    def __init__(
+        self,
+        session_ids: Iterable[str] = parse_session_ids(ONDEWO_BPI_PAYLOAD_LOG_SESSIONS),
+        session_ratio: float = ONDEWO_BPI_PAYLOAD_LOG_SESSION_RATIO,
+        logger: logging.Logger = logger_console,
+    ) -> None:
+        self.session_ids: Set[str] = set(session_ids)
+        self.session_ratio: float = session_ratio
+        self.logger: logging.Logger = logger
+        self._lock: Lock = Lock()
+
+    def add_session(self, session_id: str) -> None:
+        with self._lock:
+            self.session_ids = self.session_ids | {session_id}
+
+    def remove_session(self, session_id: str) -> None:
+        with self._lock:
+            self.session_ids = self.session_ids - {session_id}
+
+    def is_chosen(self, session_name: str) -> bool:
+        if not self.session_ids and self.session_ratio <= 0:
+            return False
+        session_id: str = session_name.rsplit("/", 1)[-1]
+        if session_id in self.session_ids or session_name in self.session_ids:
+            return True
+        if self.session_ratio <= 0:
+            return False
+        bucket: int = int.from_bytes(blake2b(session_id.encode(), digest_size=8).digest(), "big")
+        return bucket / 2 ** 64 < self.session_ratio
+
+    def log(self, session_name: str, stage: str, payload: Optional[Message]) -> None:
+        """log the payload (e.g. stage "request", "cai_response" or "response") if the session is chosen"""
+        if payload is None or not self.is_chosen(session_name):
+            return
+        self.logger.info(
+            {
+                "message": f"DetectIntent {stage} of {session_name}",
+                "session_id": session_name,
+                "stage": stage,
+                "payload": MessageToJson(payload),
+                "tags": ["payload"],
+            },
+            stacklevel=2,
+        )
+
+
+# process wide payload log of the DetectIntent pipeline, add sessions at runtime with PAYLOAD_LOG.add_session
+PAYLOAD_LOG: PayloadLog = PayloadLog()
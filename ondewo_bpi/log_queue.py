@@ -0,0 +1,241 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import queue
+from threading import (
+    Lock,
+    Thread,
+)
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from ondewo_bpi.config import (
+    ONDEWO_BPI_LOG_QUEUE_BATCH_SIZE,
+    ONDEWO_BPI_LOG_QUEUE_MAX_SIZE,
+)
+from ondewo_bpi.metrics import (
+    BPI_METRICS,
+    MetricsRegistry,
+)
+
+# a record and the handlers it is written to
+_QueuedRecord = Tuple[logging.LogRecord, Tuple[logging.Handler, ...]]
+
+# the loggers of ondewo.logging.logger: root, console and debug
+DEFAULT_LOGGER_NAMES: Tuple[str, ...] = ("", "console", "debug")
+
+
+class LogQueue:
+    """
+    Bounded queue of log records which a single writer thread writes to their handlers
+
+    Logging threads only put the record into the queue; when it is full the record is dropped and counted instead of
+    blocking the thread. The writer takes up to `batch_size` queued records at a time and writes the records of a
+    stream handler (stdout, files) with one write and one flush.
+
+    Metrics: log_queue_{dropped,written,batches}_total and log_queue_depth.
+    """
+
+    def __init__(
+        self,
+        max_size: int = ONDEWO_BPI_LOG_QUEUE_MAX_SIZE,
+        batch_size: int = ONDEWO_BPI_LOG_QUEUE_BATCH_SIZE,
+        metrics: MetricsRegistry = BPI_METRICS,
+    ) -> None:
+        assert batch_size > 0, "batch_size must be positive"
+        self.max_size: int = max_size
+        self.batch_size: int = batch_size
+        self.metrics: MetricsRegistry = metrics
+        self._queue: "queue.Queue[Optional[_QueuedRecord]]" = queue.Queue(maxsize=max_size)
+        self._thread: Optional[Thread] = None
+        self._lock: Lock = Lock()
+        self.dropped: int = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = Thread(target=self._run, name="bpi_log_writer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: Optional[float] = 5.0) -> None:
+        """write the queued records and stop the writer thread"""
+        with self._lock:
+            thread: Optional[Thread] = self._thread
+            self._thread = None
+        if thread is None:
+            return
+        self._queue.put(None)  # blocks while full, the writer is still draining
+        thread.join(timeout=timeout)
+
+    def put(self, record: logging.LogRecord, handlers: Tuple[logging.Handler, ...]) -> bool:
+        """queue the record, False if the queue is full and the record was dropped"""
+        try:
+            self._queue.put_nowait((record, handlers))
+        except queue.Full:
+            self.dropped += 1
+            self.metrics.increment("log_queue_dropped_total")
+            return False
+        return True
+
+    def _take_batch(self) -> Tuple[List[_QueuedRecord], bool]:
+        """wait for a record, then take the queued records up to the batch size; True once stop was requested"""
+        item: Optional[_QueuedRecord] = self._queue.get()
+        if item is None:
+            return [], True
+        batch: List[_QueuedRecord] = [item]
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self) -> None:
+        stopped: bool = False
+        while not stopped:
+            batch, stopped = self._take_batch()
+            if batch:
+                write_batch(batch)
+                self.metrics.increment("log_queue_written_total", len(batch))
+                self.metrics.increment("log_queue_batches_total")
+            self.metrics.set_gauge("log_queue_depth", self._queue.qsize())
+
+
+def write_batch(batch: Sequence[_QueuedRecord]) -> None:
+    """write the records to their handlers, the records of a stream handler with a single write"""
+    records_of_handler: Dict[logging.Handler, List[logging.LogRecord]] = {}
+    for record, handlers in batch:
+        for handler in handlers:
+            if record.levelno >= handler.level:
+                records_of_handler.setdefault(handler, []).append(record)
+    for handler, records in records_of_handler.items():
+        if isinstance(handler, logging.StreamHandler):
+            _write_stream(handler, records)
+        else:
+            for record in records:
+                handler.handle(record)
+
+
+def _write_stream(handler: logging.StreamHandler, records: List[logging.LogRecord]) -> None:
+    lines: List[str] = []
+    for record in records:
+        if not handler.filter(record):
+            continue
+        try:
+            lines.append(handler.format(record) + handler.terminator)
+        except Exception:
+            handler.handleError(record)
+    if not lines:
+        return
+    with handler.lock:  # type: ignore[union-attr]
+        try:
+            handler.stream.write("".join(lines))
+            handler.flush()
+        except Exception:
+            handler.handleError(records[-1])
+
+
+class QueueLogHandler(logging.Handler):
+    """
+    Puts the records of a logger into a LogQueue, the writer thread hands them to the handlers the logger had
+
+    The message (with its arguments) and the traceback are rendered by the logging thread, so the record does not
+    refer to objects which change later; formatting happens in the writer thread.
+    """
+
+    def __init__(self, log_queue: LogQueue, handlers: Sequence[logging.Handler]) -> None:
+        super().__init__(level=min((handler.level for handler in handlers), default=logging.NOTSET))
+        self.log_queue: LogQueue = log_queue
+        self.handlers: Tuple[logging.Handler, ...] = tuple(handlers)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.log_queue.put(self.prepare(record), self.handlers)
+        except Exception:
+            self.handleError(record)
+
+
+_installed: Optional[Tuple[LogQueue, Dict[str, List[logging.Handler]]]] = None
+_install_lock: Lock = Lock()
+
+
+def install_log_queue(
+    logger_names: Sequence[str] = DEFAULT_LOGGER_NAMES,
+    max_size: int = ONDEWO_BPI_LOG_QUEUE_MAX_SIZE,
+    batch_size: int = ONDEWO_BPI_LOG_QUEUE_BATCH_SIZE,
+) -> LogQueue:
+    """
+    route the loggers through a LogQueue: their handlers are replaced by one QueueLogHandler each
+
+    Calling it again returns the installed queue. Install it in the process which serves (e.g. after the fork of a
+    prefork worker), the writer thread does not survive a fork.
+    """
+    global _installed
+    with _install_lock:
+        if _installed is not None:
+            return _installed[0]
+        log_queue: LogQueue = LogQueue(max_size=max_size, batch_size=batch_size)
+        original_handlers: Dict[str, List[logging.Handler]] = {}
+        for name in logger_names:
+            logger: logging.Logger = logging.getLogger(name)
+            if not logger.handlers:
+                continue
+            original_handlers[name] = list(logger.handlers)
+            for handler in original_handlers[name]:
+                logger.removeHandler(handler)
+            logger.addHandler(QueueLogHandler(log_queue=log_queue, handlers=original_handlers[name]))
+        log_queue.start()
+        _installed = (log_queue, original_handlers)
+        return log_queue
+
+
+def uninstall_log_queue() -> None:
+    """write the queued records and give the loggers their handlers back"""
+    global _installed
+    with _install_lock:
+        if _installed is None:
+            return
+        log_queue, original_handlers = _installed
+        _installed = None
+        for name, handlers in original_handlers.items():
+            logger: logging.Logger = logging.getLogger(name)
+            for handler in list(logger.handlers):
+                if isinstance(handler, QueueLogHandler) and handler.log_queue is log_queue:
+                    logger.removeHandler(handler)
+            for handler in handlers:
+                logger.addHandler(handler)
+        log_queue.stop()
@@ -24,7 +24,6 @@ from typing import (
 )
 
 from google.protobuf.json_format import MessageToJson
-from google.protobuf.message import Message
 from ondewo.logging.logger import logger_console as log
 from ondewo.nlu import (
     context_pb2,
@@ -37,9 +36,13 @@ from ondewo_bpi.constants import (
     DATE_FORMAT_BACK,
     EnglishDays,
     GermanDays,
-    QueryTriggers,
     SipTriggers,
 )
+from ondewo_bpi.lazy_logging import lazy_log
+from ondewo_bpi.trigger_scanner import (
+    DEFAULT_TRIGGER_SCANNER,
+    TriggerScanner,
+)
 
 
 def create_parameter_dict(my_dict: Dict) -> Optional[Dict[str, context_pb2.Context.Parameter]]:
@@ -67,16 +70,16 @@ class MessageHandler:
     """
 
     @staticmethod
-    def get_triggers(message: intent_pb2.Intent.Message, session_id: Optional[str] = None) -> Dict[str, List[str]]:
-        found_triggers: Dict[str, List[str]] = {}
-        for trigger in SipTriggers:
-            if SingleMessageHandler.check_message_for_pattern(message, trigger.value):
-                content = SingleMessageHandler.get_pattern_from_message(message, trigger.value)
-                found_triggers[trigger.value] = content
-        for query_trigger in QueryTriggers:
-            if SingleMessageHandler.check_message_for_pattern(message, query_trigger.value):
-                content = SingleMessageHandler.get_pattern_from_message(message, query_trigger.value)
-                found_triggers[query_trigger.value] = content
+    def get_triggers(
+        message: intent_pb2.Intent.Message,
+        session_id: Optional[str] = None,
+        trigger_scanner: TriggerScanner = DEFAULT_TRIGGER_SCANNER,
+    ) -> Dict[str, List[str]]:
+        """
+        Args:
+            trigger_scanner: the trigger patterns to look for, defaults to the SipTriggers and QueryTriggers
+        """
+        found_triggers: Dict[str, List[str]] = trigger_scanner.scan(message)
         if len(found_triggers):
             log.info(
                 {
@@ -167,8 +170,8 @@ class ParameterMethods:
     def get_context(response: session_pb2.DetectIntentResponse, context_name: str) -> Optional[context_pb2.Context]:
         log.info({"message": "searching for context", "content": context_name, "tags": ["contexts"]})
         context = [c for c in response.query_result.output_contexts if c.name.endswith(context_name)]
-        log.info(
-            {"message": "found context", "content": MessageToJson(context[0]) if len(context) else "None"}
+        lazy_log.info(
+            lambda: {"message": "found context", "content": MessageToJson(context[0]) if len(context) else "None"}
         )
         return context[0] if len(context) else None
 
@@ -186,25 +189,13 @@ class ParameterMethods:
         if context is None:
             return None
 
-        params: List[str] = list(context.parameters)
-        returned_param: Union[str, Message]
-        if param_name in params:
-            returned_param = context.parameters[param_name]
-        else:
-            returned_param = "None"
-
-        try:
-            if returned_param is not None and returned_param != "None":
-                returned_param = MessageToJson(returned_param)
-        except AttributeError:
-            pass
-
-        log.info({"message": "found param", "content": returned_param})
-        if param_name in context.parameters:
-            parameter: context_pb2.Context.Parameter = context.parameters[param_name]
-            return parameter
-        else:
-            return None
+        parameter: Optional[context_pb2.Context.Parameter] = (
+            context.parameters[param_name] if param_name in context.parameters else None
+        )
+        lazy_log.info(
+            lambda: {"message": "found param", "content": MessageToJson(parameter) if parameter else "None"}
+        )
+        return parameter
 
     @staticmethod
     def add_params_to_response(
@@ -240,7 +231,7 @@ class ParameterMethods:
 class SingleMessageHandler:
     @staticmethod
     def check_message_for_pattern(message: intent_pb2.Intent.Message, pattern: str) -> bool:
-        log.debug({"message": "checking response for text", "content": pattern, "pattern": pattern})
+        lazy_log.debug(lambda: {"message": "checking response for text", "content": pattern, "pattern": pattern})
         if message.HasField("text"):
             has_match = SingleMessageHandler._pattern_match_text(message, pattern)
             if has_match:
@@ -0,0 +1,187 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+from contextlib import contextmanager
+from threading import Lock
+from typing import (
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+
+def get_callable_name(handler: Callable) -> str:
+    """name of a handler in metric labels and logs"""
+    return getattr(handler, "__qualname__", repr(handler))
+
+
+def with_labels(name: str, **labels: str) -> str:
+    """metric name with Prometheus style labels, e.g. bpi_stage_seconds{stage="process_messages"}"""
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+def _with_suffix(name: str, suffix: str) -> str:
+    """append the suffix to the name in front of its labels"""
+    base, brace, labels = name.partition("{")
+    return base + suffix + brace + labels
+
+
+class Histogram:
+    """
+    HDR style histogram of non-negative values (e.g. latencies in seconds) with bounded memory
+
+    Values are counted in `resolution` units, exactly up to 2**sub_bucket_bits units and above that in logarithmic
+    buckets of 2**(sub_bucket_bits - 1) linear sub-buckets each, i.e. with a relative error below
+    2**-(sub_bucket_bits - 1) (1.6% by default). Values above 2**max_exponent units are counted as the maximum, so
+    there are at most 2**sub_bucket_bits + (max_exponent - sub_bucket_bits + 1) * 2**(sub_bucket_bits - 1) buckets.
+    """
+
+    def __init__(self, resolution: float = 1e-6, sub_bucket_bits: int = 7, max_exponent: int = 40) -> None:
+        self.resolution: float = resolution
+        self.sub_bucket_bits: int = sub_bucket_bits
+        self.max_units: int = (1 << max_exponent) - 1
+        self._sub_bucket_count: int = 1 << sub_bucket_bits
+        self._half_count: int = 1 << (sub_bucket_bits - 1)
+        self._counts: Dict[int, int] = {}
+        self.count: int = 0
+        self.sum: float = 0.0
+        self.max: float = 0.0
+        self._lock: Lock = Lock()
+
+    def _get_index(self, units: int) -> int:
+        if units < self._sub_bucket_count:
+            return units
+        shift: int = units.bit_length() - self.sub_bucket_bits
+        return self._sub_bucket_count + (shift - 1) * self._half_count + (units >> shift) - self._half_count
+
+    def _get_upper_bound(self, index: int) -> float:
+        """the largest value (in the unit of the recorded values) counted in the bucket"""
+        if index < self._sub_bucket_count:
+            return index * self.resolution
+        shift, offset = divmod(index - self._sub_bucket_count, self._half_count)
+        return (((self._half_count + offset + 1) << (shift + 1)) - 1) * self.resolution
+
+    def record(self, value: float) -> None:
+        index: int = self._get_index(min(max(int(value / self.resolution), 0), self.max_units))
+        with self._lock:
+            self._counts[index] = self._counts.get(index, 0) + 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, percentile: float) -> float:
+        """
+        Returns:
+            the upper bound of the bucket holding the given percentile (0-100) of the values, 0 if there are none
+        """
+        with self._lock:
+            rank: float = percentile / 100 * self.count
+            seen: int = 0
+            for index in sorted(self._counts):
+                seen += self._counts[index]
+                if seen >= rank and seen > 0:
+                    return min(self._get_upper_bound(index), self.max)
+        return 0.0
+
+    def buckets(self) -> List[Tuple[float, int]]:
+        """
+        Returns:
+            (upper bound, cumulative count) of the non-empty buckets, e.g. for an exporter
+        """
+        with self._lock:
+            cumulative: int = 0
+            result: List[Tuple[float, int]] = []
+            for index in sorted(self._counts):
+                cumulative += self._counts[index]
+                result.append((self._get_upper_bound(index), cumulative))
+        return result
+
+
+class MetricsRegistry:
+    """
+    Minimal thread-safe in-process registry of counters, gauges and histograms
+
+    The BPI has no metrics backend of its own; the registry is meant to be read via `snapshot()` by whatever exporter
+    or health endpoint a deployment wires up. Histograms are summarized in the snapshot by their _count, _sum, _max,
+    _p50, _p90 and _p99; `histograms()` gives access to their buckets.
+    """
+
+    # percentiles of the histograms in the snapshot
+    SNAPSHOT_PERCENTILES: Tuple[int, ...] = (50, 90, 99)
+
+    def __init__(self) -> None:
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, float] = {}
+        self._histograms: Dict[str, Histogram] = {}
+        self._lock: Lock = Lock()
+
+    def increment(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value: float) -> None:
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name: str, value: float) -> None:
+        """record the value in the histogram of the name"""
+        histogram: Optional[Histogram] = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, Histogram())
+        histogram.record(value)
+
+    @contextmanager
+    def time(self, name: str) -> Iterator[None]:
+        """observe the duration of the block in seconds, also if it raises"""
+        started_at: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started_at)
+
+    def counter(self, name: str) -> float:
+        return self._counters.get(name, 0)
+
+    def gauge(self, name: str) -> float:
+        return self._gauges.get(name, 0)
+
+    def histogram(self, name: str) -> Optional[Histogram]:
+        return self._histograms.get(name)
+
+    def histograms(self) -> Dict[str, Histogram]:
+        with self._lock:
+            return dict(self._histograms)
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            values: Dict[str, float] = {**self._counters, **self._gauges}
+            histograms: Dict[str, Histogram] = dict(self._histograms)
+        for name, histogram in histograms.items():
+            values[_with_suffix(name, "_count")] = histogram.count
+            values[_with_suffix(name, "_sum")] = histogram.sum
+            values[_with_suffix(name, "_max")] = histogram.max
+            for percentile in self.SNAPSHOT_PERCENTILES:
+                values[_with_suffix(name, f"_p{percentile}")] = histogram.percentile(percentile)
+        return values
+
+
+# process wide registry used by the BPI components
+BPI_METRICS: MetricsRegistry = MetricsRegistry()
@@ -0,0 +1,48 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import (
+    Callable,
+    Dict,
+    Mapping,
+    Optional,
+)
+
+from ondewo.nlu import session_pb2
+
+# request -> the response of the turn, or None to let CAI answer it
+PreDetectIntentHook = Callable[[session_pb2.DetectIntentRequest], Optional[session_pb2.DetectIntentResponse]]
+
+
+def answer_events(responses: Mapping[str, session_pb2.DetectIntentResponse]) -> PreDetectIntentHook:
+    """
+    hook answering event inputs (e.g. keep-alive or silence events of SIP) with a fixed response per event name
+
+    Args:
+        responses: event name -> response, e.g. with an empty fulfillment for a keep-alive event
+    """
+    event_responses: Dict[str, session_pb2.DetectIntentResponse] = dict(responses)
+
+    def answer_event(request: session_pb2.DetectIntentRequest) -> Optional[session_pb2.DetectIntentResponse]:
+        if request.query_input.WhichOneof("input") != "event":
+            return None
+        event_response: Optional[session_pb2.DetectIntentResponse] = event_responses.get(
+            request.query_input.event.name
+        )
+        if event_response is None:
+            return None
+        response: session_pb2.DetectIntentResponse = session_pb2.DetectIntentResponse()
+        response.CopyFrom(event_response)
+        return response
+
+    return answer_event
@@ -0,0 +1,229 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+from collections import (
+    OrderedDict,
+    deque,
+)
+from dataclasses import (
+    dataclass,
+    field,
+)
+from threading import (
+    Condition,
+    Lock,
+    Thread,
+)
+from typing import (
+    Callable,
+    Deque,
+    List,
+    Optional,
+    Set,
+)
+
+from ondewo.logging.logger import logger_console as log
+from ondewo.nlu import (
+    intent_pb2,
+    session_pb2,
+)
+
+from ondewo_bpi.config import (
+    ONDEWO_BPI_QUICKSEND_ENQUEUE_TIMEOUT_SECONDS,
+    ONDEWO_BPI_QUICKSEND_MAX_CONCURRENCY,
+    ONDEWO_BPI_QUICKSEND_MAX_PENDING,
+    ONDEWO_BPI_QUICKSEND_MESSAGE_TTL_SECONDS,
+)
+from ondewo_bpi.metrics import (
+    BPI_METRICS,
+    MetricsRegistry,
+)
+
+# (response, message, count) -> None, the signature of BpiSessionsServices.quicksend_to_api
+QuicksendFunction = Callable[[session_pb2.DetectIntentResponse, Optional[intent_pb2.Intent.Message], int], None]
+
+
+@dataclass
+class _QuicksendItem:
+    response: session_pb2.DetectIntentResponse
+    message: Optional[intent_pb2.Intent.Message]
+    count: int
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class QuicksendDispatcher:
+    """
+    Delivers the quicksend messages of DetectIntent in the background
+
+    Every session has its own FIFO queue and at most one delivery in flight, so the messages of a session arrive in
+    order; up to `max_concurrency` sessions are delivered at the same time. The DetectIntent response does not wait
+    for any delivery.
+
+    At most `max_pending` messages wait for delivery. When the queue is full, `submit` waits up to its timeout for
+    space (backpressure) and then drops the message. Messages which waited longer than `message_ttl_seconds` are
+    expired instead of delivered, a late prompt is worse than none.
+
+    Metrics: quicksend_{enqueued,delivered,failed,dropped,expired}_total, quicksend_queue_depth,
+    quicksend_delivery_latency_seconds_sum and quicksend_last_delivery_latency_seconds (enqueue to delivered).
+    """
+
+    def __init__(
+        self,
+        send: QuicksendFunction,
+        max_concurrency: int = ONDEWO_BPI_QUICKSEND_MAX_CONCURRENCY,
+        max_pending: int = ONDEWO_BPI_QUICKSEND_MAX_PENDING,
+        message_ttl_seconds: float = ONDEWO_BPI_QUICKSEND_MESSAGE_TTL_SECONDS,
+        enqueue_timeout_seconds: float = ONDEWO_BPI_QUICKSEND_ENQUEUE_TIMEOUT_SECONDS,
+        metrics: MetricsRegistry = BPI_METRICS,
+    ) -> None:
+        assert max_concurrency > 0, "max_concurrency must be positive"
+        self.send: QuicksendFunction = send
+        self.max_concurrency: int = max_concurrency
+        self.max_pending: int = max_pending
+        self.message_ttl_seconds: float = message_ttl_seconds
+        self.enqueue_timeout_seconds: float = enqueue_timeout_seconds
+        self.metrics: MetricsRegistry = metrics
+        # session -> its undelivered messages; sessions without a delivery in flight are ready
+        self._queues: "OrderedDict[str, Deque[_QuicksendItem]]" = OrderedDict()
+        self._busy_sessions: Set[str] = set()
+        self._pending: int = 0
+        self._condition: Condition = Condition()
+        self._threads: List[Thread] = []
+        self._running: bool = False
+        self._start_lock: Lock = Lock()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._pending
+
+    def start(self) -> None:
+        with self._start_lock:
+            if self._running:
+                return
+            self._running = True
+            self._threads = [
+                Thread(target=self._run, name=f"bpi_quicksend_{index}", daemon=True)
+                for index in range(self.max_concurrency)
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def submit(
+        self,
+        session_name: str,
+        response: session_pb2.DetectIntentResponse,
+        message: Optional[intent_pb2.Intent.Message],
+        count: int,
+        timeout: Optional[float] = None,
+    ) -> bool:
+        """
+        queue a copy of the message (and of its response) for delivery
+
+        Args:
+            timeout: seconds to wait for space in a full queue, defaults to enqueue_timeout_seconds
+
+        Returns:
+            False if the queue stayed full and the message was dropped
+        """
+        if not self._running:
+            self.start()
+        copied_response: session_pb2.DetectIntentResponse = session_pb2.DetectIntentResponse()
+        copied_response.CopyFrom(response)
+        copied_message: Optional[intent_pb2.Intent.Message] = None
+        if message is not None:
+            copied_message = intent_pb2.Intent.Message()
+            copied_message.CopyFrom(message)
+        with self._condition:
+            if not self._condition.wait_for(
+                lambda: self._pending < self.max_pending,
+                timeout=self.enqueue_timeout_seconds if timeout is None else timeout,
+            ):
+                self.metrics.increment("quicksend_dropped_total")
+                log.warning(f"quicksend queue is full, dropped message {count} of session {session_name}")
+                return False
+            self._queues.setdefault(session_name, deque()).append(
+                _QuicksendItem(response=copied_response, message=copied_message, count=count)
+            )
+            self._pending += 1
+            self.metrics.increment("quicksend_enqueued_total")
+            self.metrics.set_gauge("quicksend_queue_depth", self._pending)
+            self._condition.notify_all()
+        return True
+
+    def _next_session(self) -> Optional[str]:
+        """must be called with the condition held; the oldest session with messages and no delivery in flight"""
+        for session_name in self._queues:
+            if session_name not in self._busy_sessions:
+                return session_name
+        return None
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._next_session() is not None or not self._running)
+                session_name: Optional[str] = self._next_session()
+                if session_name is None:
+                    return
+                queue: Deque[_QuicksendItem] = self._queues[session_name]
+                item: _QuicksendItem = queue.popleft()
+                if queue:
+                    self._queues.move_to_end(session_name)  # round robin between the sessions
+                else:
+                    del self._queues[session_name]
+                self._busy_sessions.add(session_name)
+                self._pending -= 1
+                self.metrics.set_gauge("quicksend_queue_depth", self._pending)
+                self._condition.notify_all()
+            try:
+                self._deliver(session_name=session_name, item=item)
+            finally:
+                with self._condition:
+                    self._busy_sessions.discard(session_name)
+                    self._condition.notify_all()
+
+    def _deliver(self, session_name: str, item: _QuicksendItem) -> None:
+        waited: float = time.monotonic() - item.enqueued_at
+        if waited > self.message_ttl_seconds:
+            self.metrics.increment("quicksend_expired_total")
+            log.warning(f"quicksend message {item.count} of session {session_name} expired after {waited:.3f}s")
+            return
+        try:
+            self.send(item.response, item.message, item.count)
+        except Exception as e:
+            self.metrics.increment("quicksend_failed_total")
+            log.exception(f"quicksend of message {item.count} of session {session_name} failed: {e}")
+            return
+        latency: float = time.monotonic() - item.enqueued_at
+        self.metrics.increment("quicksend_delivered_total")
+        self.metrics.increment("quicksend_delivery_latency_seconds_sum", latency)
+        self.metrics.set_gauge("quicksend_last_delivery_latency_seconds", latency)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Returns:
+            True if all queued messages were delivered (or expired) within the timeout
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._queues and not self._busy_sessions, timeout=timeout)
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """deliver the remaining messages and stop the worker threads"""
+        if not self._running:
+            return
+        self.flush(timeout=timeout)
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=timeout)
@@ -0,0 +1,263 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+from hashlib import blake2b
+from threading import Lock
+from typing import (
+    Callable,
+    FrozenSet,
+    Iterable,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from ondewo.nlu import session_pb2
+from ondewo.nlu.client import Client as NluClient
+
+from ondewo_bpi.config import (
+    ONDEWO_BPI_RESPONSE_CACHE_ALLOWED_INTENTS,
+    ONDEWO_BPI_RESPONSE_CACHE_DENIED_INTENTS,
+    ONDEWO_BPI_RESPONSE_CACHE_MAX_ENTRIES,
+    ONDEWO_BPI_RESPONSE_CACHE_TTL_SECONDS,
+)
+from ondewo_bpi.metrics import (
+    BPI_METRICS,
+    MetricsRegistry,
+)
+from ondewo_bpi.session_steps import (
+    SessionStepTracker,
+    adapt_local_response,
+)
+from ondewo_bpi.state_store import (
+    StateStore,
+    read_shared,
+    write_shared,
+)
+
+# (agent of the session, normalized text, language code)
+ResponseCacheKey = Tuple[str, str, str]
+
+CONTEXT_PRESERVING_ATTRIBUTE: str = "bpi_context_preserving"
+
+
+def context_preserving(handler: Callable) -> Callable:
+    """
+    mark an intent handler which neither reads nor changes contexts, so that the intent stays cacheable
+
+    Intents with any unmarked intent handler are never answered from the ResponseCache.
+    """
+    setattr(handler, CONTEXT_PRESERVING_ATTRIBUTE, True)
+    return handler
+
+
+def is_context_preserving(handler: Callable) -> bool:
+    return bool(getattr(handler, CONTEXT_PRESERVING_ATTRIBUTE, False))
+
+
+def get_agent_from_session_name(session_name: str) -> str:
+    """projects/<p>/agent/sessions/<s> -> projects/<p>/agent"""
+    return session_name.split("/sessions/", 1)[0] if "/sessions/" in session_name else ""
+
+
+def normalize_text(text: str) -> str:
+    """unicode normalized, case folded text with collapsed whitespace"""
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+def parse_intent_names(intent_names: str) -> FrozenSet[str]:
+    """comma separated intent display names -> set of names"""
+    return frozenset(name.strip() for name in intent_names.split(",") if name.strip())
+
+
+@dataclass
+class _CachedResponse:
+    response: session_pb2.DetectIntentResponse
+    expires_at: float
+
+
+class ResponseCache:
+    """
+    LRU cache with TTL of the CAI DetectIntentResponses of context-free turns
+
+    A turn is context-free if the session has no alive contexts (according to the SessionContextMirror), the request
+    carries no contexts and the response of CAI creates none. The same normalized text in the same language then
+    yields the same response, e.g. for static FAQ intents. Only intents which pass the allow list (all intents if it
+    is empty) and are not on the deny list are cached. CAI may choose between several response variants of an
+    intent; the cache freezes one of them for `ttl_seconds`.
+
+    The intent and trigger handlers still run for every turn, the cache only replaces the DetectIntent call to CAI.
+    The session step of a cache hit is recorded in CAI in the background, so that the session analytics stay
+    complete.
+
+    With a `state_store` the cached responses are also shared with the other replicas: a local miss is looked up in
+    the store and the responses cached by this replica are written to it, so the hit ratio does not drop with the
+    number of replicas.
+
+    Metrics: response_cache_{hits,shared_hits,misses,stores,bypassed}_total, response_cache_hit_ratio,
+    response_cache_entries and response_cache_track_session_step_{errors,dropped}_total.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = ONDEWO_BPI_RESPONSE_CACHE_MAX_ENTRIES,
+        ttl_seconds: float = ONDEWO_BPI_RESPONSE_CACHE_TTL_SECONDS,
+        allowed_intents: Iterable[str] = parse_intent_names(ONDEWO_BPI_RESPONSE_CACHE_ALLOWED_INTENTS),
+        denied_intents: Iterable[str] = parse_intent_names(ONDEWO_BPI_RESPONSE_CACHE_DENIED_INTENTS),
+        metrics: MetricsRegistry = BPI_METRICS,
+        state_store: Optional[StateStore] = None,
+    ) -> None:
+        self.max_entries: int = max_entries
+        self.ttl_seconds: float = ttl_seconds
+        self.allowed_intents: FrozenSet[str] = frozenset(allowed_intents)
+        self.denied_intents: FrozenSet[str] = frozenset(denied_intents)
+        self.metrics: MetricsRegistry = metrics
+        self.state_store: Optional[StateStore] = state_store
+        self._entries: "OrderedDict[ResponseCacheKey, _CachedResponse]" = OrderedDict()
+        self._lock: Lock = Lock()
+        self._hits: int = 0
+        self._lookups: int = 0
+        self.session_step_tracker: SessionStepTracker = SessionStepTracker(
+            errors_metric="response_cache_track_session_step_errors_total",
+            dropped_metric="response_cache_track_session_step_dropped_total",
+            metrics=metrics,
+        )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_key(
+        self,
+        request: session_pb2.DetectIntentRequest,
+        alive_context_names: Optional[Set[str]],
+    ) -> Optional[ResponseCacheKey]:
+        """
+        Args:
+            request: the request to CAI
+            alive_context_names: the alive contexts of the session, None if they are not known
+
+        Returns:
+            the cache key, None if the turn is not context-free and must not be answered from the cache
+        """
+        if alive_context_names is None or alive_context_names \
+                or request.query_input.WhichOneof("input") != "text" \
+                or request.query_params.contexts or request.query_params.reset_contexts \
+                or request.query_params.HasField("payload"):
+            self.metrics.increment("response_cache_bypassed_total")
+            return None
+        # the same text is answered differently by the agents of other projects
+        return (
+            get_agent_from_session_name(request.session),
+            normalize_text(request.query_input.text.text),
+            request.query_input.text.language_code,
+        )
+
+    def is_intent_cacheable(self, intent_name: str) -> bool:
+        if self.allowed_intents and intent_name not in self.allowed_intents:
+            return False
+        return intent_name not in self.denied_intents
+
+    def get(
+        self,
+        key: ResponseCacheKey,
+        request: session_pb2.DetectIntentRequest,
+    ) -> Optional[session_pb2.DetectIntentResponse]:
+        """
+        Returns:
+            a copy of the cached response adapted to the session of the request, None on a miss
+        """
+        with self._lock:
+            self._lookups += 1
+            cached: Optional[_CachedResponse] = self._entries.get(key)
+            if cached is not None and cached.expires_at < time.monotonic():
+                del self._entries[key]
+                cached = None
+            if cached is not None:
+                self._hits += 1
+                self._entries.move_to_end(key)
+        if cached is None and self.state_store is not None:
+            cached = self._get_shared(key)
+        self.metrics.set_gauge("response_cache_hit_ratio", self._hits / self._lookups)
+        if cached is None:
+            self.metrics.increment("response_cache_misses_total")
+            return None
+        self.metrics.increment("response_cache_hits_total")
+        response: session_pb2.DetectIntentResponse = session_pb2.DetectIntentResponse()
+        response.CopyFrom(cached.response)
+        return adapt_local_response(response=response, request=request)
+
+    def put(self, key: ResponseCacheKey, response: session_pb2.DetectIntentResponse) -> bool:
+        """
+        cache a copy of the response if it is context-free and its intent is cacheable
+
+        Returns:
+            True if the response was cached
+        """
+        if response.query_result.output_contexts \
+                or not self.is_intent_cacheable(response.query_result.intent.display_name):
+            return False
+        cached_response: session_pb2.DetectIntentResponse = session_pb2.DetectIntentResponse()
+        cached_response.CopyFrom(response)
+        self._store(key, cached_response, expires_at=time.monotonic() + self.ttl_seconds)
+        self.metrics.increment("response_cache_stores_total")
+        if self.state_store is not None:
+            write_shared(
+                self.state_store,
+                key=self.get_shared_key(key),
+                value=cached_response.SerializeToString(),
+                ttl_seconds=self.ttl_seconds,
+                metrics=self.metrics,
+            )
+        return True
+
+    def _store(self, key: ResponseCacheKey, response: session_pb2.DetectIntentResponse, expires_at: float) -> None:
+        with self._lock:
+            self._entries[key] = _CachedResponse(response=response, expires_at=expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            entries: int = len(self._entries)
+        self.metrics.set_gauge("response_cache_entries", entries)
+
+    @staticmethod
+    def get_shared_key(key: ResponseCacheKey) -> str:
+        agent, text, language_code = key
+        digest: str = blake2b(f"{agent}\0{text}".encode(), digest_size=16).hexdigest()
+        return f"response_cache:{language_code}:{digest}"
+
+    def _get_shared(self, key: ResponseCacheKey) -> Optional[_CachedResponse]:
+        """look up a local miss in the state store, a hit is also cached locally for `ttl_seconds`"""
+        assert self.state_store is not None
+        value: Optional[bytes] = read_shared(self.state_store, self.get_shared_key(key), metrics=self.metrics)
+        if value is None:
+            return None
+        response: session_pb2.DetectIntentResponse = session_pb2.DetectIntentResponse.FromString(value)
+        cached: _CachedResponse = _CachedResponse(response=response, expires_at=time.monotonic() + self.ttl_seconds)
+        self._store(key, response, expires_at=cached.expires_at)
+        with self._lock:
+            self._hits += 1
+        self.metrics.increment("response_cache_shared_hits_total")
+        return cached
+
+    def track_session_step(
+        self,
+        client: NluClient,
+        request: session_pb2.DetectIntentRequest,
+        response: session_pb2.DetectIntentResponse,
+    ) -> None:
+        """record the turn answered from the cache in the session of CAI, in the background"""
+        self.session_step_tracker.track(client=client, request=request, response=response)
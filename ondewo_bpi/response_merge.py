@@ -0,0 +1,123 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import Any
+
+from google.protobuf.descriptor import FieldDescriptor
+from google.protobuf.message import Message
+from ondewo.logging.logger import logger_console as log
+
+from ondewo_bpi.metrics import (
+    BPI_METRICS,
+    MetricsRegistry,
+)
+
+
+def merge_changes(target: Message, base: Message, changed: Message, metrics: MetricsRegistry = BPI_METRICS) -> None:
+    """
+    three-way merge: apply the changes which lead from `base` to `changed` onto `target`
+
+    `target` starts out as a copy of `base` and may already carry the changes of other copies. Fields (and map keys)
+    which were not changed keep the value of `target`; a field changed in several copies gets the value of the copy
+    merged last. Repeated fields are merged by position: the entries of `base` changed in place are merged entry by
+    entry and entries appended to `base` are appended to `target`, so e.g. one handler editing the first fulfillment
+    message and another one appending a message both take effect. Only if entries of `base` were removed the field
+    of `changed` replaces the one of `target`; if `target` was changed by another copy before, that is a conflict,
+    logged and counted in `response_merge_conflicts_total`.
+    """
+    for field in target.DESCRIPTOR.fields:
+        name: str = field.name
+        if field.label == FieldDescriptor.LABEL_REPEATED:
+            if field.message_type is not None and field.message_type.GetOptions().map_entry:
+                _merge_map(
+                    target=getattr(target, name),
+                    base=getattr(base, name),
+                    changed=getattr(changed, name),
+                    has_message_values=field.message_type.fields_by_name["value"].message_type is not None,
+                )
+            else:
+                _merge_repeated(
+                    target=getattr(target, name),
+                    base=getattr(base, name),
+                    changed=getattr(changed, name),
+                    has_messages=field.message_type is not None,
+                    field_name=field.full_name,
+                    metrics=metrics,
+                )
+        elif field.message_type is not None:
+            if not changed.HasField(name):
+                if base.HasField(name):
+                    target.ClearField(name)
+            elif base.HasField(name) and target.HasField(name):
+                merge_changes(
+                    target=getattr(target, name),
+                    base=getattr(base, name),
+                    changed=getattr(changed, name),
+                    metrics=metrics,
+                )
+            elif not base.HasField(name):
+                getattr(target, name).CopyFrom(getattr(changed, name))
+        elif field.containing_oneof is not None:
+            oneof_name: str = field.containing_oneof.name
+            if changed.WhichOneof(oneof_name) == name:
+                if base.WhichOneof(oneof_name) != name or getattr(base, name) != getattr(changed, name):
+                    setattr(target, name, getattr(changed, name))
+            elif base.WhichOneof(oneof_name) == name and changed.WhichOneof(oneof_name) is None:
+                target.ClearField(name)
+        elif getattr(base, name) != getattr(changed, name):
+            setattr(target, name, getattr(changed, name))
+
+
+def _merge_repeated(
+    target: Any,
+    base: Any,
+    changed: Any,
+    has_messages: bool,
+    field_name: str,
+    metrics: MetricsRegistry,
+) -> None:
+    if list(base) == list(changed):
+        return
+    if len(changed) >= len(base) and len(target) >= len(base):
+        # e.g. two handlers replacing placeholders in different fulfillment messages, or one editing a message and
+        # another one appending a message; the entries appended by other copies stay behind the ones of base
+        for index, (base_item, changed_item) in enumerate(zip(base, changed)):
+            if base_item == changed_item:
+                continue
+            if has_messages:
+                merge_changes(target=target[index], base=base_item, changed=changed_item, metrics=metrics)
+            else:
+                target[index] = changed_item
+        target.extend(changed[len(base):])
+        return
+    if list(target) != list(base):
+        metrics.increment("response_merge_conflicts_total")
+        log.warning(
+            f"conflicting changes of {field_name} by concurrent handlers, entries were removed by one of them: "
+            f"the changes of the other handlers to {field_name} are lost"
+        )
+    del target[:]
+    target.extend(changed)
+
+
+def _merge_map(target: Any, base: Any, changed: Any, has_message_values: bool) -> None:
+    for key in base:
+        if key not in changed and key in target:
+            del target[key]
+    for key in changed:
+        if key in base and base[key] == changed[key]:
+            continue
+        if has_message_values:
+            target[key].CopyFrom(changed[key])
+        else:
+            target[key] = changed[key]
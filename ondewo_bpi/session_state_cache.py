@@ -0,0 +1,306 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from threading import Lock
+from typing import (
+    Dict,
+    Iterator,
+    Optional,
+    Set,
+    Tuple,
+)
+
+import grpc
+from ondewo.logging.logger import logger_console as log
+from ondewo.nlu import (
+    context_pb2,
+    session_pb2,
+)
+from ondewo.nlu.client import Client as NluClient
+
+from ondewo_bpi.config import (
+    ONDEWO_BPI_SESSION_STATE_CACHE_MAX_ENTRIES,
+    ONDEWO_BPI_SESSION_STATE_CACHE_TTL_SECONDS,
+)
+from ondewo_bpi.context_mirror import (
+    SESSION_CONTEXT_MIRROR,
+    SessionContextMirror,
+    get_session_from_context_name,
+)
+from ondewo_bpi.metrics import (
+    BPI_METRICS,
+    MetricsRegistry,
+)
+
+
+@dataclass
+class _CachedContext:
+    # None: the context is known not to exist in CAI
+    context: Optional[context_pb2.Context]
+    expires_at: float
+
+
+class SessionStateCache:
+    """
+    In-process LRU cache of the contexts of the recently active sessions, keyed by the full context name
+
+    Every DetectIntentResponse replaces the cached contexts of its session by its output contexts, which are the alive
+    contexts of the session in CAI after the turn. Contexts read or written by the helpers are cached for
+    `ttl_seconds`. Only a process which sees every turn of a session (or a short TTL) keeps the cache accurate.
+
+    Metrics: session_state_cache_{hits,misses}_total.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = ONDEWO_BPI_SESSION_STATE_CACHE_MAX_ENTRIES,
+        ttl_seconds: float = ONDEWO_BPI_SESSION_STATE_CACHE_TTL_SECONDS,
+        metrics: MetricsRegistry = BPI_METRICS,
+    ) -> None:
+        self.max_entries: int = max_entries
+        self.ttl_seconds: float = ttl_seconds
+        self.metrics: MetricsRegistry = metrics
+        self._entries: "OrderedDict[str, _CachedContext]" = OrderedDict()
+        # session name -> names of its cached contexts, so a session is invalidated without scanning all entries
+        self._session_contexts: Dict[str, Set[str]] = {}
+        self._lock: Lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, context_name: str) -> Tuple[bool, Optional[context_pb2.Context]]:
+        """
+        Returns:
+            whether the context is cached and a copy of it, None if it is known not to exist
+        """
+        with self._lock:
+            cached: Optional[_CachedContext] = self._entries.get(context_name)
+            if cached is not None and cached.expires_at < time.monotonic():
+                self._remove(context_name)
+                cached = None
+            if cached is None:
+                self.metrics.increment("session_state_cache_misses_total")
+                return False, None
+            self._entries.move_to_end(context_name)
+        self.metrics.increment("session_state_cache_hits_total")
+        if cached.context is None:
+            return True, None
+        context: context_pb2.Context = context_pb2.Context()
+        context.CopyFrom(cached.context)
+        return True, context
+
+    def put(self, context_name: str, context: Optional[context_pb2.Context]) -> None:
+        """cache a copy of the context, None records that it does not exist"""
+        stored_context: Optional[context_pb2.Context] = None
+        if context is not None:
+            stored_context = context_pb2.Context()
+            stored_context.CopyFrom(context)
+        with self._lock:
+            self._store(context_name, stored_context)
+
+    def _store(self, context_name: str, context: Optional[context_pb2.Context]) -> None:
+        """must be called with the lock held"""
+        self._entries[context_name] = _CachedContext(context=context, expires_at=time.monotonic() + self.ttl_seconds)
+        self._entries.move_to_end(context_name)
+        self._session_contexts.setdefault(get_session_from_context_name(context_name), set()).add(context_name)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, context_name: str) -> None:
+        """must be called with the lock held"""
+        if self._entries.pop(context_name, None) is None:
+            return
+        session_name: str = get_session_from_context_name(context_name)
+        context_names: Optional[Set[str]] = self._session_contexts.get(session_name)
+        if context_names is not None:
+            context_names.discard(context_name)
+            if not context_names:
+                del self._session_contexts[session_name]
+
+    def invalidate(self, context_name: str) -> None:
+        with self._lock:
+            self._remove(context_name)
+
+    def _invalidate_session(self, session_name: str) -> None:
+        """must be called with the lock held"""
+        for context_name in self._session_contexts.pop(session_name, set()):
+            del self._entries[context_name]
+
+    def invalidate_session(self, session_name: str) -> None:
+        with self._lock:
+            self._invalidate_session(session_name)
+
+    def update_from_response(self, session_name: str, response: session_pb2.DetectIntentResponse) -> None:
+        """replace the cached contexts of the session by the output contexts of the response"""
+        with self._lock:
+            self._invalidate_session(session_name)
+            for output_context in response.query_result.output_contexts:
+                stored_context: context_pb2.Context = context_pb2.Context()
+                stored_context.CopyFrom(output_context)
+                self._store(output_context.name, stored_context)
+
+
+# process wide cache shared by the DetectIntent pipeline, the helpers and the context relays
+SESSION_STATE_CACHE: SessionStateCache = SessionStateCache()
+
+
+@dataclass
+class _PendingWrite:
+    context: context_pb2.Context
+    # whether the context exists in CAI, i.e. is updated rather than created
+    exists: bool
+    # parameters were removed, which UpdateContext cannot do, so the context is deleted and created again
+    recreate: bool = False
+
+
+class SessionStateTurn:
+    """
+    The context reads and writes of the helpers during one turn
+
+    Reads are answered from the writes of the turn, then from the SessionStateCache and only then from CAI. Writes
+    are collected per context and sent to CAI once, by `flush` at the end of the turn: several parameter changes of
+    one context cost one RPC instead of two or three each.
+
+    Metrics: session_state_writes_coalesced_total, session_state_writes_flushed_total and
+    session_state_flush_errors_total.
+    """
+
+    def __init__(
+        self,
+        client: NluClient,
+        cache: SessionStateCache = SESSION_STATE_CACHE,
+        context_mirror: SessionContextMirror = SESSION_CONTEXT_MIRROR,
+    ) -> None:
+        self.client: NluClient = client
+        self.cache: SessionStateCache = cache
+        # the written contexts are alive in CAI, e.g. the response cache must not take the session as context-free
+        self.context_mirror: SessionContextMirror = context_mirror
+        self._pending: Dict[str, _PendingWrite] = {}
+        # handlers of a turn may run concurrently
+        self._lock: Lock = Lock()
+
+    def read(self, context_name: str) -> Optional[context_pb2.Context]:
+        """
+        Returns:
+            a copy of the current context, None if it does not exist
+        """
+        with self._lock:
+            pending: Optional[_PendingWrite] = self._pending.get(context_name)
+            if pending is not None:
+                context: context_pb2.Context = context_pb2.Context()
+                context.CopyFrom(pending.context)
+                return context
+        is_cached, cached_context = self.cache.get(context_name)
+        if is_cached:
+            return cached_context
+        try:
+            existing_context: Optional[context_pb2.Context] = self.client.services.contexts.get_context(
+                request=context_pb2.GetContextRequest(name=context_name),
+            )
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.NOT_FOUND:  # type: ignore[attr-defined]
+                raise
+            existing_context = None
+        self.cache.put(context_name, existing_context)
+        return existing_context
+
+    def write(self, context: context_pb2.Context, exists: bool, recreate: bool = False) -> None:
+        """
+        Args:
+            context: the complete new state of the context
+            exists: whether the context was read from CAI (or the cache) rather than newly created
+            recreate: parameters were removed from the context
+        """
+        written_context: context_pb2.Context = context_pb2.Context()
+        written_context.CopyFrom(context)
+        with self._lock:
+            pending: Optional[_PendingWrite] = self._pending.get(context.name)
+            if pending is None:
+                self._pending[context.name] = _PendingWrite(context=written_context, exists=exists, recreate=recreate)
+                return
+            BPI_METRICS.increment("session_state_writes_coalesced_total")
+            pending.context = written_context
+            pending.recreate = pending.recreate or recreate
+
+    def flush(self) -> None:
+        """send the writes of the turn to CAI"""
+        with self._lock:
+            pending_writes: Dict[str, _PendingWrite] = self._pending
+            self._pending = {}
+        for context_name, pending in pending_writes.items():
+            session_name: str = get_session_from_context_name(context_name)
+            try:
+                if not pending.exists:
+                    self.client.services.contexts.create_context(
+                        request=context_pb2.CreateContextRequest(session_id=session_name, context=pending.context)
+                    )
+                elif pending.recreate:
+                    self.client.services.contexts.delete_context(
+                        request=context_pb2.DeleteContextRequest(name=context_name),
+                    )
+                    self.client.services.contexts.create_context(
+                        request=context_pb2.CreateContextRequest(session_id=session_name, context=pending.context)
+                    )
+                else:
+                    self.client.services.contexts.update_context(
+                        request=context_pb2.UpdateContextRequest(context=pending.context),
+                    )
+            except Exception as e:
+                self.cache.invalidate(context_name)
+                self.context_mirror.invalidate(session_name)  # the write may or may not have happened
+                BPI_METRICS.increment("session_state_flush_errors_total")
+                log.exception(f"writing the context {context_name} to CAI failed: {e}")
+                continue
+            self.cache.put(context_name, pending.context)
+            self.context_mirror.update_from_write(pending.context)
+            BPI_METRICS.increment("session_state_writes_flushed_total")
+
+
+_current_turn: "ContextVar[Optional[SessionStateTurn]]" = ContextVar("bpi_session_state_turn", default=None)
+
+
+def get_current_turn() -> Optional[SessionStateTurn]:
+    """the turn served in the current thread (or asyncio task), None outside of DetectIntent"""
+    return _current_turn.get()
+
+
+@contextmanager
+def session_state_turn(
+    client: NluClient,
+    cache: SessionStateCache = SESSION_STATE_CACHE,
+    flush: bool = True,
+) -> Iterator[SessionStateTurn]:
+    """
+    collect the context writes of the helpers while the block runs and flush them at its end (unless `flush` is
+    False, e.g. to flush from an executor in asyncio code)
+    """
+    turn: SessionStateTurn = SessionStateTurn(client=client, cache=cache)
+    token = _current_turn.set(turn)
+    try:
+        yield turn
+    finally:
+        _current_turn.reset(token)
+        if flush:
+            turn.flush()
+
+
+def flush_session_state() -> None:
+    """send the context writes of the current turn now, e.g. before a handler calls DetectIntent itself"""
+    turn: Optional[SessionStateTurn] = get_current_turn()
+    if turn is not None:
+        turn.flush()
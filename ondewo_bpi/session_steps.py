@@ -0,0 +1,117 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from ondewo.logging.logger import logger_console as log
+from ondewo.nlu import session_pb2
+from ondewo.nlu.client import Client as NluClient
+
+from ondewo_bpi.config import (
+    ONDEWO_BPI_SESSION_STEP_MAX_PENDING,
+    ONDEWO_BPI_SESSION_STEP_WORKERS,
+)
+from ondewo_bpi.metrics import (
+    BPI_METRICS,
+    MetricsRegistry,
+)
+
+
+def adapt_local_response(
+    response: session_pb2.DetectIntentResponse,
+    request: session_pb2.DetectIntentRequest,
+) -> session_pb2.DetectIntentResponse:
+    """
+    fill in what CAI would have set in a response which the BPI answers itself (from a cache or a hook)
+
+    Returns:
+        the response with a new response id, the query text and the session id of the request
+    """
+    response.response_id = str(uuid.uuid4())
+    if request.query_input.WhichOneof("input") == "text":
+        response.query_result.query_text = request.query_input.text.text
+    response.query_result.diagnostic_info["sessionId"] = request.session
+    return response
+
+
+class SessionStepTracker:
+    """
+    Records turns which the BPI answered without CAI as session steps in CAI, so the session history stays complete
+
+    The steps are sent by `num_workers` background threads, DetectIntent does not wait for them. At most
+    `max_pending` steps wait to be sent, further steps are dropped (e.g. while CAI is slow) and counted in
+    `dropped_metric`. Failures are logged and counted in `errors_metric`.
+    """
+
+    def __init__(
+        self,
+        errors_metric: str,
+        dropped_metric: str,
+        num_workers: int = ONDEWO_BPI_SESSION_STEP_WORKERS,
+        max_pending: int = ONDEWO_BPI_SESSION_STEP_MAX_PENDING,
+        metrics: MetricsRegistry = BPI_METRICS,
+    ) -> None:
+        self.errors_metric: str = errors_metric
+        self.dropped_metric: str = dropped_metric
+        self.max_pending: int = max_pending
+        self.metrics: MetricsRegistry = metrics
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=num_workers,
+            thread_name_prefix="bpi_session_step",
+        )
+        self._pending: int = 0
+        self._lock: Lock = Lock()
+
+    @property
+    def pending(self) -> int:
+        """number of steps submitted and not yet sent"""
+        return self._pending
+
+    def track(
+        self,
+        client: NluClient,
+        request: session_pb2.DetectIntentRequest,
+        response: session_pb2.DetectIntentResponse,
+    ) -> None:
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.metrics.increment(self.dropped_metric)
+                log.warning(f"too many session steps waiting to be sent, dropped the step of {request.session}")
+                return
+            self._pending += 1
+        track_request: session_pb2.TrackSessionStepRequest = session_pb2.TrackSessionStepRequest(
+            session_id=request.session,
+            session_step=session_pb2.SessionStep(
+                detect_intent_request=request,
+                detect_intent_response=response,
+                contexts=response.query_result.output_contexts,
+            ),
+            session_view=session_pb2.Session.View.VIEW_SPARSE,
+        )
+
+        def track() -> None:
+            try:
+                client.services.sessions.track_session_step(track_request)
+            except Exception as e:
+                self.metrics.increment(self.errors_metric)
+                log.warning(f"tracking the session step of a local response of {request.session} failed: {e}")
+            finally:
+                with self._lock:
+                    self._pending -= 1
+
+        self._executor.submit(track)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
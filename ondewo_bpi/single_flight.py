@@ -0,0 +1,193 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from hashlib import blake2b
+from threading import Lock
+from typing import (
+    Any,
+    List,
+    Optional,
+    Tuple,
+)
+
+from ondewo.logging.logger import logger_console as log
+from ondewo.nlu import session_pb2
+
+from ondewo_bpi.config import (
+    ONDEWO_BPI_SINGLE_FLIGHT_MAX_ENTRIES,
+    ONDEWO_BPI_SINGLE_FLIGHT_WINDOW_SECONDS,
+)
+from ondewo_bpi.deadline import is_context_active
+from ondewo_bpi.metrics import (
+    BPI_METRICS,
+    MetricsRegistry,
+)
+from ondewo_bpi.state_store import (
+    StateStore,
+    read_shared,
+    write_shared,
+)
+
+
+def get_request_fingerprint(request: session_pb2.DetectIntentRequest) -> bytes:
+    """hash of session, query input (text, event or audio config), audio and query parameters of the request"""
+    return blake2b(request.SerializeToString(deterministic=True), digest_size=16).digest()
+
+
+class Flight:
+    """
+    One DetectIntent call served for all identical requests which arrive while it runs or shortly after
+
+    A flight stands in for the servicer context of the call in `request_budget`: it stays active as long as any of the
+    attached callers is still waiting, so the work is not stopped because the first caller gave up (e.g. the retry of
+    envoy after a connection reset attaches to the flight of the original request).
+    """
+
+    def __init__(self, context: Any) -> None:
+        self.future: "Future[session_pb2.DetectIntentResponse]" = Future()
+        self.future.set_running_or_notify_cancel()
+        self.contexts: List[Any] = [context]
+        self.finished_at: Optional[float] = None
+
+    def time_remaining(self) -> Optional[float]:
+        """the deadline of the first caller, it was already propagated to CAI"""
+        remaining: Optional[float] = self.contexts[0].time_remaining()
+        return remaining
+
+    def is_active(self) -> bool:
+        return any(is_context_active(context) for context in self.contexts)
+
+    def get_response(self, timeout: Optional[float] = None) -> session_pb2.DetectIntentResponse:
+        """
+        Returns:
+            a copy of the response of the flight, every caller may modify its response
+        """
+        response: session_pb2.DetectIntentResponse = session_pb2.DetectIntentResponse()
+        response.CopyFrom(self.future.result(timeout=timeout))
+        return response
+
+
+class SingleFlight:
+    """
+    Deduplicates identical DetectIntent requests, e.g. retries of envoy or of the client
+
+    The first request of a fingerprint leads a flight; an identical request arriving while the flight runs attaches to
+    it and an identical request arriving up to `window_seconds` after it finished gets a copy of its response. Either
+    way CAI is called and the handlers run only once. A failed flight is forgotten immediately, so later retries are
+    served again; callers attached to it get its error.
+
+    With a `state_store` the responses of the finished flights are shared with the other replicas for
+    `window_seconds`, so a retry which the load balancer sends to another replica is also a late duplicate. Requests
+    running at the same time in different replicas are not deduplicated.
+
+    Metrics: single_flight_{leaders,attached,late_duplicates,shared_duplicates}_total.
+    """
+
+    def __init__(
+        self,
+        window_seconds: float = ONDEWO_BPI_SINGLE_FLIGHT_WINDOW_SECONDS,
+        max_entries: int = ONDEWO_BPI_SINGLE_FLIGHT_MAX_ENTRIES,
+        metrics: MetricsRegistry = BPI_METRICS,
+        state_store: Optional[StateStore] = None,
+    ) -> None:
+        self.window_seconds: float = window_seconds
+        self.max_entries: int = max_entries
+        self.metrics: MetricsRegistry = metrics
+        self.state_store: Optional[StateStore] = state_store
+        self._flights: "OrderedDict[bytes, Flight]" = OrderedDict()
+        self._lock: Lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    def _forget_expired(self, now: float) -> None:
+        """must be called with the lock held; flights are ordered by start, finished ones can be anywhere"""
+        for key, flight in list(self._flights.items()):
+            if flight.finished_at is not None and now - flight.finished_at > self.window_seconds:
+                del self._flights[key]
+        while len(self._flights) > self.max_entries:
+            self._flights.popitem(last=False)
+
+    def join(self, key: bytes, context: Any) -> Tuple[Flight, bool]:
+        """
+        Returns:
+            the flight of the request and whether the caller leads it, i.e. has to serve the request
+        """
+        flight, is_leader = self._join_local(key=key, context=context)
+        if not is_leader or self.state_store is None:
+            return flight, is_leader
+        value: Optional[bytes] = read_shared(self.state_store, self.get_shared_key(key), metrics=self.metrics)
+        if value is None:
+            return flight, is_leader
+        # another replica served the request within the window: the flight just started is finished with its response
+        self.metrics.increment("single_flight_shared_duplicates_total")
+        log.info("SingleFlight: duplicate DetectIntent request answered with the response of another replica")
+        self.succeed(key=key, flight=flight, response=session_pb2.DetectIntentResponse.FromString(value), share=False)
+        return flight, False
+
+    def _join_local(self, key: bytes, context: Any) -> Tuple[Flight, bool]:
+        now: float = time.monotonic()
+        with self._lock:
+            flight: Optional[Flight] = self._flights.get(key)
+            if flight is not None and flight.finished_at is not None \
+                    and now - flight.finished_at > self.window_seconds:
+                del self._flights[key]
+                flight = None
+            if flight is not None:
+                flight.contexts.append(context)
+                self.metrics.increment(
+                    "single_flight_attached_total" if flight.finished_at is None
+                    else "single_flight_late_duplicates_total"
+                )
+                log.info("SingleFlight: duplicate DetectIntent request attached to the call of the first one")
+                return flight, False
+            if len(self._flights) >= self.max_entries:
+                self._forget_expired(now)
+            flight = Flight(context=context)
+            self._flights[key] = flight
+        self.metrics.increment("single_flight_leaders_total")
+        return flight, True
+
+    def succeed(
+        self,
+        key: bytes,
+        flight: Flight,
+        response: session_pb2.DetectIntentResponse,
+        share: bool = True,
+    ) -> None:
+        stored_response: session_pb2.DetectIntentResponse = session_pb2.DetectIntentResponse()
+        stored_response.CopyFrom(response)
+        with self._lock:
+            flight.finished_at = time.monotonic()
+        flight.future.set_result(stored_response)
+        if share and self.state_store is not None:
+            write_shared(
+                self.state_store,
+                key=self.get_shared_key(key),
+                value=stored_response.SerializeToString(),
+                ttl_seconds=self.window_seconds,
+                metrics=self.metrics,
+            )
+
+    @staticmethod
+    def get_shared_key(key: bytes) -> str:
+        return f"single_flight:{key.hex()}"
+
+    def fail(self, key: bytes, flight: Flight, error: BaseException) -> None:
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.future.set_exception(error)
@@ -0,0 +1,65 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+from typing import (
+    Any,
+    Callable,
+    Optional,
+)
+
+from ondewo_bpi.metrics import (
+    BPI_METRICS,
+    MetricsRegistry,
+    get_callable_name,
+    with_labels,
+)
+
+# histogram of the stages of DetectIntent, labelled with stage and (once CAI answered) intent
+DETECT_INTENT_STAGE_SECONDS: str = "detect_intent_stage_seconds"
+# histogram of every intent handler call, labelled with intent and handler
+INTENT_HANDLER_SECONDS: str = "intent_handler_seconds"
+# histogram of the background write back of the contexts changed in one session
+CONTEXT_SYNC_SECONDS: str = "context_sync_seconds"
+
+
+def observe_stage(
+    stage: str,
+    started_at: float,
+    intent_name: Optional[str] = None,
+    metrics: MetricsRegistry = BPI_METRICS,
+) -> None:
+    """record the time since `started_at` (time.perf_counter) of a DetectIntent stage"""
+    labels = {"stage": stage} if intent_name is None else {"stage": stage, "intent": intent_name}
+    metrics.observe(with_labels(DETECT_INTENT_STAGE_SECONDS, **labels), time.perf_counter() - started_at)
+
+
+def observe_intent_handler(
+    handler: Callable,
+    intent_name: str,
+    started_at: float,
+    metrics: MetricsRegistry = BPI_METRICS,
+) -> None:
+    metrics.observe(
+        with_labels(INTENT_HANDLER_SECONDS, intent=intent_name, handler=get_callable_name(handler)),
+        time.perf_counter() - started_at,
+    )
+
+
+def call_intent_handler(handler: Callable, intent_name: str, *args: Any) -> Any:
+    """call a synchronous intent handler and record its duration, also if it raises"""
+    started_at: float = time.perf_counter()
+    try:
+        return handler(*args)
+    finally:
+        observe_intent_handler(handler=handler, intent_name=intent_name, started_at=started_at)
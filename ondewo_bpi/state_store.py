@@ -0,0 +1,264 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+from abc import (
+    ABCMeta,
+    abstractmethod,
+)
+from threading import Lock
+from typing import (
+    Any,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from ondewo.logging.logger import logger_console as log
+
+from ondewo_bpi.config import (
+    ONDEWO_BPI_STATE_STORE_KEY_PREFIX,
+    ONDEWO_BPI_STATE_STORE_URL,
+)
+from ondewo_bpi.metrics import (
+    BPI_METRICS,
+    MetricsRegistry,
+)
+
+
+class StateStore(metaclass=ABCMeta):
+    """
+    Key-value store for state shared by the BPI replicas, e.g. cached responses or deduplication windows
+
+    Values are bytes (serialized protobuf messages); every value may expire after `ttl_seconds`.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        pass
+
+    @abstractmethod
+    def set(self, key: str, value: bytes, ttl_seconds: Optional[float] = None) -> None:
+        pass
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        pass
+
+    @abstractmethod
+    def compare_and_set(
+        self,
+        key: str,
+        expected: Optional[bytes],
+        value: bytes,
+        ttl_seconds: Optional[float] = None,
+    ) -> bool:
+        """
+        set the value only if the current value is `expected` (None: the key does not exist)
+
+        Returns:
+            whether the value was set
+        """
+
+    def get_many(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        """the values of the keys, in one round trip where the store supports it"""
+        return [self.get(key) for key in keys]
+
+    def set_many(self, values: Mapping[str, bytes], ttl_seconds: Optional[float] = None) -> None:
+        """set all values, in one round trip where the store supports it"""
+        for key, value in values.items():
+            self.set(key, value, ttl_seconds=ttl_seconds)
+
+
+class InMemoryStateStore(StateStore):
+    """StateStore of a single process, the default and the stand-in for a shared store in tests"""
+
+    def __init__(self) -> None:
+        # key -> (value, expiry on the monotonic clock or None)
+        self._values: Dict[str, Tuple[bytes, Optional[float]]] = {}
+        self._lock: Lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def _get(self, key: str) -> Optional[bytes]:
+        """must be called with the lock held"""
+        entry: Optional[Tuple[bytes, Optional[float]]] = self._values.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._values[key]
+            return None
+        return value
+
+    def _set(self, key: str, value: bytes, ttl_seconds: Optional[float]) -> None:
+        """must be called with the lock held"""
+        self._values[key] = (value, time.monotonic() + ttl_seconds if ttl_seconds is not None else None)
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            return self._get(key)
+
+    def set(self, key: str, value: bytes, ttl_seconds: Optional[float] = None) -> None:
+        with self._lock:
+            self._set(key, value, ttl_seconds)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._values.pop(key, None)
+
+    def compare_and_set(
+        self,
+        key: str,
+        expected: Optional[bytes],
+        value: bytes,
+        ttl_seconds: Optional[float] = None,
+    ) -> bool:
+        with self._lock:
+            if self._get(key) != expected:
+                return False
+            self._set(key, value, ttl_seconds)
+            return True
+
+    def get_many(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        with self._lock:
+            return [self._get(key) for key in keys]
+
+    def set_many(self, values: Mapping[str, bytes], ttl_seconds: Optional[float] = None) -> None:
+        with self._lock:
+            for key, value in values.items():
+                self._set(key, value, ttl_seconds)
+
+
+# KEYS[1]: key, ARGV: expected exists ("1"/"0"), expected value, new value, ttl in milliseconds ("0": none)
+_COMPARE_AND_SET_SCRIPT: str = """
+local current = redis.call('GET', KEYS[1])
+if ARGV[1] == '1' then
+    if current ~= ARGV[2] then return 0 end
+elseif current then
+    return 0
+end
+if ARGV[4] == '0' then
+    redis.call('SET', KEYS[1], ARGV[3])
+else
+    redis.call('SET', KEYS[1], ARGV[3], 'PX', ARGV[4])
+end
+return 1
+"""
+
+
+class RedisStateStore(StateStore):
+    """
+    StateStore in a Redis (or API compatible, e.g. Valkey or KeyDB) server shared by all replicas
+
+    Takes a client with the interface of `redis.Redis`, so any compatible client (or a local stand-in) can be used;
+    `from_url` creates one with the optional `redis` package. All keys are prefixed with `key_prefix`.
+    """
+
+    def __init__(self, client: Any, key_prefix: str = ONDEWO_BPI_STATE_STORE_KEY_PREFIX) -> None:
+        self.client: Any = client
+        self.key_prefix: str = key_prefix
+
+    @classmethod
+    def from_url(cls, url: str, key_prefix: str = ONDEWO_BPI_STATE_STORE_KEY_PREFIX) -> "RedisStateStore":
+        try:
+            import redis
+        except ImportError as e:
+            raise ImportError(f"the state store {url} needs the redis package, `pip install redis`") from e
+        return cls(client=redis.Redis.from_url(url), key_prefix=key_prefix)
+
+    @staticmethod
+    def _ttl_milliseconds(ttl_seconds: Optional[float]) -> Optional[int]:
+        return max(1, int(ttl_seconds * 1000)) if ttl_seconds is not None else None
+
+    def get(self, key: str) -> Optional[bytes]:
+        value: Optional[bytes] = self.client.get(self.key_prefix + key)
+        return value
+
+    def set(self, key: str, value: bytes, ttl_seconds: Optional[float] = None) -> None:
+        self.client.set(self.key_prefix + key, value, px=self._ttl_milliseconds(ttl_seconds))
+
+    def delete(self, key: str) -> None:
+        self.client.delete(self.key_prefix + key)
+
+    def compare_and_set(
+        self,
+        key: str,
+        expected: Optional[bytes],
+        value: bytes,
+        ttl_seconds: Optional[float] = None,
+    ) -> bool:
+        ttl_milliseconds: Optional[int] = self._ttl_milliseconds(ttl_seconds)
+        return bool(self.client.eval(
+            _COMPARE_AND_SET_SCRIPT, 1, self.key_prefix + key,
+            "0" if expected is None else "1", expected or b"", value, str(ttl_milliseconds or 0),
+        ))
+
+    def get_many(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        if not keys:
+            return []
+        return list(self.client.mget([self.key_prefix + key for key in keys]))
+
+    def set_many(self, values: Mapping[str, bytes], ttl_seconds: Optional[float] = None) -> None:
+        pipeline: Any = self.client.pipeline(transaction=False)
+        for key, value in values.items():
+            pipeline.set(self.key_prefix + key, value, px=self._ttl_milliseconds(ttl_seconds))
+        pipeline.execute()
+
+
+def create_state_store(url: str = ONDEWO_BPI_STATE_STORE_URL) -> Optional[StateStore]:
+    """
+    Returns:
+        the shared state store configured by ONDEWO_BPI_STATE_STORE_URL ("memory://" for an in-process store, e.g. in
+        tests, "redis://..." or "rediss://..." for a Redis server), None if it is not set
+    """
+    if not url:
+        return None
+    if url.startswith("memory://"):
+        return InMemoryStateStore()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        log.info(f"sharing BPI state in {url.split('@')[-1]}")
+        return RedisStateStore.from_url(url)
+    raise ValueError(f"unsupported state store url {url}, use memory://, redis:// or rediss://")
+
+
+def read_shared(store: StateStore, key: str, metrics: MetricsRegistry = BPI_METRICS) -> Optional[bytes]:
+    """
+    Returns:
+        the value of the key, None if it is not set or the store is unavailable (counted in state_store_errors_total)
+    """
+    try:
+        return store.get(key)
+    except Exception as e:
+        metrics.increment("state_store_errors_total")
+        log.warning(f"reading {key} from the shared state store failed: {e}")
+        return None
+
+
+def write_shared(
+    store: StateStore,
+    key: str,
+    value: bytes,
+    ttl_seconds: Optional[float],
+    metrics: MetricsRegistry = BPI_METRICS,
+) -> None:
+    """set the key, an unavailable store only loses the shared copy (counted in state_store_errors_total)"""
+    try:
+        store.set(key, value, ttl_seconds=ttl_seconds)
+    except Exception as e:
+        metrics.increment("state_store_errors_total")
+        log.warning(f"writing {key} to the shared state store failed: {e}")
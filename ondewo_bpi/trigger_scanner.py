@@ -0,0 +1,186 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import re
+from threading import Lock
+from typing import (
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Pattern,
+    Tuple,
+)
+
+from ondewo.nlu import intent_pb2
+
+from ondewo_bpi.constants import (
+    QueryTriggers,
+    SipTriggers,
+)
+
+# characters which do not stand for themselves at the start of a pattern
+_REGEX_SPECIAL_CHARACTERS: FrozenSet[str] = frozenset("\\.^$*+?{}[]|()")
+
+
+def _has_top_level_alternation(pattern: str) -> bool:
+    """True for e.g. 'STOP|HALT', whose alternatives start with different characters, False for '<(a|b)>'"""
+    depth: int = 0
+    in_class: bool = False
+    index: int = 0
+    while index < len(pattern):
+        character: str = pattern[index]
+        if character == "\\":
+            index += 1  # the escaped character stands for itself
+        elif in_class:
+            in_class = character != "]"
+        elif character == "[":
+            in_class = True
+            if pattern[index + 1:index + 2] == "^":
+                index += 1
+            if pattern[index + 1:index + 2] == "]":
+                index += 1  # "[]...]", the first "]" is part of the class
+        elif character == "(":
+            depth += 1
+        elif character == ")":
+            depth -= 1
+        elif character == "|" and depth == 0:
+            return True
+        index += 1
+    return False
+
+
+def _first_literal(pattern: str) -> Optional[str]:
+    """the character every match of the pattern starts with, None if it is not a plain literal"""
+    if len(pattern) < 2 or pattern[0] in _REGEX_SPECIAL_CHARACTERS or pattern[1] in "*?{":
+        return None
+    if _has_top_level_alternation(pattern):
+        return None
+    return pattern[0]
+
+
+def _clean_argument(argument: str) -> str:
+    return argument.strip("(").strip(")").strip("'")
+
+
+class _CompiledTriggers:
+    """the registered patterns compiled into one regular expression"""
+
+    def __init__(self, patterns: Tuple[str, ...]) -> None:
+        self.patterns: Tuple[str, ...] = patterns
+        # pattern -> (name of the group of the whole match, number of the group of its argument or None)
+        self.groups: List[Tuple[str, Optional[int]]] = []
+        alternatives: List[str] = []
+        group_number: int = 0
+        for index, pattern in enumerate(patterns):
+            group_name: str = f"_trigger_{index}"
+            pattern_groups: int = re.compile(pattern).groups
+            group_number += 1
+            argument_group: Optional[int] = group_number + 1 if pattern_groups else None
+            group_number += pattern_groups
+            self.groups.append((group_name, argument_group))
+            alternatives.append(f"(?P<{group_name}>{pattern})")
+        first_literals: List[Optional[str]] = [_first_literal(pattern) for pattern in patterns]
+        # skip texts without any character a match could start with, e.g. without "<"
+        self.prefilter: Optional[FrozenSet[str]] = (
+            frozenset(first_literals) if patterns and None not in first_literals else None  # type: ignore[arg-type]
+        )
+        # a lookahead matches at every position, so triggers inside other triggers are found as well
+        start: str = f"(?=[{''.join(re.escape(c) for c in sorted(self.prefilter))}])" if self.prefilter else ""
+        self.regex: Optional[Pattern[str]] = (
+            re.compile(f"{start}(?=" + "|".join(alternatives) + ")") if patterns else None
+        )
+
+    def may_match(self, text: str) -> bool:
+        if not text or self.regex is None:
+            return False
+        return self.prefilter is None or any(literal in text for literal in self.prefilter)
+
+    def scan(self, text: str) -> Dict[str, List[str]]:
+        """pattern -> arguments of its matches (the first group, or the whole match without a group)"""
+        found: Dict[str, List[str]] = {}
+        if not self.may_match(text):
+            return found
+        # as re.findall, the matches of a pattern do not overlap
+        match_end: Dict[int, int] = {}
+        for match in self.regex.finditer(text):  # type: ignore[union-attr]
+            for index, (group_name, argument_group) in enumerate(self.groups):
+                start: int = match.start(group_name)
+                if start < 0:
+                    continue
+                if start < match_end.get(index, 0):
+                    break
+                match_end[index] = match.end(group_name)
+                argument: str = match.group(argument_group if argument_group else group_name) or ""
+                found.setdefault(self.patterns[index], []).append(_clean_argument(argument))
+                break
+        return found
+
+
+class TriggerScanner:
+    """
+    Finds all triggers of a fulfillment message in one pass over its text and one over its card subtitle
+
+    The registered trigger patterns are compiled into one regular expression with a named group per pattern; texts
+    without a character a trigger starts with (for the built-in triggers "<") are not scanned at all. Register further
+    patterns with `register`. If several patterns match at the same position, the first registered one counts.
+    """
+
+    def __init__(self, patterns: Iterable[str] = ()) -> None:
+        self._lock: Lock = Lock()
+        self._compiled: _CompiledTriggers = _CompiledTriggers(tuple(dict.fromkeys(patterns)))
+
+    @classmethod
+    def with_default_triggers(cls) -> "TriggerScanner":
+        return cls(patterns=[trigger.value for trigger in [*SipTriggers, *QueryTriggers]])
+
+    @property
+    def patterns(self) -> Tuple[str, ...]:
+        return self._compiled.patterns
+
+    def register(self, pattern: str) -> None:
+        """add a trigger pattern; its first group (or the whole match) is the argument of the trigger"""
+        with self._lock:
+            if pattern not in self._compiled.patterns:
+                # compiled before it replaces the current patterns, an invalid pattern (re.error) changes nothing
+                self._compiled = _CompiledTriggers(self._compiled.patterns + (pattern,))
+
+    def scan(self, message: intent_pb2.Intent.Message) -> Dict[str, List[str]]:
+        """
+        trigger pattern -> its arguments, of the triggers found in the text and the card subtitle of the message
+
+        As MessageHandler.get_triggers always did: a trigger anywhere in the texts is found, its arguments are taken
+        from the first text and the card subtitle. The triggers are ordered as registered.
+        """
+        compiled: _CompiledTriggers = self._compiled
+        found_in_text: Dict[str, List[str]] = {}
+        found_in_card: Dict[str, List[str]] = {}
+        if message.HasField("text") and message.text.text:
+            found_in_text = compiled.scan(message.text.text[0])
+            if len(message.text.text) > 1:
+                for pattern in compiled.scan("".join(message.text.text)):
+                    found_in_text.setdefault(pattern, [])
+        if message.HasField("card"):
+            found_in_card = compiled.scan(message.card.subtitle)
+        if not found_in_text and not found_in_card:
+            return {}
+        return {
+            pattern: found_in_text.get(pattern, []) + found_in_card.get(pattern, [])
+            for pattern in compiled.patterns
+            if pattern in found_in_text or pattern in found_in_card
+        }
+
+
+# the built-in SipTriggers and QueryTriggers, used by MessageHandler.get_triggers
+DEFAULT_TRIGGER_SCANNER: TriggerScanner = TriggerScanner.with_default_triggers()
@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import asyncio
+import contextvars
 import time
 from typing import (
     Any,
@@ -54,6 +55,10 @@ from ondewo.qa.qa_pb2 import (
 )
 
 from ondewo_bpi.config import ONDEWO_BPI_SENTENCE_TRUNCATION
+from ondewo_bpi.deadline import (
+    request_budget,
+    with_deadline_propagation,
+)
 from ondewo_bpi_qa.bpi_qa_base_server import BpiQABaseServer
 from ondewo_bpi_qa.config import (
     QA_ACTIVE,
@@ -80,7 +85,9 @@ from ondewo_bpi_qa.helper import ContextHelper
 class QAServer(BpiQABaseServer):
     def __init__(self) -> None:
         super().__init__()
-        self.qa_client_stub = qa_pb2_grpc.QAStub(channel=grpc.insecure_channel(f"{QA_HOST}:{QA_PORT}"))
+        self.qa_client_stub = qa_pb2_grpc.QAStub(
+            channel=with_deadline_propagation(grpc.insecure_channel(f"{QA_HOST}:{QA_PORT}")),
+        )
         self.loops: Dict[str, Any] = {}  # Async execution loops
 
     def serve(self) -> None:
@@ -102,14 +109,19 @@ class QAServer(BpiQABaseServer):
         truncated_text: TextInput = TextInput(text=request.query_input.text.text[:ONDEWO_BPI_SENTENCE_TRUNCATION])
         request.query_input.text.CopyFrom(truncated_text)
 
-        self.create_session_if_not_exists(request=request)
-        request: DetectIntentRequest = self.handle_context_injection_for_qa(request=request)  # Side-effect!
-        response, response_name = self.handle_predictions(request=request)
-
-        if response_name == CAI_RESPONSE_NAME:
-            # Process CAI response
-            response = self.process_messages(response)
-            response = self.process_intent_handler(response)
+        # the deadline of the caller is the timeout of every CAI and QA call
+        with request_budget(context):
+            self.create_session_if_not_exists(request=request)
+            request: DetectIntentRequest = self.handle_context_injection_for_qa(request=request)  # Side-effect!
+            response, response_name = self.handle_predictions(request=request)
+
+            if response_name == CAI_RESPONSE_NAME:
+                abandoned_status: Optional[grpc.StatusCode] = self._get_abandoned_status(stage="process_messages")
+                if abandoned_status is not None:
+                    context.abort(abandoned_status, "the caller has abandoned the call")
+                # Process CAI response
+                response = self.process_messages(response)
+                response = self.process_intent_handler(response)
         return response
 
     def check_session_id(self, request: DetectIntentRequest) -> None:
@@ -289,7 +301,7 @@ class QAServer(BpiQABaseServer):
             }
         )
         qa_response: DetectIntentResponse = await self.loops[request.session]["loop"].run_in_executor(
-            None, self.qa_client_stub.GetAnswer, qa_request,
+            None, contextvars.copy_context().run, self.qa_client_stub.GetAnswer, qa_request,
         )
         # intent_name_qa = qa_response.query_result.intent.display_name
         log.debug({"message": "QA-DetectIntentResponse from QA", "tags": ["text"]})
@@ -306,7 +318,7 @@ class QAServer(BpiQABaseServer):
             }
         )
         cai_response: DetectIntentResponse = await self.loops[request.session]["loop"].run_in_executor(
-            None, self.client.services.sessions.detect_intent, request,
+            None, contextvars.copy_context().run, self.client.services.sessions.detect_intent, request,
         )
         intent_name_cai = cai_response.query_result.intent.display_name
         log.debug(
@@ -0,0 +1,159 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from concurrent import futures
+from threading import Event
+from typing import (
+    Any,
+    Callable,
+    List,
+)
+from unittest.mock import MagicMock
+
+import grpc
+import pytest
+
+from ondewo_bpi.admission_control import (
+    AdmissionControlInterceptor,
+    AimdConcurrencyLimiter,
+    RETRY_AFTER_METADATA_KEY,
+)
+from ondewo_bpi.bpi_server import BpiServer
+from ondewo_bpi.config import ONDEWO_BPI_RETRY_AFTER_MS
+
+
+def test_aimd_limiter_decreases_on_slow_calls_and_grows_on_fast_calls() -> None:
+    limiter = AimdConcurrencyLimiter(
+        initial_limit=10,
+        min_limit=2,
+        max_limit=20,
+        latency_threshold_seconds=1.0,
+        backoff_ratio=0.5,
+        decrease_cooldown_seconds=0.0,
+    )
+    assert limiter.try_acquire()
+    limiter.release(latency_seconds=5.0)
+    assert limiter.limit == 5
+
+    for _ in range(3):
+        assert limiter.try_acquire()
+        limiter.release(overloaded=True)
+    assert limiter.limit == limiter.min_limit
+
+    for _ in range(200):
+        while limiter.try_acquire():
+            pass
+        limiter.release(latency_seconds=0.01)
+        while limiter.inflight:
+            limiter.release(latency_seconds=None)
+    assert limiter.limit > limiter.min_limit
+    assert limiter.limit <= limiter.max_limit
+
+
+def test_admission_control_rejects_with_retry_after_when_saturated() -> None:
+    entered: Event = Event()
+    release: Event = Event()
+
+    def slow_call(request: Any, context: grpc.ServicerContext) -> bytes:
+        entered.set()
+        release.wait(timeout=10)
+        return request
+
+    interceptor = AdmissionControlInterceptor(
+        limiter=AimdConcurrencyLimiter(initial_limit=1, min_limit=1, max_limit=1, latency_threshold_seconds=1.0),
+        retry_after_ms=250,
+    )
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4), interceptors=[interceptor])
+    server.add_generic_rpc_handlers(
+        (grpc.method_handlers_generic_handler("test.Service", {"Call": grpc.unary_unary_rpc_method_handler(slow_call)}),)
+    )
+    port: int = server.add_insecure_port("localhost:0")
+    server.start()
+    try:
+        with grpc.insecure_channel(f"localhost:{port}") as channel:
+            call = channel.unary_unary("/test.Service/Call")
+            first: Any = call.future(b"first")
+            assert entered.wait(timeout=10)
+
+            with pytest.raises(grpc.RpcError) as rejected:
+                call(b"second", timeout=10)
+            assert rejected.value.code() == grpc.StatusCode.RESOURCE_EXHAUSTED
+            assert (RETRY_AFTER_METADATA_KEY, "250") in rejected.value.trailing_metadata()
+            assert interceptor.rejected_calls == 1
+
+            release.set()
+            assert first.result(timeout=10) == b"first"
+            assert call(b"third", timeout=10) == b"third"
+    finally:
+        release.set()
+        server.stop(grace=None)
+
+
+def test_bounded_server_rejects_with_retry_after_by_default() -> None:
+    """a configured queue depth sheds load through the admission control, not through grpc without a hint"""
+    server_config: Any = MagicMock(maximum_concurrent_rpcs=1, max_workers=4, admission_control=None)
+    interceptor: Any = BpiServer._create_admission_control(server_config)
+    assert interceptor is not None and interceptor.limiter.limit == 1
+    server_config.admission_control = interceptor
+    assert BpiServer._get_grpc_maximum_concurrent_rpcs(server_config) == 5
+
+    entered: Event = Event()
+    release: Event = Event()
+
+    def slow_call(request: Any, context: grpc.ServicerContext) -> bytes:
+        entered.set()
+        release.wait(timeout=10)
+        return request
+
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4), interceptors=[interceptor], maximum_concurrent_rpcs=5)
+    server.add_generic_rpc_handlers(
+        (grpc.method_handlers_generic_handler("test.Service", {"Call": grpc.unary_unary_rpc_method_handler(slow_call)}),)
+    )
+    port: int = server.add_insecure_port("localhost:0")
+    server.start()
+    try:
+        with grpc.insecure_channel(f"localhost:{port}") as channel:
+            call = channel.unary_unary("/test.Service/Call")
+            first: Any = call.future(b"first")
+            assert entered.wait(timeout=10)
+
+            with pytest.raises(grpc.RpcError) as rejected:
+                call(b"second", timeout=10)
+            assert rejected.value.code() == grpc.StatusCode.RESOURCE_EXHAUSTED
+            assert (RETRY_AFTER_METADATA_KEY, str(ONDEWO_BPI_RETRY_AFTER_MS)) in rejected.value.trailing_metadata()
+
+            release.set()
+            assert first.result(timeout=10) == b"first"
+    finally:
+        release.set()
+        server.stop(grace=None)
+
+
+def test_response_stream_releases_its_slot_once_also_if_it_is_never_read() -> None:
+    limiter = AimdConcurrencyLimiter(initial_limit=2, min_limit=1, max_limit=2, latency_threshold_seconds=1.0)
+    interceptor = AdmissionControlInterceptor(limiter=limiter)
+    stream_twice = interceptor._wrap_stream_response(lambda request, context: iter([request, request]), True)
+    callbacks: List[Callable[[], None]] = []
+    context = MagicMock(spec=grpc.ServicerContext)
+    context.add_callback.side_effect = lambda callback: callbacks.append(callback) or True
+
+    assert limiter.try_acquire() and limiter.try_acquire()
+    cancelled = stream_twice(b"unread", context)  # the client cancels before the first read
+    read = stream_twice(b"read", context)
+    assert list(read) == [b"read", b"read"]
+    assert limiter.inflight == 1
+    for callback in callbacks:  # the calls terminate
+        callback()
+    assert limiter.inflight == 0
+    del cancelled
+    assert limiter.try_acquire() and limiter.try_acquire() and not limiter.try_acquire()
@@ -13,8 +13,10 @@
 # limitations under the License.
 
 import pytest  # noqa:
+from ondewo.nlu import session_pb2
 
 from ondewo_bpi.bpi_server import BpiServer
+from ondewo_bpi.bpi_services import BpiSessionsServices
 from ondewo_bpi.config import Client
 
 
@@ -26,3 +28,21 @@ def test_import() -> None:
     assert isinstance(bpi.client, Client)
     assert isinstance(bpi.intent_handlers, list)
     assert not bpi.server
+
+
+def test_output_context_fingerprints_detect_changes_only() -> None:
+    response = session_pb2.DetectIntentResponse()
+    for name in ["a", "b"]:
+        context = response.query_result.output_contexts.add(name=name, lifespan_count=2)
+        context.parameters["x"].value = "1"
+        context.parameters["y"].value = "2"
+    reordered = session_pb2.DetectIntentResponse()
+    reordered.CopyFrom(response)
+    del reordered.query_result.output_contexts[0].parameters["x"]
+    reordered.query_result.output_contexts[0].parameters["x"].value = "1"  # same content, other insertion order
+    reordered.query_result.output_contexts[1].parameters["y"].value = "changed"
+
+    before = BpiSessionsServices._get_output_contexts_dict(response)
+    after = BpiSessionsServices._get_output_contexts_dict(reordered)
+    assert before["a"][0] == after["a"][0]
+    assert before["b"][0] != after["b"][0]
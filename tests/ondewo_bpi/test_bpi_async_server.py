@@ -0,0 +1,110 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+import time
+from typing import (
+    Any,
+    List,
+)
+from unittest.mock import MagicMock
+
+from ondewo.nlu import (
+    intent_pb2,
+    session_pb2,
+)
+
+from ondewo_bpi.bpi_async_server import AsyncBpiServer
+
+
+class FakeClientProvider:
+    def __init__(self) -> None:
+        self.client = MagicMock()
+
+    def get_client(self) -> Any:
+        return self.client
+
+
+def create_response(intent_name: str, text: str) -> session_pb2.DetectIntentResponse:
+    response = session_pb2.DetectIntentResponse(
+        response_id="d07e62f1-e652-473c-b445-c77a0ad5260d",
+        query_result=session_pb2.QueryResult(
+            intent=intent_pb2.Intent(display_name=intent_name),
+            fulfillment_messages=[intent_pb2.Intent.Message(text=intent_pb2.Intent.Message.Text(text=[text]))],
+        ),
+    )
+    response.query_result.diagnostic_info["sessionId"] = "my_session"
+    return response
+
+
+def test_async_intent_handlers() -> None:
+    server = AsyncBpiServer(client_provider=FakeClientProvider())  # type: ignore
+    server.client.services.sessions.detect_intent.return_value = create_response("i.my_intent", "hello")
+    handler_threads = []
+
+    async def async_handler(response: session_pb2.DetectIntentResponse, client: Any) -> Any:
+        handler_threads.append(threading.current_thread())
+        response.query_result.fulfillment_messages[0].text.text[0] += " async"
+        return response
+
+    def sync_handler(response: session_pb2.DetectIntentResponse, client: Any) -> Any:
+        handler_threads.append(threading.current_thread())
+        response.query_result.fulfillment_messages[0].text.text[0] += " sync"
+        return response
+
+    server.register_intent_handler(intent_pattern="i.my_intent", handlers=[async_handler, sync_handler])
+
+    async def detect_intent() -> Any:
+        handler_threads.append(threading.current_thread())
+        request = session_pb2.DetectIntentRequest(session="my_session")
+        servicer_context = MagicMock(**{"time_remaining.return_value": None, "cancelled.return_value": False})
+        return await server.DetectIntent(request, servicer_context)
+
+    response = asyncio.run(detect_intent())
+    assert response.query_result.fulfillment_messages[0].text.text[0] == "hello async sync"
+    loop_thread, async_handler_thread, sync_handler_thread = handler_threads
+    assert async_handler_thread is loop_thread
+    assert sync_handler_thread is not loop_thread
+
+
+def test_blocking_calls_of_the_pipeline_do_not_stall_the_event_loop() -> None:
+    server = AsyncBpiServer(client_provider=FakeClientProvider())  # type: ignore
+    response = create_response("i.my_intent", "hello")
+
+    async def detect_intent_on_channel(request: session_pb2.DetectIntentRequest, **kwargs: Any) -> Any:
+        return response
+
+    # e.g. a full queue of the context sync and a slow state store behind the response cache
+    server.async_sessions_stub = MagicMock(DetectIntent=detect_intent_on_channel)
+    server.context_sync = MagicMock(**{"submit.side_effect": lambda **kwargs: time.sleep(0.2)})
+    server.response_cache = MagicMock(**{"get_key.side_effect": lambda **kwargs: time.sleep(0.2)})
+
+    async def detect_intent() -> Any:
+        request = session_pb2.DetectIntentRequest(session="my_session")
+        servicer_context = MagicMock(**{"time_remaining.return_value": None, "cancelled.return_value": False})
+        return await server.DetectIntent(request, servicer_context)
+
+    async def measure_loop_stalls() -> List[float]:
+        ticks: List[float] = [time.monotonic()]
+        task = asyncio.ensure_future(detect_intent())
+        while not task.done():
+            await asyncio.sleep(0.01)
+            ticks.append(time.monotonic())
+        assert (await task).query_result.intent.display_name == "i.my_intent"
+        return [later - earlier for earlier, later in zip(ticks, ticks[1:])]
+
+    stalls: List[float] = asyncio.run(measure_loop_stalls())
+    assert sum(stalls) >= 0.4
+    assert max(stalls) < 0.1
@@ -0,0 +1,99 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing
+import os
+import time
+from typing import (
+    Any,
+    List,
+    Tuple,
+)
+from unittest.mock import MagicMock
+
+import pytest
+
+from ondewo_bpi.bpi_prefork import PreforkLauncher
+
+worker_reports: Any = multiprocessing.get_context("fork").Queue()
+
+
+class FakeServer:
+    """records in which process it was built and with which server options it was served"""
+
+    def __init__(self) -> None:
+        self.built_in_pid: int = os.getpid()
+        self.server_options: List[Tuple[str, Any]] = []
+
+    def serve(self) -> None:
+        worker_reports.put((self.built_in_pid, os.getpid(), self.server_options))
+
+    def stop(self) -> None:
+        pass
+
+
+class FailingServer(FakeServer):
+    """fails on startup, e.g. because of a bad config"""
+
+    def serve(self) -> None:
+        worker_reports.put(os.getpid())
+        raise RuntimeError("bad config")
+
+
+def test_prefork_launcher_builds_server_in_every_worker() -> None:
+    launcher = PreforkLauncher(server_factory=FakeServer, num_workers=3, restart_workers=False)  # type: ignore
+    launcher.serve()
+
+    reports = [worker_reports.get(timeout=10) for _ in range(3)]
+    assert len({worker_pid for _, worker_pid, _ in reports}) == 3
+    for built_in_pid, worker_pid, server_options in reports:
+        assert built_in_pid == worker_pid != os.getpid()
+        assert ("grpc.so_reuseport", 1) in server_options
+
+
+def test_prefork_launcher_gives_up_on_a_crash_looping_worker() -> None:
+    launcher = PreforkLauncher(
+        server_factory=FailingServer,  # type: ignore
+        num_workers=1,
+        restart_backoff_seconds=0.01,
+        max_rapid_failures=2,
+        poll_interval_seconds=0.01,
+    )
+    with pytest.raises(RuntimeError):
+        launcher.serve()
+
+    assert launcher.crash_looping_worker == 0
+    assert len({worker_reports.get(timeout=10) for _ in range(3)}) == 3
+    assert worker_reports.empty()
+
+
+def test_prefork_launcher_backs_off_exponentially() -> None:
+    launcher = PreforkLauncher(
+        server_factory=FakeServer,  # type: ignore
+        num_workers=1,
+        restart_backoff_seconds=1.0,
+        restart_backoff_max_seconds=3.0,
+        rapid_failure_seconds=30.0,
+        max_rapid_failures=10,
+    )
+    backoffs: List[float] = []
+    for started_seconds_ago in [1.0, 1.0, 1.0, 1.0, 60.0]:
+        launcher.workers[0] = MagicMock()
+        launcher._started_at[0] = time.monotonic() - started_seconds_ago
+        launcher._on_worker_exit(worker_index=0, process=launcher.workers[0])
+        backoffs.append(round(launcher._restart_at.pop(0) - time.monotonic()))
+
+    # a worker which ran longer than rapid_failure_seconds starts over with the base backoff
+    assert backoffs == [1, 2, 3, 3, 1]
+    assert launcher.should_run
@@ -0,0 +1,203 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import time
+from typing import (
+    Any,
+    List,
+)
+from unittest.mock import MagicMock
+
+import grpc
+from google.protobuf import struct_pb2
+from ondewo.nlu import (
+    context_pb2,
+    intent_pb2,
+    session_pb2,
+)
+
+from ondewo_bpi.bpi_async_services import AsyncBpiSessionsServices
+from ondewo_bpi.bpi_services import BpiSessionsServices
+from ondewo_bpi.metrics import MetricsRegistry
+from ondewo_bpi.response_merge import merge_changes
+
+
+def _response() -> session_pb2.DetectIntentResponse:
+    return session_pb2.DetectIntentResponse(
+        response_id="r",
+        query_result=session_pb2.QueryResult(
+            intent=intent_pb2.Intent(display_name="i.order"),
+            fulfillment_messages=[
+                intent_pb2.Intent.Message(text=intent_pb2.Intent.Message.Text(text=["<PRICE>"])),
+                intent_pb2.Intent.Message(text=intent_pb2.Intent.Message.Text(text=["<DELIVERY>"])),
+            ],
+            parameters=struct_pb2.Struct(fields={"size": struct_pb2.Value(string_value="large")}),
+        ),
+    )
+
+
+def lookup_price(response: session_pb2.DetectIntentResponse, client: Any) -> session_pb2.DetectIntentResponse:
+    time.sleep(0.2)  # business backend
+    response.query_result.fulfillment_messages[0].text.text[0] = "12 Euro"
+    response.query_result.parameters["price"] = 12
+    return response
+
+
+def lookup_delivery(response: session_pb2.DetectIntentResponse, client: Any) -> session_pb2.DetectIntentResponse:
+    time.sleep(0.2)
+    response.query_result.fulfillment_messages[1].text.text[0] = "in 30 minutes"
+    response.query_result.parameters["size"] = "medium"  # the large one is sold out
+    return response
+
+
+def summarize(response: session_pb2.DetectIntentResponse, client: Any) -> session_pb2.DetectIntentResponse:
+    parameters = response.query_result.parameters
+    response.query_result.fulfillment_messages.add().text.text.append(
+        f"{parameters['size']} pizza for {parameters['price']:.0f} Euro"
+    )
+    return response
+
+
+def _check(response: session_pb2.DetectIntentResponse) -> None:
+    assert [message.text.text[0] for message in response.query_result.fulfillment_messages] == [
+        "12 Euro", "in 30 minutes", "medium pizza for 12 Euro",
+    ]
+
+
+def test_independent_handlers_run_concurrently_and_merge_their_changes() -> None:
+    class Services(BpiSessionsServices):
+        client: Any = MagicMock()
+
+    services = Services()
+    services.register_intent_handler(
+        intent_pattern="i.order",
+        handlers=[lookup_price, lookup_delivery, summarize],
+        dependencies={summarize: [lookup_price, lookup_delivery]},
+    )
+    start: float = time.monotonic()
+    response = services.process_intent_handler(_response())
+    assert time.monotonic() - start < 0.35
+    _check(response)
+
+
+def test_independent_handlers_run_concurrently_on_the_event_loop() -> None:
+    class Services(AsyncBpiSessionsServices):
+        client: Any = MagicMock()
+
+    async def lookup_price_async(response: session_pb2.DetectIntentResponse,
+                                 client: Any) -> session_pb2.DetectIntentResponse:
+        await asyncio.sleep(0.2)
+        response.query_result.fulfillment_messages[0].text.text[0] = "12 Euro"
+        response.query_result.parameters["price"] = 12
+        return response
+
+    services = Services()
+    services.register_intent_handler(
+        intent_pattern="i.order",
+        handlers=[lookup_price_async, lookup_delivery, summarize],
+        dependencies={summarize: [lookup_price_async, lookup_delivery]},
+    )
+    start: float = time.monotonic()
+    response = asyncio.run(services.process_intent_handler_async(_response()))
+    assert time.monotonic() - start < 0.35
+    _check(response)
+
+
+def _extend_order_context(response: session_pb2.DetectIntentResponse, client: Any) -> session_pb2.DetectIntentResponse:
+    response.query_result.output_contexts[0].lifespan_count = 7
+    return response
+
+
+def _submitted_lifespans(services: Any) -> List[List[int]]:
+    return [
+        [context.lifespan_count for context in call.kwargs["contexts"]]
+        for call in services.context_sync.submit.call_args_list
+    ]
+
+
+def test_contexts_changed_by_concurrent_handlers_are_written_to_cai() -> None:
+    cai_response = _response()
+    cai_response.query_result.diagnostic_info["sessionId"] = "s"
+    cai_response.query_result.output_contexts.append(
+        context_pb2.Context(name="projects/p/agent/sessions/s/contexts/order", lifespan_count=1)
+    )
+    request = session_pb2.DetectIntentRequest(
+        session="projects/p/agent/sessions/s",
+        query_input=session_pb2.QueryInput(text=session_pb2.TextInput(text="pizza", language_code="de")),
+    )
+    context = MagicMock(spec=grpc.ServicerContext)
+    context.time_remaining.return_value = None
+    context.is_active.return_value = True
+
+    class Services(BpiSessionsServices):
+        client: Any = MagicMock()
+
+    class AsyncServices(AsyncBpiSessionsServices):
+        client: Any = MagicMock()
+
+    services = Services()
+    async_services = AsyncServices()
+    for bpi in (services, async_services):
+        bpi.client.services.sessions.detect_intent.return_value = cai_response
+        bpi.context_sync = MagicMock()
+        bpi.register_intent_handler(
+            intent_pattern="i.order", handlers=[_extend_order_context, lookup_price], independent=True,
+        )
+    services.DetectIntent(request, context)
+    asyncio.run(async_services.DetectIntent(request, context))
+    assert _submitted_lifespans(services) == [[7]]
+    assert _submitted_lifespans(async_services) == [[7]]
+
+
+def _handler_copy(base: session_pb2.DetectIntentResponse) -> session_pb2.DetectIntentResponse:
+    copy: session_pb2.DetectIntentResponse = session_pb2.DetectIntentResponse()
+    copy.CopyFrom(base)
+    return copy
+
+
+def test_an_edit_and_an_append_of_concurrent_handlers_are_both_merged() -> None:
+    base: session_pb2.DetectIntentResponse = _response()
+    base.query_result.output_contexts.add(name="c/order", lifespan_count=2)
+    editing, appending = _handler_copy(base), _handler_copy(base)
+    editing.query_result.fulfillment_messages[0].text.text[0] = "12 Euro"
+    editing.query_result.output_contexts[0].lifespan_count = 5
+    appending.query_result.fulfillment_messages.add().text.text.append("Anything else?")
+    appending.query_result.output_contexts.add(name="c/upsell", lifespan_count=1)
+    metrics = MetricsRegistry()
+
+    for handler_order in [[editing, appending], [appending, editing]]:
+        merged: session_pb2.DetectIntentResponse = _handler_copy(base)
+        for changed in handler_order:
+            merge_changes(target=merged, base=base, changed=changed, metrics=metrics)
+        assert [m.text.text[0] for m in merged.query_result.fulfillment_messages] == \
+            ["12 Euro", "<DELIVERY>", "Anything else?"]
+        assert [(c.name, c.lifespan_count) for c in merged.query_result.output_contexts] == \
+            [("c/order", 5), ("c/upsell", 1)]
+    assert metrics.counter("response_merge_conflicts_total") == 0
+
+
+def test_a_removal_conflicting_with_an_edit_is_counted() -> None:
+    base: session_pb2.DetectIntentResponse = _response()
+    editing, removing = _handler_copy(base), _handler_copy(base)
+    editing.query_result.fulfillment_messages[0].text.text[0] = "12 Euro"
+    del removing.query_result.fulfillment_messages[1]
+    metrics = MetricsRegistry()
+
+    merged: session_pb2.DetectIntentResponse = _handler_copy(base)
+    merge_changes(target=merged, base=base, changed=editing, metrics=metrics)
+    merge_changes(target=merged, base=base, changed=removing, metrics=metrics)
+
+    # the removal wins, the edit is lost but reported
+    assert [m.text.text[0] for m in merged.query_result.fulfillment_messages] == ["<PRICE>"]
+    assert metrics.counter("response_merge_conflicts_total") == 1
@@ -0,0 +1,218 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+from concurrent import futures
+from threading import Event
+from typing import (
+    Any,
+    Callable,
+    Iterator,
+    List,
+    Optional,
+)
+from unittest.mock import MagicMock
+
+import grpc
+import pytest
+from ondewo.nlu import (
+    context_pb2,
+    session_pb2,
+)
+
+from ondewo_bpi.context_mirror import SessionContextMirror
+from ondewo_bpi.context_sync import ContextSyncWorker
+from ondewo_bpi.context_writer import ContextWriter
+from ondewo_bpi.metrics import MetricsRegistry
+
+SESSION: str = "projects/p/agent/sessions/s1"
+
+
+def _context(name: str, lifespan_count: int = 3, value: str = "") -> context_pb2.Context:
+    context = context_pb2.Context(name=f"{SESSION}/contexts/{name}", lifespan_count=lifespan_count)
+    if value:
+        context.parameters["value"].value = value
+    return context
+
+
+class FakeCall:
+    """a finished UpdateContext future with the given status code"""
+
+    def __init__(self, code: grpc.StatusCode) -> None:
+        self._code: grpc.StatusCode = code
+
+    def code(self) -> grpc.StatusCode:
+        return self._code
+
+    def add_done_callback(self, callback: Callable[["FakeCall"], None]) -> None:
+        callback(self)
+
+
+def _fake_client(
+    active_contexts: List[context_pb2.Context],
+    list_contexts_gate: Event,
+    status_codes: Optional[List[grpc.StatusCode]] = None,
+) -> Any:
+    client = MagicMock()
+    codes: Iterator[grpc.StatusCode] = iter(status_codes or [])
+    client.services.contexts.stub.UpdateContext.future.side_effect = \
+        lambda request, metadata, timeout: FakeCall(next(codes, grpc.StatusCode.OK))
+
+    def list_contexts(request: context_pb2.ListContextsRequest) -> context_pb2.ListContextsResponse:
+        list_contexts_gate.wait(timeout=10)
+        return context_pb2.ListContextsResponse(contexts=active_contexts)
+
+    client.services.contexts.list_contexts.side_effect = list_contexts
+    return client
+
+
+def test_context_sync_coalesces_updates_of_the_same_context() -> None:
+    gate: Event = Event()
+    client = _fake_client(active_contexts=[_context("a"), _context("b")], list_contexts_gate=gate)
+    metrics = MetricsRegistry()
+    worker = ContextSyncWorker(
+        client_provider=lambda: client,
+        num_workers=1,
+        context_mirror=SessionContextMirror(metrics=metrics),
+        metrics=metrics,
+    )
+    try:
+        # the first session batch blocks in list_contexts, the following updates queue up behind it
+        assert worker.submit(session_name="other-session", contexts=[_context("a", value="other")])
+        assert worker.submit(session_name=SESSION, contexts=[_context("a", value="1"), _context("b", value="1")])
+        assert worker.submit(session_name=SESSION, contexts=[_context("a", value="2")])
+        assert worker.submit(session_name=SESSION, contexts=[_context("decayed", value="2")])
+        gate.set()
+        assert worker.flush(timeout=10)
+    finally:
+        worker.stop()
+
+    written = [call.args[0].context for call in client.services.contexts.stub.UpdateContext.future.call_args_list]
+    written_values = {
+        (context.name.split("/")[-1], context.parameters["value"].value) for context in written[1:]
+    }
+    assert written_values == {("a", "2"), ("b", "1")}
+    assert client.services.contexts.list_contexts.call_count == 2
+    assert metrics.counter("context_sync_coalesced_total") == 1
+    assert metrics.counter("context_sync_updates_sent_total") == 3
+    assert metrics.gauge("context_sync_queue_depth") == 0
+
+
+def test_context_sync_drops_updates_when_queue_is_full() -> None:
+    gate: Event = Event()
+    client = _fake_client(active_contexts=[_context("a")], list_contexts_gate=gate)
+    metrics = MetricsRegistry()
+    worker = ContextSyncWorker(
+        client_provider=lambda: client,
+        num_workers=1,
+        max_pending_sessions=1,
+        enqueue_timeout_seconds=0.01,
+        context_mirror=SessionContextMirror(metrics=metrics),
+        metrics=metrics,
+    )
+    try:
+        assert worker.submit(session_name="s-busy", contexts=[_context("a")])
+        while worker.queue_depth:  # wait until the worker holds the first session
+            time.sleep(0.001)
+        assert worker.submit(session_name="s-queued", contexts=[_context("a")])
+        assert not worker.submit(session_name="s-dropped", contexts=[_context("a")])
+        assert metrics.counter("context_sync_dropped_total") == 1
+    finally:
+        gate.set()
+        worker.stop()
+
+
+def test_context_sync_uses_the_context_mirror_instead_of_list_contexts() -> None:
+    gate: Event = Event()
+    gate.set()
+    client = _fake_client(active_contexts=[], list_contexts_gate=gate)
+    metrics = MetricsRegistry()
+    mirror = SessionContextMirror(metrics=metrics)
+    response = session_pb2.DetectIntentResponse()
+    response.query_result.output_contexts.extend([_context("a"), _context("decayed", lifespan_count=0)])
+    mirror.update_from_response(session_name=SESSION, response=response)
+
+    worker = ContextSyncWorker(client_provider=lambda: client, num_workers=1, context_mirror=mirror, metrics=metrics)
+    try:
+        assert worker.submit(session_name=SESSION, contexts=[_context("a", value="1"), _context("decayed")])
+        assert worker.flush(timeout=10)
+    finally:
+        worker.stop()
+
+    client.services.contexts.list_contexts.assert_not_called()
+    assert client.services.contexts.stub.UpdateContext.future.call_count == 1
+    assert metrics.counter("context_mirror_hits_total") == 1
+
+
+def test_context_mirror_expires_and_evicts_sessions() -> None:
+    mirror = SessionContextMirror(max_sessions=2, ttl_seconds=60, metrics=MetricsRegistry())
+    for session in ["s1", "s2", "s3"]:
+        mirror.set_alive_contexts(session_name=session, contexts=[context_pb2.Context(name=f"{session}/contexts/a")])
+    assert mirror.alive_context_names("s1") is None  # evicted, least recently used
+    assert mirror.alive_context_names("s3") == set()  # lifespan_count 0 is not alive
+
+    mirror.update_from_write(context_pb2.Context(name="s3/contexts/b", lifespan_count=2))
+    assert mirror.alive_context_names("s3") == {"s3/contexts/b"}
+    mirror.update_from_write(context_pb2.Context(name="s1/contexts/b", lifespan_count=2))
+    assert mirror.alive_context_names("s1") is None  # a write alone does not make a session known
+
+    mirror.ttl_seconds = 0.0
+    time.sleep(0.01)
+    assert mirror.alive_context_names("s3") is None
+
+
+def test_context_writer_retries_without_blocking_and_reports_results() -> None:
+    client = _fake_client(
+        active_contexts=[],
+        list_contexts_gate=Event(),
+        # the fake calls finish immediately, i.e. the retry of "a" is issued before the call of "b"
+        status_codes=[grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.OK, grpc.StatusCode.NOT_FOUND],
+    )
+    metrics = MetricsRegistry()
+    writer = ContextWriter(client_provider=lambda: client, max_attempts=2, metrics=metrics)
+
+    retried, not_found = writer.wait(writer.write_all([_context("a"), _context("b")]), timeout=10)
+
+    assert retried.ok and retried.attempts == 2
+    assert not not_found.ok and not_found.attempts == 1  # NOT_FOUND is not retried
+    assert not_found.status_code == grpc.StatusCode.NOT_FOUND
+    assert metrics.counter("context_write_sent_total") == 3
+    assert metrics.counter("context_write_retries_total") == 1
+    assert metrics.counter("context_write_failed_total") == 1
+
+
+def test_context_writer_reports_calls_which_cannot_be_sent_and_bounds_the_wait() -> None:
+    client = _fake_client(active_contexts=[], list_contexts_gate=Event(), status_codes=[grpc.StatusCode.UNAVAILABLE])
+    calls: List[grpc.StatusCode] = []
+
+    def closed_on_retry(request: Any, metadata: Any, timeout: float) -> FakeCall:
+        if calls:
+            raise ValueError("Cannot invoke RPC on closed channel!")
+        calls.append(grpc.StatusCode.UNAVAILABLE)
+        return FakeCall(grpc.StatusCode.UNAVAILABLE)
+
+    client.services.contexts.stub.UpdateContext.future.side_effect = closed_on_retry
+    writer = ContextWriter(client_provider=lambda: client, max_attempts=3, timeout_seconds=0.1, metrics=MetricsRegistry())
+    [result] = writer.wait(writer.write_all([_context("a")]))
+    assert not result.ok and result.attempts == 2
+    assert result.status_code == grpc.StatusCode.UNKNOWN
+
+    class PendingCall:
+        def add_done_callback(self, callback: Callable[[Any], None]) -> None:
+            pass  # never completes
+
+    client.services.contexts.stub.UpdateContext.future.side_effect = lambda request, metadata, timeout: PendingCall()
+    started_at: float = time.monotonic()
+    with pytest.raises(futures.TimeoutError):
+        writer.wait(writer.write_all([_context("b")]))
+    assert time.monotonic() - started_at < 2.0  # 3 attempts of 0.1 seconds and a second of grace
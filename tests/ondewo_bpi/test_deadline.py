@@ -0,0 +1,115 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from concurrent import futures
+from typing import (
+    Any,
+    Iterator,
+    List,
+    Optional,
+)
+from unittest.mock import MagicMock
+
+import grpc
+import pytest
+from ondewo.nlu import (
+    intent_pb2,
+    session_pb2,
+    session_pb2_grpc,
+)
+
+from ondewo_bpi.bpi_services import BpiSessionsServices
+from ondewo_bpi.deadline import (
+    is_abandoned,
+    request_budget,
+    time_remaining,
+    with_deadline_propagation,
+)
+
+
+class RecordingCai(session_pb2_grpc.SessionsServicer):
+    def __init__(self) -> None:
+        self.time_remaining: List[float] = []
+
+    def DetectIntent(
+        self,
+        request: session_pb2.DetectIntentRequest,
+        context: grpc.ServicerContext,
+    ) -> session_pb2.DetectIntentResponse:
+        self.time_remaining.append(context.time_remaining())
+        return session_pb2.DetectIntentResponse()
+
+
+def _servicer_context(time_remaining: Optional[float], active: bool = True) -> Any:
+    def abort(code: grpc.StatusCode, details: str) -> None:
+        raise RuntimeError(code)
+
+    context = MagicMock(spec=grpc.ServicerContext)
+    context.time_remaining.return_value = time_remaining
+    context.is_active.return_value = active
+    context.abort.side_effect = abort
+    return context
+
+
+@pytest.fixture
+def cai() -> Iterator[Any]:
+    servicer = RecordingCai()
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=2))
+    session_pb2_grpc.add_SessionsServicer_to_server(servicer, server)
+    port: int = server.add_insecure_port("localhost:0")
+    server.start()
+    channel = with_deadline_propagation(grpc.insecure_channel(f"localhost:{port}"))
+    yield servicer, session_pb2_grpc.SessionsStub(channel)
+    channel.close()
+    server.stop(grace=None)
+
+
+def test_outgoing_calls_get_the_remaining_time_of_the_incoming_call(cai: Any) -> None:
+    servicer, stub = cai
+    request = session_pb2.DetectIntentRequest(session="s")
+    stub.DetectIntent(request)  # no incoming call, no timeout
+    with request_budget(_servicer_context(time_remaining=2.0)):
+        assert 1.0 < time_remaining() <= 2.0  # type: ignore[operator]
+        stub.DetectIntent(request)
+        stub.DetectIntent(request, timeout=0.5)  # a shorter timeout is kept
+    assert time_remaining() is None
+
+    without_budget, with_budget, with_shorter_timeout = servicer.time_remaining
+    assert without_budget > 3600
+    assert 1.0 < with_budget <= 2.1  # the deadline is rounded up on the wire
+    assert with_shorter_timeout <= 0.6
+
+
+def test_cancelled_call_skips_the_handlers_and_is_aborted() -> None:
+    class Services(BpiSessionsServices):
+        client = MagicMock()
+
+    services = Services()
+    cai_response = session_pb2.DetectIntentResponse(
+        query_result=session_pb2.QueryResult(intent=intent_pb2.Intent(display_name="my_intent")),
+    )
+    cai_response.query_result.diagnostic_info["sessionId"] = "s"
+    services.client.services.sessions.detect_intent.return_value = cai_response
+    handler = MagicMock(side_effect=lambda response, client: response)
+    services.register_intent_handler(intent_pattern="my_intent", handlers=[handler])
+    request = session_pb2.DetectIntentRequest(session="s")
+
+    services.DetectIntent(request, _servicer_context(time_remaining=None))
+    assert handler.call_count == 1
+
+    cancelled_context = _servicer_context(time_remaining=None, active=False)
+    with request_budget(cancelled_context):
+        assert is_abandoned()
+    with pytest.raises(RuntimeError, match="CANCELLED"):
+        services.DetectIntent(request, cancelled_context)
+    assert handler.call_count == 1
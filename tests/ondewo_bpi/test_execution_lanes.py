@@ -0,0 +1,87 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from concurrent import futures
+from threading import Event
+from typing import Any
+
+import grpc
+import pytest
+
+from ondewo_bpi.execution_lanes import (
+    DEFAULT_EXECUTION_LANES,
+    ExecutionLaneConfig,
+    ExecutionLanesInterceptor,
+    parse_execution_lanes,
+)
+
+
+def test_parse_execution_lanes() -> None:
+    assert parse_execution_lanes("") == []
+    assert parse_execution_lanes("[]") == []
+    assert parse_execution_lanes("default") == DEFAULT_EXECUTION_LANES
+    lanes = parse_execution_lanes('[{"name": "agents", "methods": ["ondewo.nlu.Agents"], "max_concurrency": 2}]')
+    assert lanes == [ExecutionLaneConfig(name="agents", methods=["ondewo.nlu.Agents"], max_concurrency=2)]
+
+    interceptor = ExecutionLanesInterceptor(lanes=lanes + DEFAULT_EXECUTION_LANES)
+    assert interceptor.lane_for_method("/ondewo.nlu.Agents/ExportAgent").name == "agents"  # type: ignore
+    assert interceptor.lane_for_method("/ondewo.nlu.Sessions/ListSessions").name == "admin"  # type: ignore
+    assert interceptor.lane_for_method("/ondewo.nlu.Sessions/DetectIntent") is None
+
+
+def test_saturated_lane_does_not_block_other_methods() -> None:
+    entered: Event = Event()
+    release: Event = Event()
+
+    def export_agent(request: Any, context: grpc.ServicerContext) -> bytes:
+        entered.set()
+        release.wait(timeout=10)
+        return request
+
+    def detect_intent(request: Any, context: grpc.ServicerContext) -> bytes:
+        return request
+
+    interceptor = ExecutionLanesInterceptor(
+        lanes=[ExecutionLaneConfig(name="admin", methods=["ExportAgent"], max_concurrency=1, max_queue_depth=0)],
+    )
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4), interceptors=[interceptor])
+    server.add_generic_rpc_handlers(
+        (
+            grpc.method_handlers_generic_handler(
+                "test.Service",
+                {
+                    "ExportAgent": grpc.unary_unary_rpc_method_handler(export_agent),
+                    "DetectIntent": grpc.unary_unary_rpc_method_handler(detect_intent),
+                },
+            ),
+        )
+    )
+    port: int = server.add_insecure_port("localhost:0")
+    server.start()
+    try:
+        with grpc.insecure_channel(f"localhost:{port}") as channel:
+            export_call = channel.unary_unary("/test.Service/ExportAgent")
+            first_export: Any = export_call.future(b"export")
+            assert entered.wait(timeout=10)
+
+            with pytest.raises(grpc.RpcError) as rejected:
+                export_call(b"second export", timeout=10)
+            assert rejected.value.code() == grpc.StatusCode.RESOURCE_EXHAUSTED
+            assert channel.unary_unary("/test.Service/DetectIntent")(b"hello", timeout=10) == b"hello"
+
+            release.set()
+            assert first_export.result(timeout=10) == b"export"
+            assert interceptor.lanes[0].rejected_calls == 1
+    finally:
+        release.set()
+        server.stop(grace=None)
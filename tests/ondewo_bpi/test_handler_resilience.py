@@ -0,0 +1,137 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from typing import (
+    Any,
+    Dict,
+    List,
+)
+from unittest.mock import MagicMock
+
+from ondewo.nlu import (
+    intent_pb2,
+    session_pb2,
+)
+
+from ondewo_bpi.bpi_services import BpiSessionsServices
+from ondewo_bpi.constants import SipTriggers
+from ondewo_bpi.handler_resilience import (
+    HandlerPolicy,
+    with_policy,
+)
+from ondewo_bpi.metrics import MetricsRegistry
+
+
+def _response(text: str = "<CRM>") -> session_pb2.DetectIntentResponse:
+    response = session_pb2.DetectIntentResponse(
+        response_id="r",
+        query_result=session_pb2.QueryResult(
+            fulfillment_messages=[intent_pb2.Intent.Message(text=intent_pb2.Intent.Message.Text(text=[text]))],
+        ),
+    )
+    response.query_result.diagnostic_info["sessionId"] = "s"
+    return response
+
+
+def _text(response: session_pb2.DetectIntentResponse) -> str:
+    return response.query_result.fulfillment_messages[0].text.text[0]
+
+
+def test_timed_out_handler_is_skipped() -> None:
+    def slow_crm(response: session_pb2.DetectIntentResponse, client: Any) -> session_pb2.DetectIntentResponse:
+        time.sleep(0.3)
+        response.query_result.fulfillment_messages[0].text.text[0] = "too late"
+        return response
+
+    metrics = MetricsRegistry()
+    handler = with_policy(slow_crm, HandlerPolicy(timeout_seconds=0.05, name="crm"), metrics=metrics)
+    response = _response()
+    start: float = time.monotonic()
+    assert handler(response, None) is response
+    assert time.monotonic() - start < 0.2
+    time.sleep(0.35)
+    assert _text(response) == "<CRM>"
+    assert metrics.counter('handler_timeouts_total{handler="crm"}') == 1
+
+
+def test_circuit_opens_after_failures_and_closes_after_a_successful_trial() -> None:
+    crm: Dict[str, Any] = {"up": False, "calls": 0}
+
+    def lookup(response: session_pb2.DetectIntentResponse, client: Any) -> session_pb2.DetectIntentResponse:
+        crm["calls"] += 1
+        if not crm["up"]:
+            raise ConnectionError("CRM down")
+        response.query_result.fulfillment_messages[0].text.text[0] = "customer found"
+        return response
+
+    def fallback(response: session_pb2.DetectIntentResponse, client: Any) -> session_pb2.DetectIntentResponse:
+        response.query_result.fulfillment_messages[0].text.text[0] = "please try again later"
+        return response
+
+    metrics = MetricsRegistry()
+    policy = HandlerPolicy(failure_threshold=2, reset_timeout_seconds=0.2, fallback=fallback, name="crm")
+    handler = with_policy(lookup, policy, metrics=metrics)
+    texts: List[str] = [_text(handler(_response(), None)) for _ in range(3)]
+    assert texts == ["please try again later"] * 3
+    assert crm["calls"] == 2  # the third call did not reach the CRM
+    assert metrics.counter('handler_circuit_open_total{handler="crm"}') == 1
+    assert metrics.counter('handler_circuit_opened_total{handler="crm"}') == 1
+
+    crm["up"] = True
+    time.sleep(0.25)
+    assert _text(handler(_response(), None)) == "customer found"
+    assert _text(handler(_response(), None)) == "customer found"
+    assert crm["calls"] == 4
+
+
+def test_bulkhead_skips_calls_beyond_the_concurrency_limit() -> None:
+    release = Event()
+
+    def blocking(response: session_pb2.DetectIntentResponse, client: Any) -> session_pb2.DetectIntentResponse:
+        release.wait(timeout=5)
+        return response
+
+    metrics = MetricsRegistry()
+    handler = with_policy(blocking, HandlerPolicy(max_concurrency=1, name="crm"), metrics=metrics)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        first = executor.submit(handler, _response(), None)
+        time.sleep(0.05)
+        response = _response()
+        assert handler(response, None) is response
+        release.set()
+        first.result()
+    assert metrics.counter('handler_rejected_total{handler="crm"}') == 1
+
+
+def test_trigger_handler_changes_are_taken_over() -> None:
+    class Services(BpiSessionsServices):
+        client: Any = MagicMock()
+
+    def replace_placeholder(
+        response: session_pb2.DetectIntentResponse,
+        message: intent_pb2.Intent.Message,
+        trigger: str,
+        found_triggers: Dict[str, List[str]],
+    ) -> None:
+        message.text.text[0] = "replaced"
+
+    services = Services()
+    services.register_trigger_handler(
+        SipTriggers.SIP_HANGUP.value, replace_placeholder, policy=HandlerPolicy(timeout_seconds=1),
+    )
+    response = _response("hello <SIP:HANGUP>")
+    services.process_messages(response)
+    assert _text(response) == "replaced"
@@ -0,0 +1,139 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+from concurrent import futures
+from typing import (
+    Iterator,
+    Tuple,
+)
+from unittest.mock import MagicMock
+
+import grpc
+import pytest
+from ondewo.nlu import (
+    session_pb2,
+    session_pb2_grpc,
+)
+
+from ondewo_bpi.hedging import (
+    HedgedDetectIntent,
+    LatencyWindow,
+)
+from ondewo_bpi.metrics import MetricsRegistry
+
+
+class FakeCai(session_pb2_grpc.SessionsServicer):
+    def __init__(self, name: str, delay_seconds: float) -> None:
+        self.name: str = name
+        self.delay_seconds: float = delay_seconds
+
+    def DetectIntent(
+        self,
+        request: session_pb2.DetectIntentRequest,
+        context: grpc.ServicerContext,
+    ) -> session_pb2.DetectIntentResponse:
+        time.sleep(self.delay_seconds)
+        return session_pb2.DetectIntentResponse(response_id=self.name)
+
+
+@pytest.fixture
+def stubs() -> Iterator[Tuple[session_pb2_grpc.SessionsStub, session_pb2_grpc.SessionsStub]]:
+    servers = []
+    channels = []
+    for name, delay in [("primary", 0.5), ("hedge", 0.0)]:
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=2))
+        session_pb2_grpc.add_SessionsServicer_to_server(FakeCai(name=name, delay_seconds=delay), server)
+        port: int = server.add_insecure_port("localhost:0")
+        server.start()
+        servers.append(server)
+        channels.append(grpc.insecure_channel(f"localhost:{port}"))
+    yield session_pb2_grpc.SessionsStub(channels[0]), session_pb2_grpc.SessionsStub(channels[1])
+    for channel in channels:
+        channel.close()
+    for server in servers:
+        server.stop(grace=None)
+
+
+def test_latency_window_percentile() -> None:
+    window = LatencyWindow(size=100)
+    assert window.percentile(95) is None
+    for latency in range(1, 101):
+        window.add(latency / 100)
+    assert window.percentile(50) == 0.5
+    assert window.percentile(95) == 0.95
+    assert window.percentile(100) == 1.0
+
+
+def test_slow_primary_is_hedged_and_the_hedge_wins(
+    stubs: Tuple[session_pb2_grpc.SessionsStub, session_pb2_grpc.SessionsStub],
+) -> None:
+    metrics = MetricsRegistry()
+    hedger = HedgedDetectIntent(
+        primary_stub=stubs[0],
+        hedge_stub=stubs[1],
+        metadata=[],
+        min_delay_seconds=0.05,
+        min_samples=0,
+        max_ratio=1.0,
+        metrics=metrics,
+    )
+    response = hedger.detect_intent(session_pb2.DetectIntentRequest(session="s"))
+    assert response.response_id == "hedge"
+    assert metrics.counter("detect_intent_hedge_sent_total") == 1
+    assert metrics.counter("detect_intent_hedge_wins_total") == 1
+
+
+def test_hedge_is_skipped_when_vetoed_or_over_budget(
+    stubs: Tuple[session_pb2_grpc.SessionsStub, session_pb2_grpc.SessionsStub],
+) -> None:
+    metrics = MetricsRegistry()
+    hedger = HedgedDetectIntent(
+        primary_stub=stubs[0],
+        hedge_stub=stubs[1],
+        metadata=[],
+        min_delay_seconds=0.05,
+        min_samples=0,
+        max_ratio=0.5,
+        metrics=metrics,
+    )
+    vetoed = hedger.detect_intent(session_pb2.DetectIntentRequest(session="s"), allow_hedge=False)
+    assert vetoed.response_id == "primary"
+    hedger.latencies = LatencyWindow()  # forget the slow sample, it would push the hedging delay beyond the primary
+    assert hedger.detect_intent(session_pb2.DetectIntentRequest(session="s")).response_id == "hedge"
+    # one of two recent calls was hedged, the budget of 50% is used up
+    assert hedger.detect_intent(session_pb2.DetectIntentRequest(session="s")).response_id == "primary"
+    assert metrics.counter("detect_intent_hedge_sent_total") == 1
+    assert metrics.counter("detect_intent_hedge_skipped_total") == 2
+
+
+def test_hedge_keeps_a_deadline_of_zero() -> None:
+    primary_stub, hedge_stub = MagicMock(), MagicMock()
+    hedge_call = MagicMock()
+    hedge_call.code.return_value = grpc.StatusCode.OK
+    hedge_call.result.return_value = session_pb2.DetectIntentResponse(response_id="hedge")
+    hedge_call.add_done_callback.side_effect = lambda callback: callback(hedge_call)
+    hedge_stub.DetectIntent.future.return_value = hedge_call
+    hedger = HedgedDetectIntent(
+        primary_stub=primary_stub,
+        hedge_stub=hedge_stub,
+        metadata=[],
+        min_delay_seconds=0.01,
+        min_samples=0,
+        max_ratio=1.0,
+        metrics=MetricsRegistry(),
+    )
+    response = hedger.detect_intent(session_pb2.DetectIntentRequest(session="s"), timeout=0.0)
+    assert response.response_id == "hedge"
+    assert primary_stub.DetectIntent.future.call_args.kwargs["timeout"] == 0.0
+    assert hedge_stub.DetectIntent.future.call_args.kwargs["timeout"] == 0.0
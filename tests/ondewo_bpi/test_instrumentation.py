@@ -0,0 +1,93 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+from typing import (
+    Iterator,
+    List,
+)
+from unittest.mock import MagicMock
+
+import pytest
+
+from ondewo_bpi.instrumentation import (
+    INSTRUMENTATION_FULL,
+    INSTRUMENTATION_OFF,
+    INSTRUMENTATION_SAMPLED,
+    configure_instrumentation,
+    instrumented,
+    instrumented_request,
+)
+
+
+@pytest.fixture(autouse=True)
+def reset_instrumentation() -> Iterator[None]:
+    yield
+    configure_instrumentation(INSTRUMENTATION_FULL)
+
+
+def test_modes_decide_which_calls_are_logged() -> None:
+    logger = MagicMock()
+
+    @instrumented(logger=logger, log_arguments=True, message="double: {:0.4f}")
+    def double(value: int) -> int:
+        return 2 * value
+
+    configure_instrumentation(INSTRUMENTATION_OFF)
+    assert double(2) == 4
+    logger.assert_not_called()
+
+    configure_instrumentation(INSTRUMENTATION_FULL)
+    assert double(3) == 6
+    messages: List[str] = [call.args[0]["message"] for call in logger.call_args_list]
+    assert messages[0].startswith("Starting 'double'")
+    assert "'result': '6'" in messages[1] and messages[2].startswith("double: ")
+
+    logger.reset_mock()
+    configure_instrumentation(INSTRUMENTATION_SAMPLED, sample_every=2)
+    requests_sampled: List[bool] = []
+    for _ in range(4):
+        with instrumented_request() as sampled:
+            requests_sampled.append(sampled)
+            double(1)
+            double(1)
+    assert requests_sampled.count(True) == 2
+    assert logger.call_count == 2 * 2 * 3  # all calls of the sampled requests
+
+
+def test_exceptions_are_logged_and_raised_and_disabled_levels_format_nothing() -> None:
+    logger = MagicMock()
+
+    @instrumented(logger=logger, message="fail: {:0.4f}")
+    def fail() -> None:
+        raise KeyError("missing")
+
+    with pytest.raises(KeyError):
+        fail()
+    assert logger.call_args_list[1].args[0]["exception type"] is KeyError
+
+    class Payload:
+        rendered: int = 0
+
+        def __str__(self) -> str:
+            Payload.rendered += 1
+            return "payload"
+
+    quiet_logger = logging.getLogger("test_instrumentation")
+    quiet_logger.setLevel(logging.INFO)
+    echo = instrumented(logger=quiet_logger.debug, log_arguments=True, message="echo")(lambda payload: payload)
+    echo(Payload())
+    assert Payload.rendered == 0
+    quiet_logger.setLevel(logging.DEBUG)
+    echo(Payload())
+    assert Payload.rendered == 2  # argument and result
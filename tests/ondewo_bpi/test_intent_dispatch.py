@@ -0,0 +1,90 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import (
+    Callable,
+    List,
+    Optional,
+)
+
+import pytest
+import regex as re
+
+from ondewo_bpi.intent_dispatch import (
+    IntentCallbackAssignor,
+    IntentDispatchIndex,
+    get_exact_intent_name,
+    get_handler_stages,
+)
+
+
+@pytest.mark.parametrize(
+    "intent_pattern, exact_name",
+    [
+        ("^i.hello$", None),
+        ("^i\\.hello$", "i.hello"),
+        ("i_hello$", "i_hello"),
+        ("Default Fallback Intent", None),
+        ("^i_hello", None),
+        ("^i\\d$", None),
+        ("^(a|b)$", None),
+    ],
+)
+def test_get_exact_intent_name(intent_pattern: str, exact_name: Optional[str]) -> None:
+    assert get_exact_intent_name(intent_pattern) == exact_name
+
+
+def test_dispatch_matches_the_linear_scan() -> None:
+    def handler(name: str) -> Callable:
+        def _handler() -> str:
+            return name
+
+        _handler.__name__ = name
+        return _handler
+
+    patterns: List[str] = [
+        "^i\\.order$", "i.order", "^i\\.order_pizza$", "i\\.order_.*", "Default", "^i_hello$", "^i_hello$", "i_hel",
+    ]
+    assignors: List[IntentCallbackAssignor] = []
+    for pattern in patterns:
+        assignors.append(IntentCallbackAssignor(intent_pattern=pattern, handlers=[handler(pattern)]))
+    linear_order: List[IntentCallbackAssignor] = sorted(assignors, reverse=True)
+    index = IntentDispatchIndex(assignors=assignors)
+
+    for intent_name in ["i.order", "i.order_pizza", "i.order_pasta", "ixorder", "Default Fallback Intent", "i_hello",
+                        "i_help", "unknown"]:
+        expected: List[Callable] = next(
+            (a.handlers for a in linear_order if re.match(a.intent_pattern, intent_name)), [],
+        )
+        assert list(index.resolve(intent_name)) == expected, intent_name
+        assert list(index.resolve(intent_name)) == expected, intent_name  # memoized
+
+
+def test_handler_stages() -> None:
+    def a() -> None:
+        pass
+
+    def b() -> None:
+        pass
+
+    def c() -> None:
+        pass
+
+    assert get_handler_stages([a, b, c]) == [[a], [b], [c]]
+    assert get_handler_stages([a, b, c], independent=True) == [[a, b, c]]
+    assert get_handler_stages([a, b, c], dependencies={c: [a]}) == [[a, b], [c]]
+    assert get_handler_stages([c, b, a], dependencies={c: [b], b: [a]}) == [[a], [b], [c]]
+    with pytest.raises(ValueError):
+        get_handler_stages([a, b], dependencies={a: [b], b: [a]})
+    with pytest.raises(ValueError):
+        get_handler_stages([a, b], dependencies={a: [c]})
@@ -0,0 +1,83 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+from typing import (
+    Any,
+    List,
+)
+
+from ondewo.nlu import session_pb2
+
+from ondewo_bpi.lazy_logging import (
+    LazyLogger,
+    PayloadLog,
+    parse_session_ids,
+)
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.records: List[logging.LogRecord] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.records.append(record)
+
+
+def _logger(name: str, level: int) -> Any:
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    logger.propagate = False
+    handler = RecordingHandler()
+    logger.addHandler(handler)
+    return logger, handler
+
+
+def test_lazy_logger_builds_messages_of_enabled_levels_only() -> None:
+    logger, handler = _logger("test_lazy_logging", logging.INFO)
+    lazy = LazyLogger(logger=logger)
+    built: List[str] = []
+
+    def build(text: str) -> Any:
+        built.append(text)
+        return {"message": text}
+
+    lazy.debug(lambda: build("debug"))
+    lazy.info(lambda: build("info"))
+    assert built == ["info"]
+    assert handler.records[0].msg == {"message": "info"}
+    assert handler.records[0].funcName == "test_lazy_logger_builds_messages_of_enabled_levels_only"
+
+
+def test_payload_log_logs_chosen_sessions_only() -> None:
+    logger, handler = _logger("test_payload_log", logging.INFO)
+    assert parse_session_ids(" a, ,b ") == frozenset({"a", "b"})
+    payload_log = PayloadLog(session_ids=["chosen"], session_ratio=0, logger=logger)
+    request = session_pb2.DetectIntentRequest(session="projects/p/agent/sessions/chosen")
+
+    payload_log.log(request.session, "request", request)
+    payload_log.log("projects/p/agent/sessions/other", "request", request)
+    assert [record.msg["stage"] for record in handler.records] == ["request"]
+    assert "projects/p/agent/sessions/chosen" in handler.records[0].msg["payload"]
+
+    payload_log.add_session("other")
+    assert payload_log.is_chosen("projects/p/agent/sessions/other")
+    payload_log.remove_session("other")
+    assert not payload_log.is_chosen("projects/p/agent/sessions/other")
+
+    sampled = PayloadLog(session_ids=[], session_ratio=0.25, logger=logger)
+    ratio = sum(sampled.is_chosen(f"session-{number}") for number in range(4000)) / 4000
+    assert 0.2 < ratio < 0.3
+    assert sampled.is_chosen("session-1") == sampled.is_chosen("session-1")
@@ -0,0 +1,84 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import io
+import logging
+from typing import (
+    List,
+    Tuple,
+)
+
+from ondewo_bpi.log_queue import (
+    LogQueue,
+    QueueLogHandler,
+    install_log_queue,
+    uninstall_log_queue,
+)
+from ondewo_bpi.metrics import MetricsRegistry
+
+
+class CountingStream(io.StringIO):
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.writes: int = 0
+
+    def write(self, text: str) -> int:
+        self.writes += 1
+        return super().write(text)
+
+
+def _logger(name: str) -> Tuple[logging.Logger, logging.StreamHandler, CountingStream]:
+    stream = CountingStream()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    return logger, handler, stream
+
+
+def test_writer_thread_writes_batches_and_full_queue_drops() -> None:
+    logger, handler, stream = _logger("test_log_queue_batches")
+    log_queue = LogQueue(max_size=100, batch_size=40, metrics=MetricsRegistry())
+    logger.addHandler(QueueLogHandler(log_queue=log_queue, handlers=[handler]))
+
+    changing: List[int] = [0]
+    logger.info("value %s", changing)
+    changing.append(1)  # rendered when it was logged
+    for number in range(1, 105):
+        logger.debug(f"record {number}")
+    assert log_queue.dropped == 5
+    assert log_queue.metrics.counter("log_queue_dropped_total") == 5
+
+    log_queue.start()
+    log_queue.stop()
+    lines: List[str] = stream.getvalue().splitlines()
+    assert lines[0] == "INFO value [0]"
+    assert lines[1:] == [f"DEBUG record {number}" for number in range(1, 100)]
+    assert stream.writes == 3
+    assert log_queue.metrics.counter("log_queue_written_total") == 100
+
+
+def test_install_routes_loggers_through_the_queue_and_uninstall_restores_them() -> None:
+    logger, handler, stream = _logger("test_log_queue_install")
+    logger.addHandler(handler)
+    log_queue = install_log_queue(logger_names=["test_log_queue_install"])
+    try:
+        assert install_log_queue() is log_queue
+        assert [type(installed) for installed in logger.handlers] == [QueueLogHandler]
+        logger.warning("queued")
+    finally:
+        uninstall_log_queue()
+    assert logger.handlers == [handler]
+    assert stream.getvalue() == "WARNING queued\n"
@@ -0,0 +1,99 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import (
+    Any,
+    Optional,
+)
+from unittest.mock import MagicMock
+
+import grpc
+from ondewo.nlu import (
+    intent_pb2,
+    session_pb2,
+)
+
+from ondewo_bpi.bpi_services import BpiSessionsServices
+from ondewo_bpi.metrics import (
+    BPI_METRICS,
+    Histogram,
+    MetricsRegistry,
+)
+
+
+def test_histogram_percentiles_are_accurate_with_bounded_buckets() -> None:
+    histogram = Histogram()
+    for millisecond in range(1, 1001):
+        histogram.record(millisecond / 1000)
+    histogram.record(10 ** 9)  # beyond the largest bucket
+    assert histogram.count == 1001
+    assert abs(histogram.percentile(50) - 0.5) < 0.5 * 0.016
+    assert abs(histogram.percentile(99) - 0.99) < 0.99 * 0.016
+    assert histogram.max == 10 ** 9
+    assert histogram.percentile(100) == histogram.max_units * histogram.resolution
+    assert len(histogram.buckets()) < 400
+    assert histogram.buckets()[-1][1] == 1001
+
+
+def test_snapshot_summarizes_labelled_histograms() -> None:
+    metrics = MetricsRegistry()
+    with metrics.time('stage_seconds{stage="a"}'):
+        pass
+    metrics.observe('stage_seconds{stage="a"}', 2.0)
+    snapshot = metrics.snapshot()
+    assert snapshot['stage_seconds_count{stage="a"}'] == 2
+    assert snapshot['stage_seconds_max{stage="a"}'] == 2.0
+    assert 1.9 < snapshot['stage_seconds_p99{stage="a"}'] <= 2.0
+
+
+def _count(name: str) -> int:
+    histogram: Optional[Histogram] = BPI_METRICS.histogram(name)
+    return histogram.count if histogram is not None else 0
+
+
+def test_detect_intent_records_stage_and_handler_timings() -> None:
+    class Services(BpiSessionsServices):
+        client: Any = MagicMock()
+
+    def greet(response: session_pb2.DetectIntentResponse, client: Any) -> session_pb2.DetectIntentResponse:
+        return response
+
+    services = Services()
+    cai_response = session_pb2.DetectIntentResponse(
+        response_id="cai",
+        query_result=session_pb2.QueryResult(intent=intent_pb2.Intent(display_name="i.greeting")),
+    )
+    cai_response.query_result.diagnostic_info["sessionId"] = "s"
+    services.client.services.sessions.detect_intent.return_value = cai_response
+    services.register_intent_handler(intent_pattern="i.greeting", handlers=[greet])
+    names = [
+        'detect_intent_stage_seconds{stage="truncate_request"}',
+        'detect_intent_stage_seconds{stage="cai_detect_intent",intent="i.greeting"}',
+        'detect_intent_stage_seconds{stage="process_messages",intent="i.greeting"}',
+        'detect_intent_stage_seconds{stage="intent_handlers",intent="i.greeting"}',
+        'detect_intent_stage_seconds{stage="return_response",intent="i.greeting"}',
+        'intent_handler_seconds{intent="i.greeting",handler="' + greet.__qualname__ + '"}',
+    ]
+    counts = [_count(name) for name in names]
+
+    context = MagicMock(spec=grpc.ServicerContext)
+    context.time_remaining.return_value = None
+    context.is_active.return_value = True
+    services.DetectIntent(
+        session_pb2.DetectIntentRequest(
+            session="s",
+            query_input=session_pb2.QueryInput(text=session_pb2.TextInput(text="hi", language_code="de")),
+        ),
+        context,
+    )
+    assert [_count(name) - count for name, count in zip(names, counts)] == [1] * len(names)
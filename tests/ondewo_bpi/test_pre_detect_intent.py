@@ -0,0 +1,67 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import Any
+from unittest.mock import MagicMock
+
+import grpc
+from ondewo.nlu import (
+    intent_pb2,
+    session_pb2,
+)
+
+from ondewo_bpi.bpi_services import BpiSessionsServices
+from ondewo_bpi.pre_detect_intent import answer_events
+
+
+def _servicer_context() -> Any:
+    context = MagicMock(spec=grpc.ServicerContext)
+    context.time_remaining.return_value = None
+    context.is_active.return_value = True
+    return context
+
+
+def test_hook_answers_keep_alive_events_without_cai() -> None:
+    class Services(BpiSessionsServices):
+        client: Any = MagicMock()
+
+    services = Services()
+    cai_response = session_pb2.DetectIntentResponse(response_id="cai")
+    cai_response.query_result.diagnostic_info["sessionId"] = "s"
+    services.client.services.sessions.detect_intent.return_value = cai_response
+    keep_alive_response = session_pb2.DetectIntentResponse(
+        query_result=session_pb2.QueryResult(intent=intent_pb2.Intent(display_name="i.keep_alive")),
+    )
+    services.register_pre_detect_intent_hook(answer_events({"SIP_KEEP_ALIVE": keep_alive_response}))
+    handler = MagicMock(side_effect=lambda response, client: response)
+    services.register_intent_handler(intent_pattern="i.keep_alive", handlers=[handler])
+
+    keep_alive = session_pb2.DetectIntentRequest(
+        session="s",
+        query_input=session_pb2.QueryInput(event=session_pb2.EventInput(name="SIP_KEEP_ALIVE", language_code="de")),
+    )
+    response = services.DetectIntent(keep_alive, _servicer_context())
+    services.session_step_tracker.shutdown(wait=True)
+
+    assert response.query_result.intent.display_name == "i.keep_alive"
+    assert response.response_id and response.query_result.diagnostic_info["sessionId"] == "s"
+    assert handler.call_count == 1
+    services.client.services.sessions.detect_intent.assert_not_called()
+    track_request = services.client.services.sessions.track_session_step.call_args[0][0]
+    assert track_request.session_step.detect_intent_request == keep_alive
+
+    text = session_pb2.DetectIntentRequest(
+        session="s",
+        query_input=session_pb2.QueryInput(text=session_pb2.TextInput(text="hello", language_code="de")),
+    )
+    assert services.DetectIntent(text, _servicer_context()).response_id == "cai"
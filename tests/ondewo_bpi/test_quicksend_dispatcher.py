@@ -0,0 +1,119 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+from threading import Event
+from typing import (
+    Any,
+    List,
+    Optional,
+    Tuple,
+)
+from unittest.mock import MagicMock
+
+from ondewo.nlu import (
+    intent_pb2,
+    session_pb2,
+)
+
+from ondewo_bpi.bpi_services import BpiSessionsServices
+from ondewo_bpi.metrics import MetricsRegistry
+from ondewo_bpi.quicksend_dispatcher import QuicksendDispatcher
+
+
+def _response(session: str, texts: List[str]) -> session_pb2.DetectIntentResponse:
+    response = session_pb2.DetectIntentResponse(
+        response_id=session,
+        query_result=session_pb2.QueryResult(
+            fulfillment_messages=[
+                intent_pb2.Intent.Message(text=intent_pb2.Intent.Message.Text(text=[text])) for text in texts
+            ],
+        ),
+    )
+    response.query_result.diagnostic_info["sessionId"] = session
+    return response
+
+
+def test_messages_of_a_session_are_delivered_in_order() -> None:
+    delivered: List[Tuple[str, int]] = []
+
+    def send(response: session_pb2.DetectIntentResponse, message: Optional[intent_pb2.Intent.Message],
+             count: int) -> None:
+        time.sleep(0.01 * (3 - count))  # earlier messages take longer
+        delivered.append((response.response_id, count))
+
+    dispatcher = QuicksendDispatcher(send=send, max_concurrency=4, metrics=MetricsRegistry())
+    for session in ["a", "b"]:
+        response = _response(session, ["1", "2", "3"])
+        for count, message in enumerate(response.query_result.fulfillment_messages):
+            assert dispatcher.submit(session_name=session, response=response, message=message, count=count)
+    assert dispatcher.flush(timeout=5)
+    dispatcher.stop()
+
+    for session in ["a", "b"]:
+        assert [count for name, count in delivered if name == session] == [0, 1, 2]
+    assert dispatcher.metrics.counter("quicksend_delivered_total") == 6
+
+
+def test_full_queue_drops_and_stale_messages_expire() -> None:
+    release = Event()
+    delivered: List[str] = []
+
+    def send(response: session_pb2.DetectIntentResponse, message: Optional[intent_pb2.Intent.Message],
+             count: int) -> None:
+        release.wait(timeout=5)
+        delivered.append(message.text.text[0])
+
+    dispatcher = QuicksendDispatcher(
+        send=send, max_concurrency=1, max_pending=1, message_ttl_seconds=0.1, enqueue_timeout_seconds=0.0,
+        metrics=MetricsRegistry(),
+    )
+    response = _response("s", ["in flight", "queued", "dropped"])
+    messages = response.query_result.fulfillment_messages
+    assert dispatcher.submit(session_name="s", response=response, message=messages[0], count=0)
+    time.sleep(0.05)  # the first message is taken by the worker
+    assert dispatcher.submit(session_name="s", response=response, message=messages[1], count=1)
+    assert not dispatcher.submit(session_name="s", response=response, message=messages[2], count=2)
+    time.sleep(0.15)
+    release.set()
+    assert dispatcher.flush(timeout=5)
+    dispatcher.stop()
+
+    assert delivered == ["in flight"]
+    assert dispatcher.metrics.counter("quicksend_dropped_total") == 1
+    assert dispatcher.metrics.counter("quicksend_expired_total") == 1
+
+
+def test_process_messages_does_not_wait_for_delivery() -> None:
+    class Services(BpiSessionsServices):
+        client: Any = MagicMock()
+
+    release = Event()
+    sent: List[str] = []
+
+    def quicksend_to_api(response: session_pb2.DetectIntentResponse, message: Optional[intent_pb2.Intent.Message],
+                         count: int) -> None:
+        release.wait(timeout=5)
+        sent.append(message.text.text[0])
+
+    services = Services()
+    services.quicksend_dispatcher = QuicksendDispatcher(send=quicksend_to_api, metrics=MetricsRegistry())
+    response = _response("s", ["hello", "how are you?"])
+    assert services.process_messages(response) is response
+    response.query_result.fulfillment_messages[0].text.text[0] = "changed after the response was sent"
+    assert sent == []
+
+    release.set()
+    assert services.quicksend_dispatcher.flush(timeout=5)
+    services.quicksend_dispatcher.stop()
+    assert sent == ["hello", "how are you?"]
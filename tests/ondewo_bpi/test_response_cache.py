@@ -0,0 +1,158 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+from typing import Any
+from unittest.mock import MagicMock
+
+import grpc
+from ondewo.nlu import (
+    context_pb2,
+    intent_pb2,
+    session_pb2,
+)
+
+from ondewo_bpi.bpi_services import BpiSessionsServices
+from ondewo_bpi.context_mirror import SessionContextMirror
+from ondewo_bpi.helpers import add_params_to_cai_context
+from ondewo_bpi.metrics import MetricsRegistry
+from ondewo_bpi.response_cache import (
+    ResponseCache,
+    context_preserving,
+)
+from ondewo_bpi.session_state_cache import SessionStateCache
+
+
+def _request(text: str, session: str = "s") -> session_pb2.DetectIntentRequest:
+    return session_pb2.DetectIntentRequest(
+        session=session,
+        query_input=session_pb2.QueryInput(text=session_pb2.TextInput(text=text, language_code="de")),
+    )
+
+
+def _response(intent_name: str, session: str = "s") -> session_pb2.DetectIntentResponse:
+    response = session_pb2.DetectIntentResponse(
+        response_id="cai",
+        query_result=session_pb2.QueryResult(intent=intent_pb2.Intent(display_name=intent_name)),
+    )
+    response.query_result.diagnostic_info["sessionId"] = session
+    return response
+
+
+def _servicer_context() -> Any:
+    context = MagicMock(spec=grpc.ServicerContext)
+    context.time_remaining.return_value = None
+    context.is_active.return_value = True
+    return context
+
+
+def test_only_context_free_turns_of_allowed_intents_are_cached() -> None:
+    cache = ResponseCache(ttl_seconds=0.2, denied_intents=["i.denied"], metrics=MetricsRegistry())
+    assert cache.get_key(_request("Hi"), alive_context_names=None) is None  # unknown session
+    assert cache.get_key(_request("Hi"), alive_context_names={"s/contexts/c"}) is None
+    key = cache.get_key(_request("  Opening   HOURS "), alive_context_names=set())
+    assert key == ("", "opening hours", "de")
+
+    assert not cache.put(key, _response("i.denied"))  # type: ignore[arg-type]
+    with_context = _response("i.faq")
+    with_context.query_result.output_contexts.append(context_pb2.Context(name="s/contexts/c", lifespan_count=1))
+    assert not cache.put(key, with_context)  # type: ignore[arg-type]
+    assert cache.put(key, _response("i.faq"))  # type: ignore[arg-type]
+
+    hit = cache.get(key, _request("opening hours", session="other"))  # type: ignore[arg-type]
+    assert hit is not None
+    assert hit.query_result.diagnostic_info["sessionId"] == "other"
+    assert hit.response_id != "cai"
+    time.sleep(0.3)
+    assert cache.get(key, _request("opening hours")) is None  # type: ignore[arg-type]
+    assert cache.metrics.counter("response_cache_hits_total") == 1
+    assert cache.metrics.gauge("response_cache_hit_ratio") == 0.5
+
+
+def test_agents_of_other_projects_do_not_share_cached_responses() -> None:
+    cache = ResponseCache(metrics=MetricsRegistry())
+    pizza = cache.get_key(_request("Opening hours", session="projects/pizza/agent/sessions/1"), set())
+    bank = cache.get_key(_request("Opening hours", session="projects/bank/agent/sessions/1"), set())
+    assert pizza == ("projects/pizza/agent", "opening hours", "de")
+    assert bank is not None and pizza is not None
+    assert cache.get_shared_key(pizza) != cache.get_shared_key(bank)
+    assert cache.put(pizza, _response("i.pizza_opening_hours"))
+    assert cache.get(bank, _request("Opening hours", session="projects/bank/agent/sessions/1")) is None
+    same_agent = cache.get(pizza, _request("opening hours", session="projects/pizza/agent/sessions/2"))
+    assert same_agent is not None and same_agent.query_result.intent.display_name == "i.pizza_opening_hours"
+
+
+def test_cache_hit_replaces_the_cai_call_and_tracks_the_session_step() -> None:
+    class Services(BpiSessionsServices):
+        client: Any = MagicMock()
+
+    services = Services()
+    services.context_mirror = SessionContextMirror(metrics=MetricsRegistry())
+    services.response_cache = ResponseCache(metrics=MetricsRegistry())
+    services.client.services.sessions.detect_intent.side_effect = lambda request: _response("i.faq")
+    handled = MagicMock(side_effect=lambda response, client: response)
+    services.register_intent_handler(intent_pattern="i.faq", handlers=[context_preserving(handled)])
+
+    for _ in range(3):
+        services.DetectIntent(_request("opening hours"), _servicer_context())
+    # the first turn is a miss of the context mirror, the second one a miss of the cache
+    assert services.client.services.sessions.detect_intent.call_count == 2
+    assert handled.call_count == 3
+    services.response_cache.session_step_tracker.shutdown(wait=True)
+    services.client.services.sessions.track_session_step.assert_called_once()
+
+    # an intent handler which may change contexts makes the intent uncacheable
+    services.register_intent_handler(intent_pattern="i.faq.*", handlers=[lambda response, client: response])
+    services.response_cache = ResponseCache(metrics=MetricsRegistry())
+    for _ in range(2):
+        services.DetectIntent(_request("opening hours"), _servicer_context())
+    assert services.client.services.sessions.detect_intent.call_count == 4
+
+
+class NotFoundError(grpc.RpcError):
+    def code(self) -> grpc.StatusCode:
+        return grpc.StatusCode.NOT_FOUND
+
+
+def test_a_context_created_by_a_handler_bypasses_the_cache_on_the_next_turn() -> None:
+    def open_order(response: session_pb2.DetectIntentResponse, client: Any) -> session_pb2.DetectIntentResponse:
+        add_params_to_cai_context(client=client, response=response, params={"size": "large"}, context="order")
+        return response
+
+    def get_context(request: context_pb2.GetContextRequest) -> context_pb2.Context:
+        raise NotFoundError()
+
+    # written directly by the helper (the context exists already) and at the end of the turn by the state cache
+    for session, session_state_cache in [
+        ("projects/p/agent/sessions/direct", None),
+        ("projects/p/agent/sessions/turn", SessionStateCache(metrics=MetricsRegistry())),
+    ]:
+        class Services(BpiSessionsServices):
+            client: Any = MagicMock()
+
+        services = Services()
+        services.session_state_cache = session_state_cache
+        services.response_cache = ResponseCache(metrics=MetricsRegistry())
+        services.client.services.sessions.detect_intent.side_effect = lambda request: _response(
+            "i.order" if request.query_input.text.text == "pizza" else "i.faq", session=request.session,
+        )
+        services.client.services.contexts.get_context.side_effect = \
+            get_context if session_state_cache is not None else \
+            lambda request: context_pb2.Context(name=request.name, lifespan_count=5)
+        services.register_intent_handler(intent_pattern="i.order", handlers=[open_order])
+
+        for text in ["opening hours", "opening hours", "pizza", "opening hours"]:
+            services.DetectIntent(_request(text, session=session), _servicer_context())
+        # the last turn is not context-free anymore and goes to CAI instead of the cached context-free answer
+        assert services.client.services.sessions.detect_intent.call_count == 4
+        assert services.response_cache.metrics.counter("response_cache_hits_total") == 0
@@ -0,0 +1,132 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import Any
+from unittest.mock import MagicMock
+
+import grpc
+from ondewo.nlu import (
+    context_pb2,
+    intent_pb2,
+    session_pb2,
+)
+
+from ondewo_bpi.bpi_services import BpiSessionsServices
+from ondewo_bpi.helpers import (
+    add_params_to_cai_context,
+    delete_param_from_cai_context,
+)
+from ondewo_bpi.metrics import MetricsRegistry
+from ondewo_bpi.session_state_cache import (
+    SessionStateCache,
+    session_state_turn,
+)
+
+SESSION: str = "projects/p/agent/sessions/s"
+
+
+class NotFoundError(grpc.RpcError):
+    def code(self) -> grpc.StatusCode:
+        return grpc.StatusCode.NOT_FOUND
+
+
+def _response(*output_contexts: context_pb2.Context) -> session_pb2.DetectIntentResponse:
+    response = session_pb2.DetectIntentResponse(
+        response_id="r",
+        query_result=session_pb2.QueryResult(
+            intent=intent_pb2.Intent(display_name="i.order"),
+            output_contexts=output_contexts,
+        ),
+    )
+    response.query_result.diagnostic_info["sessionId"] = SESSION
+    return response
+
+
+def _servicer_context() -> Any:
+    context = MagicMock(spec=grpc.ServicerContext)
+    context.time_remaining.return_value = None
+    context.is_active.return_value = True
+    return context
+
+
+def test_writes_of_a_turn_are_flushed_once() -> None:
+    client = MagicMock()
+    existing = context_pb2.Context(name=f"{SESSION}/contexts/order", lifespan_count=5)
+    existing.parameters["size"].value = "large"
+    client.services.contexts.get_context.return_value = existing
+    cache = SessionStateCache(metrics=MetricsRegistry())
+
+    with session_state_turn(client=client, cache=cache):
+        add_params_to_cai_context(client, _response(), {"pizza": "salami"}, "order")
+        add_params_to_cai_context(client, _response(), {"drink": "water"}, "order")
+        delete_param_from_cai_context(client, _response(), "size", "order")
+        client.services.contexts.create_context.assert_not_called()
+
+    assert client.services.contexts.get_context.call_count == 1
+    client.services.contexts.update_context.assert_not_called()
+    client.services.contexts.delete_context.assert_called_once()
+    created = client.services.contexts.create_context.call_args[1]["request"].context
+    assert sorted(created.parameters) == ["drink", "pizza"]
+    # the written state is cached
+    assert cache.get(f"{SESSION}/contexts/order")[1] == created
+
+
+def test_output_contexts_of_the_turn_answer_the_helper_reads() -> None:
+    class Services(BpiSessionsServices):
+        client: Any = MagicMock()
+
+    services = Services()
+    services.session_state_cache = SessionStateCache(metrics=MetricsRegistry())
+    order = context_pb2.Context(name=f"{SESSION}/contexts/order", lifespan_count=5)
+    services.client.services.sessions.detect_intent.return_value = _response(order)
+    services.client.services.contexts.get_context.side_effect = NotFoundError()
+
+    def handler(response: session_pb2.DetectIntentResponse, client: Any) -> session_pb2.DetectIntentResponse:
+        add_params_to_cai_context(client, response, {"pizza": "salami"}, "order")
+        add_params_to_cai_context(client, response, {"new": "context"}, "other")
+        return response
+
+    services.register_intent_handler(intent_pattern="i.order", handlers=[handler])
+    services.DetectIntent(
+        session_pb2.DetectIntentRequest(
+            session=SESSION,
+            query_input=session_pb2.QueryInput(text=session_pb2.TextInput(text="salami", language_code="de")),
+        ),
+        _servicer_context(),
+    )
+
+    # the order context is known from the response, only the unknown one is looked up
+    assert services.client.services.contexts.get_context.call_count == 1
+    update = services.client.services.contexts.update_context.call_args[1]["request"]
+    assert update.context.parameters["pizza"].value == "salami"
+    services.client.services.contexts.create_context.assert_called_once()
+
+
+def test_update_from_response_only_replaces_the_contexts_of_its_session() -> None:
+    cache = SessionStateCache(max_entries=3, ttl_seconds=60, metrics=MetricsRegistry())
+    other_session: str = "projects/p/agent/sessions/other"
+    cache.put(f"{other_session}/contexts/a", context_pb2.Context(name=f"{other_session}/contexts/a"))
+    cache.put(f"{SESSION}/contexts/old", context_pb2.Context(name=f"{SESSION}/contexts/old"))
+
+    cache.update_from_response(SESSION, _response(context_pb2.Context(name=f"{SESSION}/contexts/new")))
+    assert cache.get(f"{SESSION}/contexts/old") == (False, None)
+    assert cache.get(f"{SESSION}/contexts/new")[0]
+    assert cache.get(f"{other_session}/contexts/a")[0]
+
+    # evicted entries leave the index of their session as well
+    for name in ["x", "y", "z"]:
+        cache.put(f"{SESSION}/contexts/{name}", None)
+    assert len(cache) == 3
+    assert cache._session_contexts == {SESSION: {f"{SESSION}/contexts/{name}" for name in ["x", "y", "z"]}}
+    cache.invalidate_session(SESSION)
+    assert len(cache) == 0 and not cache._session_contexts
@@ -0,0 +1,44 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from threading import Event
+from typing import Any
+from unittest.mock import MagicMock
+
+from ondewo.nlu import session_pb2
+
+from ondewo_bpi.metrics import MetricsRegistry
+from ondewo_bpi.session_steps import SessionStepTracker
+
+
+def test_session_steps_beyond_max_pending_are_dropped() -> None:
+    release: Event = Event()
+    client: Any = MagicMock()
+    client.services.sessions.track_session_step.side_effect = lambda request: release.wait(timeout=10)
+    tracker = SessionStepTracker(
+        errors_metric="errors_total",
+        dropped_metric="dropped_total",
+        num_workers=1,
+        max_pending=2,
+        metrics=MetricsRegistry(),
+    )
+    request = session_pb2.DetectIntentRequest(session="projects/p/agent/sessions/s")
+    for _ in range(5):
+        tracker.track(client=client, request=request, response=session_pb2.DetectIntentResponse())
+
+    assert tracker.pending == 2
+    assert tracker.metrics.counter("dropped_total") == 3
+    release.set()
+    tracker.shutdown(wait=True)
+    assert tracker.pending == 0
+    assert client.services.sessions.track_session_step.call_count == 2
@@ -0,0 +1,107 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from unittest.mock import MagicMock
+
+import grpc
+import pytest
+from ondewo.nlu import (
+    intent_pb2,
+    session_pb2,
+)
+
+from ondewo_bpi.bpi_services import BpiSessionsServices
+from ondewo_bpi.metrics import MetricsRegistry
+from ondewo_bpi.single_flight import (
+    SingleFlight,
+    get_request_fingerprint,
+)
+
+
+def _request(text: str) -> session_pb2.DetectIntentRequest:
+    return session_pb2.DetectIntentRequest(
+        session="s",
+        query_input=session_pb2.QueryInput(text=session_pb2.TextInput(text=text, language_code="de")),
+    )
+
+
+def _servicer_context(active: bool = True) -> Any:
+    context = MagicMock(spec=grpc.ServicerContext)
+    context.time_remaining.return_value = None
+    context.is_active.return_value = active
+    return context
+
+
+@pytest.fixture
+def services() -> Any:
+    class Services(BpiSessionsServices):
+        client: Any = MagicMock()
+
+    def detect_intent(request: session_pb2.DetectIntentRequest) -> session_pb2.DetectIntentResponse:
+        time.sleep(0.3)
+        response = session_pb2.DetectIntentResponse(
+            response_id=request.query_input.text.text,
+            query_result=session_pb2.QueryResult(intent=intent_pb2.Intent(display_name="i.order")),
+        )
+        response.query_result.diagnostic_info["sessionId"] = request.session
+        return response
+
+    bpi = Services()
+    bpi.single_flight = SingleFlight(window_seconds=0.5, metrics=MetricsRegistry())
+    bpi.client.services.sessions.detect_intent.side_effect = detect_intent
+    return bpi
+
+
+def test_fingerprint_covers_session_text_and_query_params() -> None:
+    request = _request("one pizza")
+    assert get_request_fingerprint(request) == get_request_fingerprint(_request("one pizza"))
+    assert get_request_fingerprint(request) != get_request_fingerprint(_request("two pizzas"))
+    request.query_params.time_zone = "Europe/Vienna"
+    assert get_request_fingerprint(request) != get_request_fingerprint(_request("one pizza"))
+
+
+def test_duplicates_are_served_by_one_call(services: Any) -> None:
+    handler = MagicMock(side_effect=lambda response, client: response)
+    services.register_intent_handler(intent_pattern="i.order", handlers=[handler])
+    # the first caller gives up, the work continues for the retry attached to it
+    contexts = [_servicer_context(active=False), _servicer_context()]
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first = executor.submit(services.DetectIntent, _request("one pizza"), contexts[0])
+        time.sleep(0.1)
+        retry = executor.submit(services.DetectIntent, _request("one pizza"), contexts[1])
+        responses = [first.result(), retry.result()]
+    late_duplicate = services.DetectIntent(_request("one pizza"), _servicer_context())
+
+    assert services.client.services.sessions.detect_intent.call_count == 1
+    assert handler.call_count == 1
+    assert all(response.response_id == "one pizza" for response in [*responses, late_duplicate])
+    assert responses[0] is not responses[1]
+    assert services.single_flight.metrics.counter("single_flight_attached_total") == 1
+    assert services.single_flight.metrics.counter("single_flight_late_duplicates_total") == 1
+
+    time.sleep(0.6)  # after the window an identical request is a new turn
+    services.DetectIntent(_request("one pizza"), _servicer_context())
+    assert services.client.services.sessions.detect_intent.call_count == 2
+
+
+def test_failed_call_is_not_remembered(services: Any) -> None:
+    services.client.services.sessions.detect_intent.side_effect = RuntimeError("CAI unavailable")
+    with pytest.raises(RuntimeError):
+        services.DetectIntent(_request("one pizza"), _servicer_context())
+    with pytest.raises(RuntimeError):
+        services.DetectIntent(_request("one pizza"), _servicer_context())
+    assert services.client.services.sessions.detect_intent.call_count == 2
+    assert len(services.single_flight) == 0
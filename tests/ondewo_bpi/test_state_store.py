@@ -0,0 +1,119 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+from unittest.mock import MagicMock
+
+import pytest
+from ondewo.nlu import (
+    intent_pb2,
+    session_pb2,
+)
+
+from ondewo_bpi.metrics import MetricsRegistry
+from ondewo_bpi.response_cache import ResponseCache
+from ondewo_bpi.single_flight import SingleFlight
+from ondewo_bpi.state_store import (
+    InMemoryStateStore,
+    RedisStateStore,
+    create_state_store,
+)
+
+
+def _response(intent_name: str = "i.faq") -> session_pb2.DetectIntentResponse:
+    response = session_pb2.DetectIntentResponse(
+        response_id="cai",
+        query_result=session_pb2.QueryResult(intent=intent_pb2.Intent(display_name=intent_name)),
+    )
+    response.query_result.diagnostic_info["sessionId"] = "s"
+    return response
+
+
+def test_in_memory_store_expires_compares_and_sets_in_batches() -> None:
+    store = InMemoryStateStore()
+    store.set("a", b"1", ttl_seconds=0.1)
+    store.set_many({"b": b"2", "c": b"3"})
+    assert store.get_many(["a", "b", "c", "d"]) == [b"1", b"2", b"3", None]
+
+    assert not store.compare_and_set("b", expected=None, value=b"x")
+    assert not store.compare_and_set("b", expected=b"1", value=b"x")
+    assert store.compare_and_set("b", expected=b"2", value=b"x")
+    assert store.compare_and_set("d", expected=None, value=b"4")
+    assert store.get_many(["b", "d"]) == [b"x", b"4"]
+
+    time.sleep(0.15)
+    assert store.get("a") is None
+    assert store.compare_and_set("a", expected=None, value=b"5")
+    store.delete("c")
+    assert store.get_many(["a", "c"]) == [b"5", None]
+
+
+def test_redis_store_prefixes_keys_and_pipelines_batches() -> None:
+    client = MagicMock()
+    store = RedisStateStore(client=client, key_prefix="bpi:")
+    store.set("a", b"1", ttl_seconds=1.5)
+    client.set.assert_called_once_with("bpi:a", b"1", px=1500)
+    store.set_many({"b": b"2", "c": b"3"})
+    pipeline = client.pipeline.return_value
+    assert [call.args[0] for call in pipeline.set.call_args_list] == ["bpi:b", "bpi:c"]
+    pipeline.execute.assert_called_once_with()
+    client.mget.return_value = [b"2", None]
+    assert store.get_many(["b", "x"]) == [b"2", None]
+    client.mget.assert_called_once_with(["bpi:b", "bpi:x"])
+    client.eval.return_value = 1
+    assert store.compare_and_set("b", expected=b"2", value=b"4")
+    assert client.eval.call_args.args[1:] == (1, "bpi:b", "1", b"2", b"4", "0")
+
+
+def test_create_state_store() -> None:
+    assert create_state_store("") is None
+    assert isinstance(create_state_store("memory://"), InMemoryStateStore)
+    with pytest.raises(ValueError):
+        create_state_store("etcd://etcd:2379")
+
+
+def test_replicas_share_cached_responses_and_deduplication_windows() -> None:
+    store = InMemoryStateStore()
+    replica_1 = ResponseCache(metrics=MetricsRegistry(), state_store=store)
+    replica_2 = ResponseCache(metrics=MetricsRegistry(), state_store=store)
+    request = session_pb2.DetectIntentRequest(
+        session="other",
+        query_input=session_pb2.QueryInput(text=session_pb2.TextInput(text="Opening hours", language_code="de")),
+    )
+    key = replica_1.get_key(request, alive_context_names=set())
+    assert replica_1.put(key, _response())  # type: ignore[arg-type]
+    hit = replica_2.get(key, request)  # type: ignore[arg-type]
+    assert hit is not None and hit.query_result.intent.display_name == "i.faq"
+    assert hit.query_result.diagnostic_info["sessionId"] == "other"
+    assert replica_2.metrics.counter("response_cache_shared_hits_total") == 1
+    assert len(replica_2) == 1
+
+    flights_1 = SingleFlight(window_seconds=1, metrics=MetricsRegistry(), state_store=store)
+    flights_2 = SingleFlight(window_seconds=1, metrics=MetricsRegistry(), state_store=store)
+    flight, is_leader = flights_1.join(key=b"retry", context=MagicMock())
+    assert is_leader
+    flights_1.succeed(key=b"retry", flight=flight, response=_response())
+    duplicate, is_leader = flights_2.join(key=b"retry", context=MagicMock())
+    assert not is_leader
+    assert duplicate.get_response(timeout=0).query_result.intent.display_name == "i.faq"
+    assert flights_2.metrics.counter("single_flight_shared_duplicates_total") == 1
+
+
+def test_unavailable_store_is_a_miss() -> None:
+    store = MagicMock()
+    store.get.side_effect = ConnectionError("redis down")
+    store.set.side_effect = ConnectionError("redis down")
+    cache = ResponseCache(metrics=MetricsRegistry(), state_store=store)
+    assert cache.put(("", "hi", "de"), _response())
+    assert cache.get(("", "bye", "de"), session_pb2.DetectIntentRequest(session="s")) is None
+    assert cache.metrics.counter("state_store_errors_total") == 2
@@ -0,0 +1,82 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import (
+    Any,
+    Iterator,
+    List,
+)
+from unittest.mock import MagicMock
+
+import grpc
+from ondewo.nlu import (
+    intent_pb2,
+    session_pb2,
+)
+
+from ondewo_bpi.bpi_services import BpiSessionsServices
+
+
+def fake_cai_stream(
+    request_iterator: Iterator[session_pb2.StreamingDetectIntentRequest],
+) -> Iterator[session_pb2.StreamingDetectIntentResponse]:
+    """answers every audio chunk with an interim transcript and the end of the stream with the final result"""
+    for _ in request_iterator:
+        yield session_pb2.StreamingDetectIntentResponse(
+            recognition_result=session_pb2.StreamingRecognitionResult(transcript="one pi"),
+        )
+    query_result = session_pb2.QueryResult(
+        intent=intent_pb2.Intent(display_name="i.order"),
+        fulfillment_messages=[intent_pb2.Intent.Message(text=intent_pb2.Intent.Message.Text(text=["ordered"]))],
+    )
+    query_result.diagnostic_info["sessionId"] = "s"
+    yield session_pb2.StreamingDetectIntentResponse(
+        response_id="r",
+        recognition_result=session_pb2.StreamingRecognitionResult(transcript="one pizza", is_final=True),
+        query_result=query_result,
+    )
+
+
+def test_streaming_detect_intent_relays_chunks_and_processes_the_final_result() -> None:
+    class Services(BpiSessionsServices):
+        client: Any = MagicMock()
+
+    services = Services()
+    services.client.services.sessions.streaming_detect_intent.side_effect = \
+        lambda request_iterator: fake_cai_stream(request_iterator)
+
+    def handler(response: session_pb2.DetectIntentResponse, client: Any) -> session_pb2.DetectIntentResponse:
+        response.query_result.fulfillment_messages[0].text.text[0] += " by the BPI"
+        return response
+
+    services.register_intent_handler(intent_pattern="i.order", handlers=[handler])
+
+    sent_chunks: List[int] = []
+
+    def audio_chunks() -> Iterator[session_pb2.StreamingDetectIntentRequest]:
+        for chunk in range(3):
+            sent_chunks.append(chunk)
+            yield session_pb2.StreamingDetectIntentRequest(session="s", input_audio=bytes([chunk]))
+
+    context = MagicMock(spec=grpc.ServicerContext)
+    context.time_remaining.return_value = None
+    context.is_active.return_value = True
+    responses = services.StreamingDetectIntent(audio_chunks(), context)
+
+    first_response = next(responses)
+    assert first_response.recognition_result.transcript == "one pi"
+    assert sent_chunks == [0]  # nothing is buffered
+    *interim_responses, final_response = list(responses)
+    assert len(interim_responses) == 2
+    assert final_response.recognition_result.transcript == "one pizza"
+    assert final_response.query_result.fulfillment_messages[0].text.text[0] == "ordered by the BPI"
@@ -0,0 +1,84 @@
+# Copyright 2021-2024 ONDEWO GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the License);
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import (
+    Any,
+    List,
+)
+from unittest.mock import MagicMock
+
+from ondewo.nlu import (
+    intent_pb2,
+    session_pb2,
+)
+
+from ondewo_bpi.bpi_services import BpiSessionsServices
+from ondewo_bpi.constants import (
+    QueryTriggers,
+    SipTriggers,
+)
+from ondewo_bpi.message_handler import MessageHandler
+from ondewo_bpi.trigger_scanner import TriggerScanner
+
+
+def _message(*texts: str) -> intent_pb2.Intent.Message:
+    return intent_pb2.Intent.Message(text=intent_pb2.Intent.Message.Text(text=texts))
+
+
+def test_all_triggers_and_their_arguments_are_found_in_one_scan() -> None:
+    message = _message(
+        "<SIP:HUMAN_HANDOVER=('agent')> hello <SIP:SEND_NOW=('one')> <SIP:SEND_NOW=hi <c-name.value>> <SIP:HANGUP>",
+    )
+    assert MessageHandler.get_triggers(message) == {
+        SipTriggers.SIP_HANGUP.value: ["<SIP:HANGUP>"],
+        SipTriggers.SIP_HUMAN_HANDOVER.value: ["agent"],
+        SipTriggers.SIP_SEND_NOW.value: ["one", "hi <c-name.value"],
+        QueryTriggers.REPLACEMENT_TRIGGER.value: ["c-name.value"],
+    }
+    card = intent_pb2.Intent.Message(card=intent_pb2.Intent.Message.Card(subtitle="<SIP:PAUSE=('10s')> <SIP:PAUSE=5>"))
+    assert MessageHandler.get_triggers(card) == {SipTriggers.SIP_PAUSE.value: ["10s", "5"]}
+    assert MessageHandler.get_triggers(_message("no triggers", "in <here")) == {}
+    # as before, triggers of later texts are found, their arguments are taken from the first text only
+    assert MessageHandler.get_triggers(_message("first", "<SIP:HANGUP>")) == {SipTriggers.SIP_HANGUP.value: []}
+
+
+def test_own_trigger_patterns_are_scanned() -> None:
+    scanner = TriggerScanner(patterns=["<A=(.*?)>"])
+    assert scanner.scan(_message("x [B:1] y <A=2>")) == {"<A=(.*?)>": ["2"]}
+    scanner.register(r"\[B:(\d)\]")  # no common first character, the scan is not prefiltered any more
+    assert scanner.scan(_message("x [B:1] y <A=2>")) == {"<A=(.*?)>": ["2"], r"\[B:(\d)\]": ["1"]}
+
+    # the alternatives start with different characters, so there is no character to prefilter on
+    alternatives = TriggerScanner.with_default_triggers()
+    alternatives.register("STOP|HALT")
+    assert alternatives.scan(_message("please HALT now")) == {"STOP|HALT": ["HALT"]}
+    assert alternatives.scan(_message("<SIP:HANGUP> STOP")) == {
+        SipTriggers.SIP_HANGUP.value: ["<SIP:HANGUP>"], "STOP|HALT": ["STOP"],
+    }
+
+    class Services(BpiSessionsServices):
+        client: Any = MagicMock()
+
+    calls: List[List[str]] = []
+
+    def on_order(response: Any, message: Any, trigger: str, found_triggers: Any) -> None:
+        calls.append(found_triggers[trigger])
+
+    services = Services()
+    services.register_trigger_handler("<ORDER:(\\d+)>", on_order)
+    response = session_pb2.DetectIntentResponse(
+        query_result=session_pb2.QueryResult(fulfillment_messages=[_message("ordered <ORDER:42>")]),
+    )
+    response.query_result.diagnostic_info["sessionId"] = "s"
+    services.process_messages(response)
+    assert calls == [["42"]]